@@ -0,0 +1,149 @@
+import json
+import os
+import os.path
+
+import tensorflow as tf
+from tensorflow.keras.callbacks import Callback
+
+from non_ml.ranking import recall_at_k
+
+"""
+Checkpoints, resume and early stopping for train.py.
+
+A checkpoint directory holds
+
+- `latest/`, the model and optimizer state of the last checkpointed epochs
+- `best/`, the same for the epoch with the best validation score
+- `validation/`, the held-out cubes (see non_ml.holdout.HoldOut)
+- `state.json`, the epoch to resume at, the seed the batches are derived
+    from, the validation history, whether early stopping ended the run and
+    the checkpoint the state belongs to
+
+`state.json` is replaced after the checkpoint it names is written, so a run
+killed at any point resumes from a consistent pair.
+"""
+
+STATE = 'state.json'
+VALIDATION = 'validation'
+# the validation score is the recall of the held-out cards in the top k
+VALIDATION_K = 10
+
+
+def load_state(directory):
+    """
+    return: the state of the last checkpoint in `directory`, None when there
+        is none
+    """
+    path = os.path.join(directory, STATE)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+class TrainingCheckpoints:
+    """
+    param directory: where the checkpoints of one training run live
+    param model: the model being trained
+    param optimizer: its optimizer, whose slots are checkpointed as well
+    param max_to_keep: number of `latest` checkpoints kept around
+    """
+    def __init__(self, directory, model, optimizer, max_to_keep=2):
+        self.directory = directory
+        self.checkpoint = tf.train.Checkpoint(model=model, optimizer=optimizer)
+        self.latest = tf.train.CheckpointManager(
+            self.checkpoint, os.path.join(directory, 'latest'), max_to_keep)
+        self.best = tf.train.CheckpointManager(
+            self.checkpoint, os.path.join(directory, 'best'), 1)
+
+    def restore(self, state):
+        """
+        Restores the model and optimizer to the checkpoint of `state`.
+        Variables the model hasn't built yet are restored when they are.
+        """
+        self.checkpoint.restore(state['checkpoint'])
+
+    def restore_best(self):
+        """
+        return: whether there was a best checkpoint to restore
+        """
+        if self.best.latest_checkpoint is None:
+            return False
+        self.checkpoint.restore(self.best.latest_checkpoint)
+        return True
+
+    def save(self, state, best=False):
+        """
+        Checkpoints the model and optimizer, then records `state` with it.
+        """
+        number = state['epoch']
+        state['checkpoint'] = self.latest.save(checkpoint_number=number)
+        if best:
+            self.best.save(checkpoint_number=number)
+        path = os.path.join(self.directory, STATE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(state, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+
+def validation_recall(model, hold_out, k=VALIDATION_K, batch_size=256):
+    """
+    return: the mean recall@k of the held-out cards of `hold_out`, ranking
+        every card not shown by the reconstruction of the shown ones
+    """
+    total = 0.0
+    for shown, held in hold_out.batches(batch_size):
+        scores = model.decoder(model.encoder(shown)).numpy()
+        total += recall_at_k(scores, held, k, exclude=shown == 1).sum()
+    return total / len(hold_out)
+
+
+class Checkpointer(Callback):
+    """
+    Checkpoints every `every` epochs and, given a HoldOut, scores it after
+    every epoch and stops training once the score hasn't improved for
+    `patience` epochs. Epochs that improve it are always checkpointed, as
+    `best` too.
+
+    param state: the dict saved with every checkpoint, either a fresh one
+        or the one training resumed from
+    """
+    def __init__(self, checkpoints, state, hold_out=None, patience=None,
+                 every=1):
+        super().__init__()
+        self.checkpoints = checkpoints
+        self.state = state
+        self.hold_out = hold_out
+        self.patience = patience
+        self.every = every
+        state.setdefault('history', [])
+        state.setdefault('best', None)
+        state.setdefault('best_epoch', None)
+
+    def on_epoch_end(self, epoch, logs=None):
+        state = self.state
+        state['epoch'] = epoch + 1
+        improved = stop = False
+        if self.hold_out is not None:
+            score = float(validation_recall(self.model, self.hold_out))
+            if logs is not None:
+                logs['val_recall'] = score
+            state['history'].append(score)
+            improved = state['best'] is None or score > state['best']
+            if improved:
+                state['best'] = score
+                state['best_epoch'] = epoch
+            elif self.patience is not None:
+                stop = epoch - state['best_epoch'] >= self.patience
+                state['stopped'] = stop
+            print('epoch {}: val recall@{} {:.4f} (best {:.4f} at epoch {})'
+                  .format(epoch + 1, VALIDATION_K, score, state['best'],
+                          state['best_epoch'] + 1))
+        if improved or stop or (epoch + 1) % self.every == 0:
+            self.checkpoints.save(state, best=improved)
+        if stop:
+            print('no improvement in {} epochs, stopping'.format(
+                self.patience))
+            self.model.stop_training = True
@@ -0,0 +1,256 @@
+# enable sibling imports
+if __name__ == "__main__":
+    from sys import path
+    from os.path import dirname as dir
+    path.append(dir(path[0]))
+
+import argparse
+import datetime
+import json
+import os
+import os.path
+import time
+
+import numpy as np
+
+from ml.runtime import load_recommender, model_file
+from non_ml import cooccurrence, evaluation
+from non_ml.dataset import load_dataset
+from non_ml.holdout import HOLD_OUT, HoldOut
+from non_ml.sparse_adjacency import SparseAdjacency
+from non_ml.utils import git_commit
+from non_ml.vocabulary import load_vocabulary
+
+"""
+Scores the models under ml_files/ and the adjacency baselines on held-out
+cubes of the corpus (see non_ml/evaluation.py for the metrics):
+
+    python src/ml/evaluate.py [models ...] [--precision float32 int8]
+
+evaluates every model directory under ml_files/ by default, each at every
+precision quantize.py has written weights for, next to simple_recs and
+simple_cuts over the adjacency matrix of the cubes that aren't held out,
+in full and keeping the `--topk` strongest links of each card as
+sparse_adjacency.py does. The held-out cubes are drawn from a fixed seed
+so runs are comparable, and the results are written as JSON to
+output/evaluation/.
+
+When a `train.py --validation` run of one of the models saved its held-out
+cubes under output/checkpoints/<name>/validation, those are scored on by
+default, pass `--hold-out` to pick them explicitly. Every result records
+whether its recommender has seen the held-out cubes as `"leaked"`: models
+have unless the hold-out is the validation split of their own training
+run, the baselines never have.
+"""
+
+ML_FILES = '././ml_files'
+CHECKPOINTS = '././output/checkpoints'
+DEFAULT_ID_MAP = 'recommender_id_map.json'
+ID_MAP = 'id_map.json'
+RESULTS = '././output/evaluation'
+
+
+def model_dirs(root=ML_FILES):
+    return sorted(
+        os.path.join(root, name) for name in os.listdir(root)
+        if os.path.isdir(os.path.join(root, name)) and
+        model_file(os.path.join(root, name)) is not None
+    )
+
+
+def model_id_map(path):
+    id_map = os.path.join(path, ID_MAP)
+    if not os.path.isfile(id_map):
+        id_map = os.path.join(os.path.dirname(path), DEFAULT_ID_MAP)
+    return id_map
+
+
+def validation_dir(path, root=CHECKPOINTS):
+    """
+    return: where a `train.py --validation` run of the model in `path`
+        saves its held-out cubes
+    """
+    name = os.path.basename(os.path.normpath(path))
+    return os.path.join(root, name, 'validation')
+
+
+def default_hold_out(paths, dataset_key, root=CHECKPOINTS):
+    """
+    return: the validation directory a `train.py --validation` run of the
+        first of the models in `paths` saved over this dataset, None when
+        none of them has one
+    """
+    for path in paths:
+        validation = validation_dir(path, root)
+        state = os.path.join(os.path.dirname(validation), 'state.json')
+        if not (os.path.isfile(state) and os.path.isdir(validation)):
+            continue
+        with open(state) as f:
+            if json.load(f).get('dataset') == dataset_key:
+                return validation
+    return None
+
+
+def trained_without(path, hold_out):
+    """
+    return: whether the model in `path` was trained with the HoldOut saved
+        in directory `hold_out` left out
+    """
+    validation = validation_dir(path)
+    return hold_out is not None and os.path.isdir(validation) and \
+        os.path.samefile(validation, hold_out)
+
+
+def candidates(args, train):
+    """
+    param train: CubeCorpus of the cubes that aren't held out, the
+        baselines are built from these alone
+    return: iterator of (name, kind, loader, id map, leaked) for every
+        recommender to evaluate. The loaders return the scorer, the id map
+        is the {index: name} file of its vocabulary, None for the dataset's
+    """
+    for path in args.models or model_dirs():
+        leaked = not trained_without(path, args.hold_out)
+        for precision in args.precision:
+            if precision != 'float32' and \
+                    model_file(path, precision) == model_file(path):
+                continue
+            name = os.path.basename(os.path.normpath(path))
+            if precision != 'float32':
+                name += ':' + precision
+            yield (
+                name,
+                'model',
+                lambda path=path, precision=precision:
+                    evaluation.ModelScorer(load_recommender(path, precision)),
+                model_id_map(path),
+                leaked,
+            )
+    adj_mtx = []
+
+    def adjacency():
+        # built once, for both baselines
+        if not adj_mtx:
+            adj_mtx.append(cooccurrence.adjacency_matrix(
+                train.to_csr(), dtype=np.float32, verbose=False))
+        return adj_mtx[0]
+
+    yield (
+        'simple_recs/simple_cuts',
+        'adjacency',
+        lambda: evaluation.AdjacencyScorer(adjacency()),
+        None,
+        False,
+    )
+    if args.topk:
+        yield (
+            'simple_recs/simple_cuts:top{}'.format(args.topk),
+            'adjacency',
+            lambda: evaluation.AdjacencyScorer(SparseAdjacency.from_dense(
+                adjacency(), k=args.topk, dtype=np.float16)),
+            None,
+            False,
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('models', nargs='*',
+                        help='model directories, all of ml_files/ by default')
+    parser.add_argument('--precision', nargs='+', default=['float32'],
+                        help='also score the quantized weights, when written')
+    parser.add_argument('--cubes', default='././data/cube/')
+    parser.add_argument('--map', default='././data/maps/nameToId.json')
+    parser.add_argument('--topk', type=int, default=256,
+                        help='links per card of the sparse baseline, 0 to '
+                             'leave it out')
+    parser.add_argument('--hold-out',
+                        help='directory of a saved HoldOut to score on')
+    parser.add_argument('--fraction', type=float, default=0.05,
+                        help='fraction of the cubes held out')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--k', type=int, nargs='+',
+                        default=list(evaluation.KS))
+    parser.add_argument('--batch-size', type=int,
+                        default=evaluation.BATCH_SIZE)
+    parser.add_argument('--out', help='results file, a new one in '
+                                      'output/evaluation/ by default')
+    args = parser.parse_args()
+    if min(args.k) < 1:
+        parser.error('--k needs values of at least 1')
+
+    print('Loading Cube Data . . . \n')
+    dataset = load_dataset(args.map, args.cubes)
+    corpus = dataset.corpus
+    names = dataset.vocabulary.names
+    rng = np.random.RandomState(args.seed)
+    if args.hold_out is None:
+        args.hold_out = default_hold_out(args.models or model_dirs(),
+                                         dataset.key)
+    if args.hold_out is None:
+        print('warning: no validation hold-out of train.py for these models, '
+              'scoring on cubes they were trained on\n')
+        _, hold_out = HoldOut.from_corpus(corpus, args.fraction, rng)
+    else:
+        print('Using the Hold-Out in {} . . . \n'.format(args.hold_out))
+        hold_out = HoldOut.load(args.hold_out)
+
+    # intruders are drawn by how many of the other cubes play each card
+    train = corpus.take(np.setdiff1d(np.arange(len(corpus)), hold_out.cubes))
+    popularity = np.bincount(train.indices, minlength=corpus.num_cards)
+    intruders = evaluation.draw_intruders(
+        corpus.take(hold_out.cubes), popularity, hold_out.held.sizes, rng)
+    print('Holding Out {} Cubes . . . \n'.format(len(hold_out)))
+
+    results = dict()
+    for name, kind, load, id_map, leaked in candidates(args, train):
+        print('Evaluating {} . . . '.format(name))
+        started = time.perf_counter()
+        scorer = load()
+        load_seconds = time.perf_counter() - started
+        mapping, num_cards = None, len(names)
+        if id_map is not None:
+            vocabulary = load_vocabulary(id_map)
+            mapping = evaluation.card_mapping(names, vocabulary)
+            num_cards = len(vocabulary)
+            if num_cards == len(names) and \
+                    np.array_equal(mapping, np.arange(num_cards)):
+                mapping = None
+        if kind == 'adjacency' and not scorer.check(evaluation.remap(
+                hold_out.shown.take(np.arange(min(8, len(hold_out)))),
+                mapping, num_cards)):
+            print('warning: batched scores differ from simple_recs/'
+                  'simple_cuts')
+        metrics = evaluation.evaluate(scorer, hold_out, intruders, args.k,
+                                      mapping, num_cards, args.batch_size)
+        metrics['kind'] = kind
+        metrics['leaked'] = leaked
+        metrics['load_seconds'] = load_seconds
+        results[name] = metrics
+        print('  ' + ', '.join(
+            '{}: {:.4f}'.format(k, v) for k, v in metrics.items()
+            if isinstance(v, float)) + '\n')
+
+    report = {
+        'created': datetime.datetime.utcnow().isoformat() + 'Z',
+        'commit': git_commit(),
+        'dataset': dataset.key,
+        'hold_out': {
+            'path': args.hold_out,
+            'cubes': len(hold_out),
+            'fraction': None if args.hold_out else args.fraction,
+            'card_fraction': None if args.hold_out else HOLD_OUT,
+            'seed': args.seed,
+        },
+        'ks': args.k,
+        'batch_size': args.batch_size,
+        'results': results,
+    }
+    out = args.out or os.path.join(RESULTS, '{}.json'.format(
+        datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')))
+    if os.path.dirname(out):
+        os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out + '.tmp', 'w') as f:
+        json.dump(report, f, indent=2)
+    os.replace(out + '.tmp', out)
+    print('Wrote', out)
@@ -0,0 +1,87 @@
+# enable sibling imports
+if __name__ == "__main__":
+    from sys import path
+    from os.path import dirname as dir
+    path.append(dir(path[0]))
+
+import os.path
+import sys
+
+import numpy as np
+
+from ml.runtime import (
+    DECODER_LAYERS,
+    ENCODER_LAYERS,
+    WEIGHTS_FILE,
+    NumpyRecommender,
+    save_weights,
+    weight_key,
+)
+
+"""
+Exports the encoder and main decoder weights of a trained CC_Recommender
+for the TensorFlow free runtime in `runtime.py`:
+
+    python src/ml/export.py ml_files/recommender
+
+writes `ml_files/recommender/weights/` and checks that both runtimes
+produce the same scores.
+"""
+
+
+def get_weights(model):
+    """
+    return: {weight_key: array} for the layers used when serving
+    """
+    weights = dict()
+    for part, layers in (("encoder", ENCODER_LAYERS),
+                         ("decoder", DECODER_LAYERS)):
+        sub_model = getattr(model, part)
+        for name, _ in layers:
+            kernel, bias = getattr(sub_model, name).get_weights()
+            weights[weight_key(part, name, "kernel")] = kernel
+            weights[weight_key(part, name, "bias")] = bias
+    return weights
+
+
+def export_weights(model, model_dir):
+    """
+    param model: a trained (or loaded) CC_Recommender
+    param model_dir: model directory to write the weights into
+    return: path of the weights directory
+    """
+    dest = os.path.join(model_dir, WEIGHTS_FILE)
+    save_weights(get_weights(model), dest)
+    return dest
+
+
+def max_difference(model, recommender, num_cubes=32, cube_size=360,
+                   seed=0):
+    """
+    return: largest absolute difference between the scores of the keras
+        model and the NumPy runtime on random cubes
+    """
+    rng = np.random.RandomState(seed)
+    cube_size = min(cube_size, recommender.num_cards)
+    cubes = np.zeros((num_cubes, recommender.num_cards), dtype=np.float32)
+    for cube in cubes:
+        cube[rng.choice(recommender.num_cards, cube_size, replace=False)] = 1
+    expected = model.decoder(model.encoder(cubes)).numpy()
+    return np.abs(expected - recommender.recommend(cubes)).max()
+
+
+if __name__ == "__main__":
+    from tensorflow.keras.models import load_model
+
+    args = sys.argv[1:]
+    src = args[0]
+    dest = args[1] if len(args) > 1 else src
+
+    print('Loading Model . . . \n')
+    model = load_model(src)
+
+    print('Exporting Weights . . . \n')
+    dest = export_weights(model, dest)
+
+    diff = max_difference(model, NumpyRecommender.load(dest))
+    print('Wrote', dest, '- max score difference:', diff)
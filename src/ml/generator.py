@@ -1,4 +1,8 @@
+import threading
+
+import tensorflow as tf
 from tensorflow.keras.utils import Sequence
+from noise import NegativeSampler, corrupt_batch
 import numpy as np
 
 class DataGenerator(Sequence):
@@ -12,7 +16,17 @@ class DataGenerator(Sequence):
         to_fit=True,
         noise=0.2,
         noise_std=0.1,
+        seed=None,
+        index_regularization=False,
     ):
+        # drawn from the global numpy generator unless given, so
+        # reset_random_seeds in train.py still applies. Every batch is
+        # derived from this seed alone, see `batch`
+        self.seed = np.random.randint(2 ** 31) if seed is None else seed
+        # the epoch the batches served as a Sequence belong to
+        self.epoch = 0
+        self._epoch_indices = dict()
+        self._epoch_lock = threading.Lock()
         self.noise_std = noise_std
         self.batch_size = batch_size
         self.shuffle = shuffle
@@ -20,14 +34,20 @@ class DataGenerator(Sequence):
         self.noise = noise
         #initialize inputs and outputs
         self.y_reg = adj_mtx
-        self.x_reg = np.zeros_like(adj_mtx)
-        np.fill_diagonal(self.x_reg,1)
+        # the regularization inputs are rows of the identity matrix, or just
+        # the card indices for models that gather them (see
+        # Encoder.call_indices), which spares the N x N identity
+        self.index_regularization = index_regularization
+        if index_regularization:
+            self.x_reg = None
+        else:
+            self.x_reg = np.zeros_like(adj_mtx)
+            np.fill_diagonal(self.x_reg,1)
+        # a CubeCorpus, only the cubes of each batch are densified
         self.x_main = cubes
         #initialize other needed inputs
-        self.N_cubes = self.x_main.shape[0]
-        self.N_cards = self.x_main.shape[1]
-        self.reset_indices()
-        self.neg_sampler = adj_mtx.sum(0)/adj_mtx.sum()
+        self.N_cubes, self.N_cards = self.x_main.shape
+        self.neg_sampler = NegativeSampler(adj_mtx.sum(0, dtype=np.float64))
 
     def __len__(self):
         """
@@ -37,67 +57,285 @@ class DataGenerator(Sequence):
 
     def __getitem__(self, batch_number):
         """
-        Generates a data mini-batch
-        param batch_number: which batch to generate  
+        Generates a data mini-batch of the current epoch, see `batch`
+        param batch_number: which batch to generate
         return: X and y when fitting. X only when predicting
         """
-        main_indices = self.indices[
+        x_main, x_reg, y_main, y_reg = self.batch(self.epoch, batch_number)
+
+        if self.to_fit:
+            return [x_main, x_reg], [y_main, y_reg]
+        else:
+            return [x_main, x_reg]
+
+    def on_epoch_end(self):
+        """
+        Moves on to the order and batches of the next epoch
+        """
+        self.epoch += 1
+
+    def resume(self, epoch):
+        """
+        Prepares the generator for a run resumed at `epoch`. Every batch is
+        a function of (seed, epoch, batch_number), so the resumed run gets
+        the same batches an uninterrupted one would have.
+        """
+        self.epoch = epoch
+
+    def epoch_indices(self, epoch):
+        """
+        return: the order of the cubes in `epoch`, a function of the seed
+        """
+        with self._epoch_lock:
+            indices = self._epoch_indices.get(epoch)
+            if indices is None:
+                indices = np.arange(self.N_cubes)
+                if self.shuffle == True:
+                    np.random.RandomState([self.seed, epoch]).shuffle(indices)
+                # batches of at most a couple of epochs are in flight
+                self._epoch_indices = {
+                    e: i for e, i in self._epoch_indices.items()
+                    if e >= epoch - 1
+                }
+                self._epoch_indices[epoch] = indices
+        return indices
+
+    def batch(self, epoch, batch_number):
+        """
+        Generates a mini-batch from its own generator seeded with (seed,
+        epoch, batch_number), so batches can be built concurrently and in
+        any order and still come out the same on every run.
+
+        return: x_main, x_reg, y_main, y_reg as float32 arrays, x_reg as
+            int32 card indices with index_regularization
+        """
+        main_indices = self.epoch_indices(epoch)[
             batch_number * self.batch_size:(batch_number + 1) * self.batch_size
         ]
-        reg_indices = np.random.choice(
-            np.arange(self.N_cards),
-            len(main_indices),
-            p=self.neg_sampler,
-        )
-
-        X,y = self.generate_data(
+        rng = np.random.RandomState([self.seed, epoch, batch_number])
+        reg_indices = self.neg_sampler.sample(len(main_indices), rng)
+        (x_main, x_reg), (y_main, y_reg) = self.generate_data(
             main_indices,
             reg_indices,
+            rng=rng,
+        )
+        x_reg_dtype = np.int32 if self.index_regularization else np.float32
+        return (
+            x_main,
+            np.asarray(x_reg, dtype=x_reg_dtype),
+            y_main,
+            np.asarray(y_reg, dtype=np.float32),
         )
 
-        if self.to_fit:
-            return [X[0],X[1]], [y[0],y[1]]
-        else:
-            return [X[0],X[1]]
+    def as_dataset(self, epochs, initial_epoch=0,
+                   num_parallel_calls=tf.data.experimental.AUTOTUNE,
+                   prefetch=tf.data.experimental.AUTOTUNE):
+        """
+        Batches as a tf.data pipeline that builds them with graph ops, see
+        `graph_batch`, so they are synthesized in parallel without taking
+        the GIL and prefetched while the model trains on earlier ones. The
+        corpus and the sampling weights are copied into tensors once, the
+        regularization target stays memory mapped and only its rows are
+        copied out, the one step that holds the GIL. Fit it with
+        steps_per_epoch=len(self).
 
-    def reset_indices(self):
-        self.indices = np.arange(self.N_cubes)
-        if self.shuffle == True:
-            np.random.shuffle(self.indices)
+        The batches are drawn the way `batch` draws them, from TensorFlow's
+        stateless generators seeded with (seed, epoch, batch_number), so
+        they are the same on every run and on resuming, but not the ones
+        the Sequence serves.
 
-    def on_epoch_end(self):
+        return: a tf.data.Dataset of ((x_main, x_reg), (y_main, y_reg)) for
+            the batches of epochs initial_epoch through epochs - 1
+        """
+        steps = len(self)
+        batch = self.graph_batch()
+
+        def epoch_batches(epoch):
+            cubes = tf.reshape(
+                self.graph_epoch_indices(epoch)[:steps * self.batch_size],
+                (steps, self.batch_size),
+            )
+            return tf.data.Dataset.from_tensor_slices((
+                tf.fill((steps,), epoch),
+                tf.range(steps, dtype=tf.int64),
+                cubes,
+            ))
+
+        def to_tensors(epoch, batch_number, cubes):
+            x_main, x_reg, y_main, y_reg = batch(epoch, batch_number, cubes)
+            return (x_main, x_reg), (y_main, y_reg)
+
+        options = tf.data.Options()
+        options.experimental_deterministic = True
+        return tf.data.Dataset.range(initial_epoch, epochs) \
+            .flat_map(epoch_batches) \
+            .map(to_tensors, num_parallel_calls=num_parallel_calls) \
+            .prefetch(prefetch) \
+            .with_options(options)
+
+    def graph_seed(self, stream, step, attempt=0):
         """
-        Update indices after each epoch
+        return: the seed of a stateless random op, distinct for each of the
+            (at most 8) streams of draws, each step and each of the (at
+            most 1024) attempts of a rejection loop, for the generator's
+            seed
         """
-        self.reset_indices()
+        return tf.stack([
+            tf.constant(self.seed * 8 + stream, dtype=tf.int64),
+            tf.cast(step, tf.int64) * 1024 + tf.cast(attempt, tf.int64),
+        ])
 
-    def generate_data(self,main_indices,reg_indices):
-        cubes = self.x_main[main_indices]
-        x_regularization = self.x_reg[reg_indices]
-        y_regularization = self.y_reg[reg_indices]
+    def graph_epoch_indices(self, epoch):
+        """
+        return: the order of the cubes in `epoch` as an int64 tensor
+        """
+        if not self.shuffle:
+            return tf.range(self.N_cubes, dtype=tf.int64)
+        keys = tf.random.stateless_uniform((self.N_cubes,),
+                                           self.graph_seed(0, epoch))
+        return tf.cast(tf.argsort(keys), tf.int64)
+
+    def graph_batch(self):
+        """
+        return: a graph function of (epoch, batch_number, cube indices) to
+            x_main, x_reg, y_main, y_reg, which corrupts the cubes as
+            noise.corrupt_batch does and draws the regularization rows from
+            the negative sampler
+        """
+        num_cards = self.N_cards
+        indptr = tf.constant(self.x_main.indptr, dtype=tf.int64)
+        indices = tf.constant(self.x_main.indices, dtype=tf.int64)
+        p = tf.constant(self.neg_sampler.p, dtype=tf.float64)
+        cdf = tf.constant(self.neg_sampler.cdf, dtype=tf.float64)
+        steps = len(self)
+
+        def regularization_rows(reg_indices):
+            return np.asarray(self.y_reg[reg_indices], dtype=np.float32)
+
+        def sample(shape, seed):
+            # inverts the sampler's distribution, as NegativeSampler.sample
+            u = tf.random.stateless_uniform((tf.reduce_prod(shape),), seed,
+                                            dtype=tf.float64)
+            return tf.reshape(
+                tf.searchsorted(cdf, u, side='right', out_type=tf.int64),
+                shape)
+
+        def sample_excluding(cubes, rows, step, draws=4):
+            # as NegativeSampler.sample_excluding, `draws` cards at a time
+            # for each entry, keeping the first outside its cube's row
+            valid = tf.reduce_sum(tf.cast(cubes > 0, tf.float64) * p,
+                                  axis=1) < 1 - 1e-9
+            flat = tf.reshape(cubes, (-1,))
+
+            def attempt(i, cards, todo):
+                drawn = sample((tf.size(rows), draws),
+                               self.graph_seed(4, step, i))
+                allowed = tf.gather(flat, rows[:, None] * num_cards +
+                                    drawn) == 0
+                first = tf.gather(drawn, tf.argmax(tf.cast(allowed, tf.int32),
+                                                   axis=1),
+                                  batch_dims=1)
+                cards = tf.where(todo, first, cards)
+                return i + 1, cards, todo & ~tf.reduce_any(allowed, axis=1)
+
+            _, cards, _ = tf.while_loop(
+                lambda i, cards, todo: tf.reduce_any(todo),
+                attempt,
+                (0, tf.zeros_like(rows), tf.gather(valid, rows)),
+            )
+            return cards, tf.gather(valid, rows)
+
+        def uniform_positions(starts, sizes, counts, seed):
+            # counts[i] positions of starts[i]:starts[i] + sizes[i], drawn
+            # uniformly with replacement, rows one after the other
+            rows = tf.ragged.range(counts).value_rowids()
+            offsets = tf.random.stateless_uniform(
+                tf.shape(rows), seed, dtype=tf.float64) * \
+                tf.cast(tf.gather(sizes, rows), tf.float64)
+            return rows, tf.gather(starts, rows) + tf.cast(offsets, tf.int64)
+
+        def batch(epoch, batch_number, cube_indices):
+            step = epoch * steps + batch_number
+            num_cubes = tf.shape(cube_indices, out_type=tf.int64)[0]
+            starts = tf.gather(indptr, cube_indices)
+            sizes = tf.gather(indptr, cube_indices + 1) - starts
+
+            cube_positions = tf.ragged.range(starts, starts + sizes)
+            cubes = tf.scatter_nd(
+                tf.stack([cube_positions.value_rowids(),
+                          tf.gather(indices, cube_positions.flat_values)], 1),
+                tf.ones_like(cube_positions.flat_values, dtype=tf.float32),
+                (num_cubes, num_cards),
+            )
 
-        cut_mask = np.zeros((self.batch_size,self.N_cards))
-        add_mask = np.zeros((self.batch_size,self.N_cards))
-        y_cut_mask = np.zeros((self.batch_size,self.N_cards))
-        for i,cube in enumerate(cubes):
-            includes = np.where(cube == 1)[0]
-            excludes = np.where(cube == 0)[0]
-            size = len(includes)
-            noise = np.clip(
-                np.random.normal(self.noise,self.noise_std),
-                a_min = 0.05,
-                a_max = 0.8,
+            noise = tf.clip_by_value(
+                tf.random.stateless_normal((num_cubes,),
+                                           self.graph_seed(1, step),
+                                           dtype=tf.float64) *
+                self.noise_std + self.noise,
+                0.05, 0.8,
             )
-            flip_amount = int(size * noise)
-            flip_include = np.random.choice(includes, flip_amount)
-            neg_sampler = self.neg_sampler[excludes]/self.neg_sampler[excludes].sum()
-            flip_exclude = np.random.choice(excludes, flip_amount, p=neg_sampler)
-            y_flip_include = np.random.choice(flip_include, flip_amount//4)
-            cut_mask[i,flip_include] = -1
-            y_cut_mask[i,y_flip_include] = -1
-            add_mask[i,flip_exclude] = 1
-
-        x_cubes = cubes + cut_mask + add_mask
-        y_cubes = cubes + y_cut_mask
+            flips = tf.cast(tf.cast(sizes, tf.float64) * noise, tf.int64)
+
+            # cards cut from the input
+            cut_rows, cut_positions = uniform_positions(
+                starts, sizes, flips, self.graph_seed(2, step))
+            cut_cards = tf.gather(indices, cut_positions)
+
+            # a quarter of them are cut from the target too
+            cut_starts = tf.cumsum(flips, exclusive=True)
+            y_rows, y_positions = uniform_positions(
+                cut_starts, flips, flips // 4, self.graph_seed(3, step))
+            y_cards = tf.gather(cut_cards, y_positions)
+
+            # cards added to the input, from outside the cube
+            add_rows = tf.ragged.range(flips).value_rowids()
+            add_cards, valid = sample_excluding(cubes, add_rows, step)
+            add_rows = tf.boolean_mask(add_rows, valid)
+            add_cards = tf.boolean_mask(add_cards, valid)
+
+            x_main = tf.tensor_scatter_nd_update(
+                cubes,
+                tf.stack([cut_rows, cut_cards], 1),
+                tf.zeros_like(cut_cards, dtype=tf.float32),
+            )
+            x_main = tf.tensor_scatter_nd_update(
+                x_main,
+                tf.stack([add_rows, add_cards], 1),
+                tf.ones_like(add_cards, dtype=tf.float32),
+            )
+            y_main = tf.tensor_scatter_nd_update(
+                cubes,
+                tf.stack([y_rows, y_cards], 1),
+                tf.zeros_like(y_cards, dtype=tf.float32),
+            )
+
+            reg_indices = sample((num_cubes,), self.graph_seed(5, step))
+            if self.index_regularization:
+                x_reg = tf.cast(reg_indices, tf.int32)
+            else:
+                x_reg = tf.one_hot(reg_indices, num_cards, dtype=tf.float32)
+            y_reg = tf.numpy_function(regularization_rows, [reg_indices],
+                                      tf.float32)
+            y_reg.set_shape((None, num_cards))
+            return x_main, x_reg, y_main, y_reg
+
+        return batch
+
+    def generate_data(self,main_indices,reg_indices,rng=None):
+        if self.index_regularization:
+            x_regularization = reg_indices
+        else:
+            x_regularization = self.x_reg[reg_indices]
+        y_regularization = self.y_reg[reg_indices]
+
+        x_cubes, y_cubes = corrupt_batch(
+            self.x_main,
+            main_indices,
+            self.neg_sampler,
+            noise=self.noise,
+            noise_std=self.noise_std,
+            rng=np.random if rng is None else rng,
+        )
 
         return [(x_cubes,x_regularization),(y_cubes,y_regularization)]
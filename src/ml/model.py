@@ -46,6 +46,19 @@ class Encoder(Model):
         encoded = self.encoded_2(encoded)
         encoded = self.encoded_3(encoded)
         return self.bottleneck(encoded)
+
+    def call_indices(self, cards):
+        """
+        Encodes single cards given by index. A one-hot row times the first
+        kernel is just that card's kernel row, so gather it instead of
+        building the one-hot rows.
+        """
+        encoded_1 = self.encoded_1
+        encoded = tf.gather(encoded_1.kernel, cards) + encoded_1.bias
+        encoded = encoded_1.activation(encoded)
+        encoded = self.encoded_2(encoded)
+        encoded = self.encoded_3(encoded)
+        return self.bottleneck(encoded)
     
 class Decoder(Model):
     """
@@ -69,6 +82,18 @@ class Decoder(Model):
         decoded = self.decoded_3(decoded)
         return self.reconstruct(decoded)
 
+    def call_candidates(self, x, candidates):
+        """
+        The logits (before the output activation) of only the `candidates`
+        outputs, for training objectives that sample the vocabulary.
+        """
+        decoded = self.decoded_1(x)
+        decoded = self.decoded_2(decoded)
+        decoded = self.decoded_3(decoded)
+        kernel = tf.gather(self.reconstruct.kernel, candidates, axis=1)
+        bias = tf.gather(self.reconstruct.bias, candidates)
+        return tf.matmul(decoded, kernel) + bias
+
     # def call_for_reg(self, x):
     #     x = self.bottleneck_drop(x)
     #     decoded = self.decoded_1(x)
@@ -101,7 +126,8 @@ class CC_Recommender(Model):
         """
         input contains two things:
             input[0] = the binary vectors representing the collections
-            input[1] = a diagonal matrix of size (self.N X self.N)
+            input[1] = a diagonal matrix of size (self.N X self.N), or
+                rows of it, or just the indices of the cards (the 1s)
 
         We run the same encoder for each type of input, but with different
         decoders. This is because the goal is to make sure that the compression
@@ -119,7 +145,10 @@ class CC_Recommender(Model):
         encoded = self.encoder(x)
         #latent_for_reconstruct = self.latent_noise(encoded)
         reconstruction = self.decoder(encoded)
-        encode_for_reg = self.encoder(identity)
+        if tf.as_dtype(identity.dtype).is_integer:
+            encode_for_reg = self.encoder.call_indices(identity)
+        else:
+            encode_for_reg = self.encoder(identity)
         #latent_for_reg = self.latent_noise(encode_for_reg)
         decoded_for_reg = self.decoder_for_reg(encode_for_reg)
         return reconstruction, decoded_for_reg
@@ -0,0 +1,140 @@
+# enable sibling imports
+if __name__ == "__main__":
+    from sys import path
+    from os.path import dirname as dir
+    path.append(dir(path[0]))
+
+import os.path
+import sys
+
+import numpy as np
+
+from ml.runtime import (
+    NumpyRecommender,
+    load_weights,
+    model_file,
+    save_weights,
+    to_csr,
+    weights_file,
+)
+from non_ml import ranking, utils
+from non_ml.vocabulary import load_vocabulary
+
+"""
+Quantizes the exported weights of a model for serving:
+
+    python src/ml/quantize.py ml_files/recommender int8 [cube_folder map_file]
+
+writes `ml_files/recommender/weights_int8/` (or `weights_float16/`)
+and reports how much the top-k recommendations agree with the float32
+weights, on the cubes in `cube_folder` when given, else on random cubes.
+Serve it with RECOMMENDER_PRECISION=int8.
+"""
+
+KERNEL = "/kernel"
+SCALE = "/scale"
+
+
+def quantize_weights(weights, precision):
+    """
+    param weights: {weight_key: array} as written by export.py
+    param precision: "float16", or "int8" for symmetric per output column
+        quantization with a float32 scale stored next to each kernel
+    return: the quantized weights, biases are left in float32
+    """
+    quantized = dict()
+    for key, value in weights.items():
+        if not key.endswith(KERNEL):
+            quantized[key] = value
+        elif precision == "float16":
+            quantized[key] = value.astype(np.float16)
+        elif precision == "int8":
+            scale = np.abs(value).max(0) / 127
+            scale[scale == 0] = 1
+            quantized[key] = np.clip(np.round(value / scale), -127, 127) \
+                .astype(np.int8)
+            quantized[key[:-len(KERNEL)] + SCALE] = scale.astype(np.float32)
+        else:
+            raise ValueError("Unknown precision: " + str(precision))
+    return quantized
+
+
+def size_mb(weights):
+    return sum(value.nbytes for value in weights.values()) / 2 ** 20
+
+
+def ranking_agreement(reference, candidate, index_lists, ks=(10, 50, 100)):
+    """
+    return: {k: mean fraction of the reference's top k additions that the
+        candidate also ranks in its top k}, and the largest absolute
+        difference in scores
+    """
+    indptr, indices = to_csr(index_lists)
+    expected = reference.recommend_indices(indptr, indices)
+    actual = candidate.recommend_indices(indptr, indices)
+    exclude = ranking.index_mask(index_lists, reference.num_cards)
+    agreement = dict()
+    for k in ks:
+        expected_top = ranking.top_k(expected, k, exclude=exclude)
+        actual_top = ranking.top_k(actual, k, exclude=exclude)
+        agreement[k] = float(np.mean([
+            len(np.intersect1d(e, a)) / max(len(e), 1)
+            for e, a in zip(expected_top, actual_top)
+        ]))
+    return agreement, float(np.abs(expected - actual).max())
+
+
+def random_cubes(num_cards, num_cubes=256, cube_size=360, seed=0):
+    rng = np.random.RandomState(seed)
+    cube_size = min(cube_size, num_cards)
+    return [
+        np.sort(rng.choice(num_cards, cube_size, replace=False))
+        for _ in range(num_cubes)
+    ]
+
+
+def corpus_cubes(cube_folder, map_file, vocabulary, limit=1024):
+    """
+    return: the cubes in `cube_folder` as indices into `vocabulary`
+    """
+    _, name_lookup, _, _ = utils.get_card_maps(map_file)
+    cubes = []
+    for cube in utils.iter_cubes(cube_folder):
+        names = [name_lookup.get(card['cardID']) for card in cube['cards']]
+        cubes.append(np.unique(vocabulary.resolve(
+            [name for name in names if name is not None])))
+        if len(cubes) >= limit:
+            break
+    return cubes
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    model_dir = args[0]
+    precision = args[1] if len(args) > 1 else "int8"
+
+    weights = load_weights(model_file(model_dir), mmap_mode=None)
+
+    print('Quantizing Weights . . . \n')
+    quantized = quantize_weights(weights, precision)
+    dest = os.path.join(model_dir, weights_file(precision))
+    save_weights(quantized, dest)
+    print('Wrote', dest)
+    print('Size: {:.1f}MB -> {:.1f}MB\n'.format(size_mb(weights),
+                                               size_mb(quantized)))
+
+    reference = NumpyRecommender(weights)
+    candidate = NumpyRecommender(quantized)
+    if len(args) > 3:
+        id_map = os.path.join(model_dir, 'id_map.json')
+        if not os.path.isfile(id_map):
+            id_map = 'ml_files/recommender_id_map.json'
+        cubes = corpus_cubes(args[2], args[3], load_vocabulary(id_map))
+    else:
+        cubes = random_cubes(reference.num_cards)
+
+    print('Comparing Rankings on', len(cubes), 'Cubes . . . \n')
+    agreement, max_diff = ranking_agreement(reference, candidate, cubes)
+    for k, value in agreement.items():
+        print('top {} agreement: {:.4f}'.format(k, value))
+    print('max score difference: {:.6f}'.format(max_diff))
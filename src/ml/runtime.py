@@ -0,0 +1,376 @@
+import os
+import os.path
+import shutil
+
+import numpy as np
+
+"""
+TensorFlow free inference for a trained CC_Recommender.
+
+Serving only needs the encoder and the main decoder, eight Dense layers in
+total, so `export.py` writes their weights to a `weights` directory inside
+the model directory (a symlink to its current version, see save_weights) and `NumpyRecommender` replays the forward pass with
+NumPy. The output matches `model.decoder(model.encoder(x))` up to float32
+rounding.
+
+Every weight is its own `.npy` file and is memory mapped read only, so all
+the workers on a node share one copy of the weights through the page cache.
+"""
+
+WEIGHTS_FILE = "weights"
+SAVED_MODEL = "saved_model.pb"
+# weights written by quantize.py, see weights_file
+PRECISIONS = ("float32", "float16", "int8")
+# rows or columns upcast at a time when multiplying by a quantized kernel
+QUANTIZED_BLOCK_SIZE = 4096
+# rows of a matrix gathered at a time by sparse_rows_sum
+GATHER_BLOCK_SIZE = 8192
+
+# (layer, activation) in forward order, mirroring Encoder/Decoder in model.py
+ENCODER_LAYERS = (
+    ("encoded_1", "relu"),
+    ("encoded_2", "relu"),
+    ("encoded_3", "relu"),
+    ("bottleneck", "relu"),
+)
+DECODER_LAYERS = (
+    ("decoded_1", "relu"),
+    ("decoded_2", "relu"),
+    ("decoded_3", "relu"),
+    ("reconstruct", "sigmoid"),
+)
+
+
+def relu(x):
+    return np.maximum(x, 0, out=x)
+
+
+def sigmoid(x):
+    # exp(-|x|) can't overflow, unlike exp(-x) for very negative x
+    e = np.exp(-np.abs(x))
+    return np.where(x >= 0, 1 / (1 + e), e / (1 + e)).astype(x.dtype)
+
+
+ACTIVATIONS = {
+    "relu": relu,
+    "sigmoid": sigmoid,
+}
+
+
+def weight_key(part, layer, kind):
+    return "{}/{}/{}".format(part, layer, kind)
+
+
+def weights_file(precision="float32"):
+    if precision == "float32":
+        return WEIGHTS_FILE
+    return "{}_{}".format(WEIGHTS_FILE, precision)
+
+
+def save_weights(weights, path):
+    """
+    Writes {weight_key: array} to directory `path`, one .npy file per array.
+
+    Every save writes a new version directory next to `path`, named
+    `<path>.v<n>`, and makes `path` a symlink to it by atomically replacing
+    the link. A version is never modified once the link points to it, so a
+    reader that resolved the link sees the layers of a single save, see
+    load_weights. The previous version is then deleted, processes that have
+    its weights mapped keep reading them until they reload.
+    """
+    parent, name = os.path.split(path)
+    previous = os.readlink(path) if os.path.islink(path) else None
+    number = int(previous.rsplit(".v", 1)[1]) + 1 if previous else 1
+    version = os.path.join(parent, "{}.v{}".format(name, number))
+    tmp_path = version + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for key, value in weights.items():
+        dest = os.path.join(tmp_path, key.replace("/", ".") + ".npy")
+        with open(dest, "wb") as f:
+            np.save(f, value)
+    # left by a save that crashed before publishing it
+    shutil.rmtree(version, ignore_errors=True)
+    os.rename(tmp_path, version)
+
+    link = path + ".link"
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(os.path.basename(version), link)
+    old_path = path + ".old"
+    if os.path.isdir(path) and not os.path.islink(path):
+        # a plain directory written before versions, moved aside once
+        shutil.rmtree(old_path, ignore_errors=True)
+        os.rename(path, old_path)
+    os.replace(link, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+    if previous is not None:
+        shutil.rmtree(os.path.join(parent, previous), ignore_errors=True)
+
+
+def load_weights(path, mmap_mode="r"):
+    """
+    The link of a directory written by save_weights is resolved once and
+    every layer is read from that version. Should a save delete the version
+    before all its files are open, the link is resolved again and the newer
+    version read instead, so the layers never mix versions.
+
+    param path: a directory written by save_weights, or an .npz file
+    param mmap_mode: how to memory map the arrays of a directory, None to
+        read them into memory
+    return: {weight_key: array}
+    """
+    if not os.path.isdir(path):
+        with np.load(path, allow_pickle=False) as data:
+            return {key: data[key] for key in data.files}
+    while True:
+        version = os.path.realpath(path)
+        try:
+            return {
+                f[:-len(".npy")].replace(".", "/"):
+                    np.load(os.path.join(version, f), mmap_mode=mmap_mode)
+                for f in os.listdir(version)
+                if f.endswith(".npy")
+            }
+        except FileNotFoundError:
+            if os.path.realpath(path) == version:
+                raise
+
+
+def dense(x, kernel, scale, bias):
+    """
+    x @ kernel + bias for float32 kernels as well as float16 and int8 ones.
+    Quantized kernels are upcast QUANTIZED_BLOCK_SIZE columns at a time, or
+    as many rows for kernels taller than they are wide (the first encoder
+    layer), so serving never holds a float32 copy of a whole kernel over
+    the vocabulary. int8 kernels are rescaled per output column after the
+    product.
+    """
+    if kernel.dtype == x.dtype:
+        out = x @ kernel
+    elif kernel.shape[0] > kernel.shape[1]:
+        out = np.zeros((x.shape[0], kernel.shape[1]), dtype=x.dtype)
+        for start in range(0, kernel.shape[0], QUANTIZED_BLOCK_SIZE):
+            block = slice(start, start + QUANTIZED_BLOCK_SIZE)
+            out += x[:, block] @ kernel[block].astype(x.dtype)
+    else:
+        out = np.empty((x.shape[0], kernel.shape[1]), dtype=x.dtype)
+        for start in range(0, kernel.shape[1], QUANTIZED_BLOCK_SIZE):
+            block = slice(start, start + QUANTIZED_BLOCK_SIZE)
+            out[:, block] = x @ kernel[:, block].astype(x.dtype)
+    if scale is not None:
+        out *= scale
+    out += bias
+    return out
+
+
+def to_csr(index_lists):
+    """
+    param index_lists: one array of card indices per cube
+    return: (indptr, indices) such that cube i holds the cards
+        indices[indptr[i]:indptr[i + 1]]
+    """
+    lengths = [len(cube) for cube in index_lists]
+    indptr = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+    if indptr[-1] == 0:
+        return indptr, np.zeros(0, dtype=np.int64)
+    return indptr, np.concatenate(index_lists).astype(np.int64)
+
+
+def sparse_rows_sum(matrix, indptr, indices, dtype=None):
+    """
+    return: for every CSR row, the sum of the rows of `matrix` it selects,
+        i.e. the product of the binary CSR matrix with `matrix` without ever
+        building the dense binary rows. Summed in `dtype`, by default the
+        dtype of `matrix`. The selected rows are gathered for as many CSR
+        rows at a time as select about GATHER_BLOCK_SIZE of them.
+    """
+    dtype = matrix.dtype if dtype is None else dtype
+    num_rows = len(indptr) - 1
+    out = np.zeros((num_rows, matrix.shape[1]), dtype=dtype)
+    row = 0
+    while row < num_rows:
+        # at least one row, however many cards it selects
+        end = np.searchsorted(indptr, indptr[row] + GATHER_BLOCK_SIZE,
+                              side="right") - 1
+        end = min(max(end, row + 1), num_rows)
+        lo, hi = indptr[row], indptr[end]
+        if hi > lo:
+            starts = indptr[row:end] - lo
+            nonempty = starts < indptr[row + 1:end + 1] - lo
+            # reduceat sums each start up to the next start, empty rows
+            # select nothing so leaving them out keeps the other ranges
+            # intact
+            out[row:end][nonempty] = np.add.reduceat(
+                matrix[indices[lo:hi]].astype(dtype, copy=False),
+                starts[nonempty], axis=0)
+        row = end
+    return out
+
+
+class NumpyRecommender:
+    """
+    param weights: mapping of weight_key(part, layer, "kernel"|"bias") to
+        arrays, as written by `export.export_weights`. Kernels may also be
+        float16, or int8 with a per output column "scale" (see quantize.py);
+        they are kept that way in memory.
+    """
+    def __init__(self, weights, dtype=np.float32):
+        self.dtype = dtype
+        self.encoder_layers = self._layers(weights, "encoder", ENCODER_LAYERS)
+        self.decoder_layers = self._layers(weights, "decoder", DECODER_LAYERS)
+        self.num_cards = self.encoder_layers[0][0].shape[0]
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """
+        param path: weights directory (or .npz file) as read by load_weights
+        """
+        return cls(load_weights(path, mmap_mode))
+
+    def _layers(self, weights, part, layers):
+        built = []
+        for name, activation in layers:
+            kernel = weights[weight_key(part, name, "kernel")]
+            scale = weights.get(weight_key(part, name, "scale"))
+            if scale is not None:
+                scale = np.asarray(scale, dtype=self.dtype)
+            elif kernel.dtype != np.float16:
+                kernel = kernel.astype(self.dtype, copy=False)
+            built.append((
+                np.ascontiguousarray(kernel),
+                scale,
+                np.ascontiguousarray(weights[weight_key(part, name, "bias")],
+                                     dtype=self.dtype),
+                ACTIVATIONS[activation],
+            ))
+        return built
+
+    @staticmethod
+    def _forward(x, layers):
+        for kernel, scale, bias, activation in layers:
+            x = activation(dense(x, kernel, scale, bias))
+        return x
+
+    def encode(self, x):
+        x = np.asarray(x, dtype=self.dtype)
+        return self._forward(np.atleast_2d(x), self.encoder_layers)
+
+    def decode(self, encoded):
+        return self._forward(np.asarray(encoded, dtype=self.dtype),
+                             self.decoder_layers)
+
+    def recommend(self, x):
+        """
+        param x: (batch, num_cards) binary cube vectors
+        return: (batch, num_cards) scores as a NumPy array
+        """
+        return self.decode(self.encode(x))
+
+    def encode_indices(self, indptr, indices):
+        """
+        Encodes cubes given as CSR card indices. A binary input makes the
+        first layer a sum of the kernel rows of the cards in the cube, so it
+        costs O(cube size) per cube instead of O(num_cards).
+        """
+        kernel, scale, bias, activation = self.encoder_layers[0]
+        encoded = sparse_rows_sum(kernel, indptr, indices, dtype=self.dtype)
+        if scale is not None:
+            encoded *= scale
+        encoded = activation(encoded + bias)
+        return self._forward(encoded, self.encoder_layers[1:])
+
+    def recommend_indices(self, indptr, indices):
+        """
+        Same as `recommend` for cubes given as CSR card indices.
+        """
+        return self.decode(self.encode_indices(indptr, indices))
+
+    def embed_cards(self, cards=None):
+        """
+        return: the encoding of each card on its own (all cards by default),
+            what pushing rows of the identity matrix through the encoder gives
+        """
+        if cards is None:
+            cards = np.arange(self.num_cards)
+        cards = np.asarray(cards, dtype=np.int64)
+        return self.encode_indices(np.arange(len(cards) + 1), cards)
+
+
+class KerasRecommender:
+    """
+    Same interface as NumpyRecommender around a SavedModel, for model
+    directories that haven't been exported yet. TensorFlow is only imported
+    when one of these is created.
+    """
+    def __init__(self, path):
+        from tensorflow import keras
+        self.model = keras.models.load_model(path)
+        kernel = self.model.encoder.encoded_1.get_weights()[0]
+        self.num_cards = kernel.shape[0]
+
+    def encode(self, x):
+        return self.model.encoder(x, training=False).numpy()
+
+    def decode(self, encoded):
+        return self.model.decoder(encoded, training=False).numpy()
+
+    def recommend(self, x):
+        encoded = self.model.encoder(x, training=False)
+        return self.model.decoder(encoded, training=False).numpy()
+
+    def _densify(self, indptr, indices):
+        x = np.zeros((len(indptr) - 1, self.num_cards), dtype=np.float32)
+        rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+        x[rows, indices] = 1
+        return x
+
+    def encode_indices(self, indptr, indices):
+        return self.encode(self._densify(indptr, indices))
+
+    def recommend_indices(self, indptr, indices):
+        return self.recommend(self._densify(indptr, indices))
+
+    def embed_cards(self, cards=None, batch_size=1024):
+        if cards is None:
+            cards = np.arange(self.num_cards)
+        return np.concatenate([
+            self.encode_indices(np.arange(len(batch) + 1), batch)
+            for batch in np.array_split(cards, max(1, len(cards) // batch_size))
+        ])
+
+
+def model_file(path, precision="float32"):
+    """
+    return: the file that identifies the model in directory `path`: the
+        weights of the requested precision when present, else the float32
+        weights, else the SavedModel. None if the directory holds none.
+        Weights written as a single .npz file are still recognised.
+    """
+    names = []
+    for weights in (weights_file(precision), WEIGHTS_FILE):
+        names += [weights, weights + ".npz"]
+    for name in names + [SAVED_MODEL]:
+        if os.path.exists(os.path.join(path, name)):
+            return os.path.join(path, name)
+    return None
+
+
+def is_exported(path, precision="float32"):
+    """
+    return: whether the model in directory `path` loads without tensorflow
+    """
+    found = model_file(path, precision)
+    return found is not None and not found.endswith(SAVED_MODEL)
+
+
+def load_recommender(path, precision="float32", mmap_mode="r"):
+    """
+    Loads the model in directory `path`, without TensorFlow whenever its
+    weights have been exported. Quantized weights of the given precision
+    are used when quantize.py has written them.
+    """
+    if is_exported(path, precision):
+        return NumpyRecommender.load(model_file(path, precision), mmap_mode)
+    return KerasRecommender(path)
@@ -5,14 +5,21 @@ if __name__ == "__main__":
     path.append(dir(path[0]))
 
 from model import CC_Recommender
+from export import export_weights
 import tensorflow as tf
-from non_ml import utils
+from non_ml.dataset import load_dataset
 from generator import DataGenerator
+from training import ThroughputLogger, fit_compiled
+from checkpoints import (VALIDATION, Checkpointer, TrainingCheckpoints,
+                         load_state)
+from non_ml.holdout import HoldOut
 import numpy as np
+import argparse
 import json
 import os
 import os.path
 import random
+import shutil
 import sys
 import pdb
 
@@ -25,16 +32,110 @@ def reset_random_seeds(seed):
     random.seed(seed)
 
 
-args = sys.argv[1:]
+# python src/ml/train.py epochs batch_size name reg noise [seed]
+#     [--tf-data] [--compiled [--xla] [--num-sampled N [--max-positives N]]]
+#     [--validation FRACTION [--patience N]] [--checkpoint-every N]
+#     [--checkpoint-dir DIR] [--resume | --overwrite]
+parser = argparse.ArgumentParser()
+parser.add_argument('epochs', type=int)
+parser.add_argument('batch_size', type=int)
+parser.add_argument('name')
+parser.add_argument('reg', type=float)
+parser.add_argument('noise', type=float)
+parser.add_argument('seed', type=int, nargs='?')
+parser.add_argument(
+    '--tf-data',
+    action='store_true',
+    help='build batches in a parallel, prefetching tf.data pipeline',
+)
+parser.add_argument(
+    '--compiled',
+    action='store_true',
+    help='train with a graph compiled step that gathers the regularization '
+         'rows by card index instead of feeding an N x N identity',
+)
+parser.add_argument(
+    '--xla',
+    action='store_true',
+    help='compile the --compiled training step with XLA',
+)
+parser.add_argument(
+    '--num-sampled',
+    type=int,
+    help='with --compiled, score only the cards of each batch and this many '
+         'sampled negatives instead of the whole vocabulary',
+)
+parser.add_argument(
+    '--max-positives',
+    type=int,
+    help='with --num-sampled, score at most this many of the cards of each '
+         'batch, drawn at random, when they cover most of the vocabulary',
+)
+parser.add_argument(
+    '--validation',
+    type=float,
+    default=0.0,
+    help='hold out this fraction of the cubes and score the recall of some '
+         'of their cards after every epoch',
+)
+parser.add_argument(
+    '--patience',
+    type=int,
+    help='stop once the validation score hasn\'t improved for this many '
+         'epochs, the best epoch is the one saved',
+)
+parser.add_argument(
+    '--checkpoint-every',
+    type=int,
+    default=1,
+    help='checkpoint the model, optimizer and batch seed every N epochs',
+)
+parser.add_argument(
+    '--checkpoint-dir',
+    help='where checkpoints are kept, output/checkpoints/<name> by default',
+)
+parser.add_argument(
+    '--resume',
+    action='store_true',
+    help='continue from the last checkpoint instead of starting over',
+)
+parser.add_argument(
+    '--overwrite',
+    action='store_true',
+    help='start over, deleting the checkpoints of an earlier run',
+)
+args = parser.parse_args()
+if args.num_sampled is not None and not args.compiled:
+    parser.error('--num-sampled requires --compiled')
+if args.max_positives is not None and args.num_sampled is None:
+    parser.error('--max-positives requires --num-sampled')
+if args.patience is not None and not args.validation:
+    parser.error('--patience requires --validation')
+if args.resume and args.overwrite:
+    parser.error('--resume and --overwrite are exclusive')
+
+epochs = args.epochs
+batch_size = args.batch_size
+name = args.name
+reg = args.reg
+noise = args.noise
 
-epochs = int(args[0])
-batch_size = int(args[1])
-name = args[2]
-reg = float(args[3])
-noise = float(args[4])
+checkpoint_dir = args.checkpoint_dir or f'././output/checkpoints/{name}'
+state = None
+if args.resume:
+    state = load_state(checkpoint_dir)
+    if state is None:
+        parser.error(f'no checkpoint to resume from in {checkpoint_dir}')
+else:
+    if load_state(checkpoint_dir) is not None and not args.overwrite:
+        parser.error(f'{checkpoint_dir} holds the checkpoints of an earlier '
+                     'run, pass --resume to continue it or --overwrite to '
+                     'delete them')
+    shutil.rmtree(checkpoint_dir, ignore_errors=True)
 
-if len(args) == 6:
-    seed = int(args[5])
+# a resumed run derives its batches from the seed of the first one
+seed = args.seed if state is None else state['seed']
+if seed is not None:
     reset_random_seeds(seed)
 
 map_file = '././data/maps/nameToId.json'
@@ -42,17 +143,28 @@ folder = "././data/cube/"
 
 print('Loading Cube Data . . .\n')
 
-num_cards, name_lookup, card_to_int, int_to_card = \
-    utils.get_card_maps(map_file)
-
-num_cubes = utils.get_num_cubes(folder)
-
-cubes = utils.build_cubes(folder, num_cubes, num_cards, name_lookup,
-                          card_to_int)
+# parsed once, later runs on the same data load the cached artifacts
+dataset = load_dataset(map_file, folder)
+corpus = dataset.corpus
+num_cards = len(dataset.vocabulary)
+int_to_card = dataset.vocabulary.int_to_card
+if state is not None and state['dataset'] != dataset.key:
+    parser.error(f'the checkpoint in {checkpoint_dir} is of another dataset')
 
-print('Loading Adjacency Matrix . . .\n')
-
-adj_mtx = np.load('././output/full_adj_mtx.npy')
+# the held-out cubes are saved with the checkpoints, a resumed run scores
+# the same ones
+validation_dir = os.path.join(checkpoint_dir, VALIDATION)
+hold_out = None
+train_cubes = None
+train_corpus = corpus
+if state is not None and os.path.isdir(validation_dir):
+    hold_out = HoldOut.load(validation_dir)
+    train_cubes = np.setdiff1d(np.arange(len(corpus)), hold_out.cubes)
+    train_corpus = corpus.take(train_cubes)
+elif args.validation:
+    train_cubes, hold_out = HoldOut.from_corpus(corpus, args.validation)
+    hold_out.save(validation_dir)
+    train_corpus = corpus.take(train_cubes)
 
 # print('Converting Graph Weights to Probabilities . . . \n')
 print('Creating Graph for Regularization . . . \n')
@@ -66,9 +178,14 @@ print('Creating Graph for Regularization . . . \n')
 # y_mtx = np.nan_to_num(y_mtx,0)
 # y_mtx[np.where(y_mtx.sum(1) == 0),np.where(y_mtx.sum(1) == 0)] = 1
 
-y_mtx = adj_mtx.copy()
-np.fill_diagonal(y_mtx,1)
-y_mtx = (y_mtx/y_mtx.sum(1)[:,None])
+# the adjacency matrix with ones on the diagonal, rows normalized to sum to
+# one. Cached with the dataset and memory mapped. With a validation split
+# it's counted over the training cubes only, as are the negatives the
+# generator samples from it, so the held-out cubes never reach the model
+if train_cubes is None:
+    y_mtx = dataset.regularization_target('././output/full_adj_mtx.npy')
+else:
+    y_mtx = dataset.cubes_regularization_target(train_cubes)
 
 print('Setting Up Data for Training . . .\n')
 
@@ -89,17 +206,73 @@ autoencoder.compile(
 
 generator = DataGenerator(
     y_mtx,
-    cubes,
+    train_corpus,
     batch_size=batch_size,
     noise=noise,
+    seed=seed,
+    index_regularization=args.compiled,
+)
+
+checkpoints = TrainingCheckpoints(checkpoint_dir, autoencoder,
+                                  autoencoder.optimizer)
+if state is None:
+    state = {'seed': int(generator.seed), 'dataset': dataset.key, 'epoch': 0}
+else:
+    print(f'Resuming at epoch {state["epoch"] + 1} . . .\n')
+    checkpoints.restore(state)
+    generator.resume(state['epoch'])
+initial_epoch = state['epoch']
+checkpointer = Checkpointer(
+    checkpoints,
+    state,
+    hold_out=hold_out,
+    patience=args.patience,
+    every=args.checkpoint_every,
 )
 
 # pdb.set_trace()
 
-autoencoder.fit(
-    generator,
-    epochs=epochs,
-)
+if state.get('stopped') or initial_epoch >= epochs:
+    print('Nothing left to train . . .\n')
+elif args.compiled:
+    fit_compiled(
+        autoencoder,
+        autoencoder.optimizer,
+        generator,
+        epochs,
+        reg,
+        jit=args.xla,
+        initial_epoch=initial_epoch,
+        tf_data=args.tf_data,
+        num_sampled=args.num_sampled,
+        max_positives=args.max_positives,
+        callbacks=[checkpointer],
+    )
+elif args.tf_data:
+    autoencoder.fit(
+        generator.as_dataset(epochs, initial_epoch),
+        epochs=epochs,
+        initial_epoch=initial_epoch,
+        steps_per_epoch=len(generator),
+        callbacks=[ThroughputLogger(), checkpointer],
+    )
+else:
+    # the generator orders every epoch from the seed, keras reshuffling the
+    # batches with python's global generator would break resuming
+    autoencoder.fit(
+        generator,
+        epochs=epochs,
+        initial_epoch=initial_epoch,
+        shuffle=False,
+        callbacks=[ThroughputLogger(), checkpointer],
+    )
+# fit sets the input signature the model is saved with, a prediction on an
+# empty cube does the same for the other paths and builds the variables
+# a checkpoint is restored into
+empty = np.zeros((1, num_cards), dtype=np.float32)
+autoencoder.predict([empty, empty])
+if hold_out is not None and checkpoints.restore_best():
+    print(f'Keeping the best epoch, {state["best_epoch"] + 1} . . .\n')
 
 # autoencoder.fit(
 #     [x_train, x_items],
@@ -109,7 +282,19 @@ autoencoder.fit(
 #     shuffle=True,
 # )
 
+# save next to the destination and swap the directory in with renames, so
+# a running web service never sees a half written model (see ModelRegistry)
 dest = f'././ml_files/{name}'
-if not os.path.isdir(dest):
-    os.makedirs(dest)
-autoencoder.save(dest, save_format='tf')
+tmp_dest = dest + '.tmp'
+old_dest = dest + '.old'
+shutil.rmtree(tmp_dest, ignore_errors=True)
+autoencoder.save(tmp_dest, save_format='tf')
+# weights for serving without tensorflow, see runtime.py
+export_weights(autoencoder, tmp_dest)
+with open(os.path.join(tmp_dest, 'id_map.json'), 'w') as out_lookup:
+    json.dump(int_to_card, out_lookup)
+if os.path.isdir(dest):
+    shutil.rmtree(old_dest, ignore_errors=True)
+    os.rename(dest, old_dest)
+os.rename(tmp_dest, dest)
+shutil.rmtree(old_dest, ignore_errors=True)
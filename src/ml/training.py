@@ -0,0 +1,260 @@
+import resource
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.callbacks import Callback
+from tensorflow.keras.losses import binary_crossentropy, kld
+
+"""
+A compiled alternative to `model.fit` for CC_Recommender.
+
+The whole forward and backward pass of a step is one tf.function, optionally
+compiled with XLA, and the regularization branch is fed card indices that the
+encoder gathers kernel rows for (see Encoder.call_indices). The losses match
+what train.py compiles the model with: binary crossentropy on the cubes plus
+`reg` times the KL divergence on the regularization rows.
+
+With `num_sampled`, both output layers are only evaluated for a candidate
+set per batch instead of the whole vocabulary: every card in the batch's
+inputs or targets plus `num_sampled` negatives drawn from the generator's
+negative sampling distribution (see `sample_candidates`).
+
+- the reconstruction head takes the binary crossentropy over the candidates
+- the regularization head takes a sampled softmax over the candidates, the
+    logits of sampled cards corrected by their log expected count, against
+    the target renormalized over the candidates
+
+The full vocabulary losses are still reported after every epoch, next to the
+mean number of candidates per batch. Large batches of large cubes hold most
+of the vocabulary between them, which leaves little to sample; `max_positives`
+then caps the cards of the batch among the candidates to a uniform draw, whose
+logits are corrected by the log of the fraction kept like the sampled ones.
+
+Both this loop and the ThroughputLogger callback used with `fit` report steps
+per second and the peak resident memory after every epoch, so the two paths
+can be compared.
+"""
+
+# candidate sets are padded with negatives to a multiple of this, so the
+# step is traced (and XLA compiled) for a handful of shapes only
+CANDIDATE_BUCKET = 1024
+
+
+def peak_rss_mb():
+    """
+    return: the peak resident memory of the process so far (Linux reports
+        ru_maxrss in kilobytes)
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def report(epoch, steps, seconds, losses):
+    print('epoch {}: {:.2f} steps/s, peak rss {:.0f}MB, {}'.format(
+        epoch + 1,
+        steps / seconds,
+        peak_rss_mb(),
+        ', '.join('{}: {:.4f}'.format(k, v) for k, v in losses.items()),
+    ))
+
+
+class ThroughputLogger(Callback):
+    """
+    Reports steps per second and peak RSS after every epoch of `fit`.
+    """
+    def on_epoch_begin(self, epoch, logs=None):
+        self.start = time.perf_counter()
+        self.steps = 0
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.steps += 1
+
+    def on_epoch_end(self, epoch, logs=None):
+        report(epoch, self.steps, time.perf_counter() - self.start,
+               {k: v for k, v in (logs or {}).items() if 'loss' in k})
+
+
+def sample_candidates(x_main, y_main, sampler, num_sampled, rng=np.random,
+                      bucket=CANDIDATE_BUCKET, max_positives=None):
+    """
+    param x_main: dense input batch
+    param y_main: dense target batch
+    param sampler: NegativeSampler the negatives are drawn from
+    param num_sampled: number of negatives drawn with replacement, the
+        candidates are then topped up to a multiple of `bucket`
+    param max_positives: at most this many of the cards of the batch are
+        candidates, drawn uniformly without replacement, all by default
+    return: (candidates, log_q), the sorted int32 candidate cards and the
+        log of the expected number of times each was sampled, which for
+        the cards of the batch is that of the fraction of them kept, 0
+        unless they are capped
+    """
+    positives = np.flatnonzero(np.asarray(x_main).any(0) |
+                               np.asarray(y_main).any(0))
+    log_keep = 0
+    if max_positives is not None and len(positives) > max_positives:
+        log_keep = np.log(max_positives / len(positives))
+        positives = np.sort(rng.choice(positives, max_positives,
+                                       replace=False))
+    negatives = np.setdiff1d(sampler.sample(num_sampled, rng), positives)
+    draws = num_sampled
+
+    # top up to the bucket with a draw without replacement from the cards
+    # left (Gumbel top-k), only cards with a positive weight ever qualify
+    size = -(-(len(positives) + len(negatives)) // bucket) * bucket
+    left = np.ones(len(sampler.p), dtype=bool)
+    left[positives] = False
+    left[negatives] = False
+    left &= sampler.p > 0
+    missing = min(size - len(positives) - len(negatives), left.sum())
+    if missing > 0:
+        left = np.flatnonzero(left)
+        keys = np.log(sampler.p[left]) - np.log(-np.log(
+            rng.random_sample(len(left))))
+        extra = left[np.argpartition(-keys, missing - 1)[:missing]]
+        negatives = np.concatenate([negatives, extra])
+        draws += missing
+    candidates = np.concatenate([positives, negatives])
+    log_q = np.full(len(candidates), log_keep, dtype=np.float32)
+    log_q[len(positives):] = np.log(np.minimum(
+        1, draws * sampler.p[negatives]))
+    order = np.argsort(candidates)
+    return candidates[order].astype(np.int32), log_q[order]
+
+
+def full_losses(model, x_main, x_reg, y_main, y_reg, training=False):
+    reconstruction, decoded_for_reg = model((x_main, x_reg), training=training)
+    main_loss = tf.reduce_mean(binary_crossentropy(y_main, reconstruction))
+    reg_loss = tf.reduce_mean(kld(y_reg, decoded_for_reg))
+    return main_loss, reg_loss
+
+
+def sampled_losses(model, x_main, x_reg, y_main, y_reg, candidates, log_q):
+    main_logits = model.decoder.call_candidates(model.encoder(x_main),
+                                                candidates)
+    main_targets = tf.gather(y_main, candidates, axis=1)
+    main_loss = tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(
+        labels=main_targets, logits=main_logits))
+
+    reg_logits = model.decoder_for_reg.call_candidates(
+        model.encoder.call_indices(x_reg), candidates) - log_q
+    reg_targets = tf.gather(y_reg, candidates, axis=1)
+    reg_targets = reg_targets / tf.maximum(
+        tf.reduce_sum(reg_targets, axis=1, keepdims=True), 1e-12)
+    reg_loss = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(
+        labels=reg_targets, logits=reg_logits))
+    return main_loss, reg_loss
+
+
+def make_train_step(model, optimizer, reg, jit=False, sampled=False,
+                    totals=None):
+    """
+    param jit: compile the step with XLA
+    param sampled: the step takes (candidates, log_q) from
+        sample_candidates and optimizes the sampled losses
+    param totals: float32 tf.Variable of shape (3,) the losses of every
+        step are added to on the device, so reading them doesn't wait for
+        each step to finish
+    return: a graph function running one optimization step on a batch and
+        returning (loss, main loss, regularization loss)
+    """
+    @tf.function(experimental_compile=jit, experimental_relax_shapes=True)
+    def train_step(x_main, x_reg, y_main, y_reg, *candidates):
+        with tf.GradientTape() as tape:
+            if sampled:
+                main_loss, reg_loss = sampled_losses(
+                    model, x_main, x_reg, y_main, y_reg, *candidates)
+            else:
+                main_loss, reg_loss = full_losses(
+                    model, x_main, x_reg, y_main, y_reg, training=True)
+            loss = main_loss + reg * reg_loss
+        variables = model.trainable_variables
+        gradients = tape.gradient(loss, variables)
+        optimizer.apply_gradients(zip(gradients, variables))
+        if totals is not None:
+            totals.assign_add(tf.stack([loss, main_loss, reg_loss]))
+        return loss, main_loss, reg_loss
+
+    return train_step
+
+
+def fit_compiled(model, optimizer, generator, epochs, reg, jit=False,
+                 initial_epoch=0, tf_data=False, num_sampled=None,
+                 max_positives=None, callbacks=()):
+    """
+    Trains `model` on the batches of `generator`, a DataGenerator built
+    with index_regularization=True.
+
+    param tf_data: read the batches from generator.as_dataset instead of
+        building them on the training thread
+    param num_sampled: train on the sampled losses with (at least) this
+        many negatives per batch, see the module docstring
+    param max_positives: with num_sampled, the most cards of a batch
+        among its candidates, see sample_candidates
+    param callbacks: Keras callbacks, only their epoch hooks are called,
+        and setting model.stop_training ends training after the epoch
+    """
+    steps = len(generator)
+    sampled = num_sampled is not None
+    # build the variables eagerly before tracing the step
+    x_main, x_reg, _, _ = generator.batch(initial_epoch, 0)
+    model((x_main, x_reg))
+    # summed on the device and read once per epoch
+    totals = tf.Variable(tf.zeros(3), trainable=False)
+    train_step = make_train_step(model, optimizer, reg, jit, sampled, totals)
+    evaluate = tf.function(full_losses, experimental_relax_shapes=True)
+    model.stop_training = False
+    for callback in callbacks:
+        callback.set_model(model)
+
+    if tf_data:
+        batches = iter(generator.as_dataset(epochs, initial_epoch))
+    else:
+        batches = None
+
+    for epoch in range(initial_epoch, epochs):
+        for callback in callbacks:
+            callback.on_epoch_begin(epoch)
+        start = time.perf_counter()
+        totals.assign(tf.zeros(3))
+        num_candidates = 0
+        for batch_number in range(steps):
+            if batches is None:
+                x_main, x_reg, y_main, y_reg = generator.batch(epoch,
+                                                               batch_number)
+            else:
+                (x_main, x_reg), (y_main, y_reg) = next(batches)
+            candidates = ()
+            if sampled:
+                candidates = sample_candidates(
+                    x_main,
+                    y_main,
+                    generator.neg_sampler,
+                    num_sampled,
+                    np.random.RandomState([generator.seed, epoch,
+                                           batch_number, 1]),
+                    max_positives=max_positives,
+                )
+                num_candidates += len(candidates[0])
+            train_step(x_main, x_reg, y_main, y_reg, *candidates)
+        loss, main_loss, reg_loss = totals.numpy() / steps
+        seconds = time.perf_counter() - start
+        logs = {
+            'loss': float(loss),
+            'main_loss': float(main_loss),
+            'reg_loss': float(reg_loss),
+        }
+        if sampled:
+            # the sampled losses aren't comparable to the full ones, so
+            # score the last batch over the whole vocabulary as well
+            main_loss, reg_loss = evaluate(model, x_main, x_reg, y_main,
+                                           y_reg)
+            logs['full_main_loss'] = float(main_loss)
+            logs['full_reg_loss'] = float(reg_loss)
+            # how much of the vocabulary the sampled losses actually cover
+            logs['candidates'] = num_candidates / steps
+        report(epoch, steps, seconds, logs)
+        for callback in callbacks:
+            callback.on_epoch_end(epoch, logs)
+        if model.stop_training:
+            break
@@ -0,0 +1,84 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+import aiohttp
+
+from non_ml.cubelist import (
+    ROOT,
+    CubeListEntry,
+    conditional_headers,
+    cubelist_url,
+    parse_cards,
+)
+
+
+class AsyncCubeListClient:
+    """
+    asyncio counterpart of `cubelist.CubeListClient` with the same pooling,
+    TTL+LRU caching, revalidation and single-flight behaviour. It must only
+    be used from the event loop it was first used on.
+    """
+    def __init__(self, root=ROOT, timeout=10, ttl=300, max_size=1024,
+                 pool_size=100):
+        self.root = root
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.pool_size = pool_size
+        self._session = None
+        self._cache = OrderedDict()
+        self._in_flight = dict()
+
+    async def get_cards(self, cube_id, root=None):
+        """
+        param cube_id: CubeCobra cube id or short name
+        param root: site to fetch from, defaults to the client's root
+        return: list of card names in the cube
+        """
+        key = (root or self.root, cube_id)
+        entry = self._cache.get(key)
+        if entry is not None and \
+                time.monotonic() - entry.fetched_at < self.ttl:
+            self._cache.move_to_end(key)
+            return entry.cards
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(key, entry))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        # shield so one cancelled caller doesn't cancel the shared fetch
+        return await asyncio.shield(task)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=self.timeout,
+            )
+        return self._session
+
+    async def _fetch(self, key, cached):
+        root, cube_id = key
+        session = self._get_session()
+        async with session.get(cubelist_url(root, cube_id),
+                               headers=conditional_headers(cached)) as response:
+            if response.status == 304 and cached is not None:
+                entry = cached.revalidated()
+            else:
+                response.raise_for_status()
+                entry = CubeListEntry(
+                    parse_cards(await response.read()),
+                    response.headers.get("ETag"),
+                    response.headers.get("Last-Modified"),
+                )
+        self._cache[key] = entry
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+        return entry.cards
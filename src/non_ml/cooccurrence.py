@@ -0,0 +1,358 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy import sparse
+
+from non_ml.corpus import CubeCorpus
+
+"""
+Card co-occurrence counts over a corpus of cubes, computed as the sparse
+product cubes.T @ cubes.
+
+The output is built a chunk of cards (rows) at a time: every chunk is the
+product of the columns of those cards with the whole corpus, so the only
+large allocation is the output itself. Chunks run on a thread pool, scipy's
+sparse kernels and NumPy both release the GIL while they work.
+"""
+
+CHUNK_SIZE = 1024
+
+
+def as_sparse(cubes):
+    """
+    param cubes: (num_cubes, num_cards) dense array or scipy sparse matrix
+    return: cubes as a CSR matrix
+    """
+    if sparse.issparse(cubes):
+        return sparse.csr_matrix(cubes)
+    return sparse.csr_matrix(np.asarray(cubes))
+
+
+def contains(cubes):
+    """
+    return: CSC matrix that is 1 wherever a cube holds a card, i.e. where
+        `cubes == 1` as in the original per card loop
+    """
+    cubes = sparse.csc_matrix(cubes, copy=True)
+    cubes.data = (cubes.data == 1).astype(np.float64)
+    cubes.eliminate_zeros()
+    return cubes
+
+
+def cooccurrence_rows(contained, cubes, rows, dtype=np.float64):
+    """
+    param contained: CSC output of `contains`
+    param cubes: CSR output of `as_sparse`
+    param rows: slice of cards to compute
+    return: dense (len(rows), num_cards) block of the summed cubes that
+        contain each card
+    """
+    return (contained[:, rows].T @ cubes).toarray().astype(dtype, copy=False)
+
+
+def normalize_rows(block, rows):
+    """
+    Divides each row of `block` in place by its own diagonal entry, the
+    number of cubes that contain the card. Cards in no cube are left as is.
+
+    param rows: the card of each row of `block`
+    """
+    diag = block[np.arange(len(block)), rows].astype(np.float64)
+    diag[diag == 0] = 1
+    block /= diag[:, np.newaxis]
+    return block
+
+
+def fill_chunks(num_cards, fill, chunk_size=CHUNK_SIZE, workers=None,
+                verbose=True):
+    """
+    Calls `fill` with a slice of at most `chunk_size` cards until every card
+    is covered, on `workers` threads (all cores by default).
+    """
+    chunks = [
+        slice(start, min(start + chunk_size, num_cards))
+        for start in range(0, num_cards, chunk_size)
+    ]
+    workers = workers or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for chunk in executor.map(fill, chunks):
+            if verbose:
+                print(chunk.stop, "/", num_cards)
+
+
+def cooccurrence_counts(cubes, chunk_size=CHUNK_SIZE, workers=None,
+                        dtype=np.int32, verbose=True):
+    """
+    return: (num_cards, num_cards) matrix counting the cubes that hold both
+        cards, with the number of cubes holding each card on the diagonal
+    """
+    cubes = as_sparse(cubes)
+    contained = contains(cubes)
+    num_cards = cubes.shape[1]
+    counts = np.empty((num_cards, num_cards), dtype=dtype)
+
+    def fill(chunk):
+        counts[chunk] = cooccurrence_rows(contained, cubes, chunk, dtype)
+        return chunk
+
+    fill_chunks(num_cards, fill, chunk_size, workers, verbose)
+    return counts
+
+
+def adjacency_matrix(cubes, force_diag=None, chunk_size=CHUNK_SIZE,
+                     workers=None, dtype=np.float64, verbose=True):
+    """
+    param cubes: (num_cubes, num_cards) dense array or scipy sparse matrix
+    param force_diag: value to set the diagonal to after normalizing
+    param chunk_size: number of cards computed per task
+    param workers: threads to use, all cores by default
+    return: (num_cards, num_cards) matrix whose row i is the sum of the cubes
+        containing card i divided by the number of such cubes
+    """
+    cubes = as_sparse(cubes)
+    contained = contains(cubes)
+    num_cards = cubes.shape[1]
+    adj_mtx = np.empty((num_cards, num_cards), dtype=dtype)
+
+    def fill(chunk):
+        block = cooccurrence_rows(contained, cubes, chunk, dtype)
+        adj_mtx[chunk] = normalize_rows(block, np.arange(num_cards)[chunk])
+        return chunk
+
+    fill_chunks(num_cards, fill, chunk_size, workers, verbose)
+
+    if force_diag is not None:
+        np.fill_diagonal(adj_mtx, force_diag)
+    return adj_mtx
+
+
+def _read_json(path, default):
+    if not os.path.isfile(path):
+        return default
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_json(path, value):
+    with open(path + ".tmp", "w") as f:
+        json.dump(value, f)
+    os.replace(path + ".tmp", path)
+
+
+class CooccurrenceState:
+    """
+    The co-occurrence counts behind the adjacency matrix, maintained under
+    cube additions, removals and card edits.
+
+    A change to a cube only touches the counts between the cards it gained
+    or lost and the cards it holds, and marks those rows dirty. The
+    normalized matrix is re-derived on demand, for the dirty rows only.
+    Counts are kept for binary cubes, i.e. what create_adjacency_matrix
+    gives for the output of build_cubes.
+
+    Every save bumps the state's version. save_adjacency records which
+    version the matrix it writes belongs to, so a later process can seed
+    the matrix with it (load_adjacency) and normalize only the rows its own
+    changes touch.
+
+    param counts: output of cooccurrence_counts
+    param cubes: {cube id: sorted card indices} of the counted cubes
+    param version: number of times the state has been saved
+    """
+    ARRAYS = ("counts", "indptr", "indices")
+    IDS = "ids.json"
+    VERSION = "version.json"
+    MATRIX = "matrix.json"
+
+    def __init__(self, counts, cubes, version=0):
+        self.counts = counts
+        self.cubes = cubes
+        self.version = version
+        self.num_cards = counts.shape[0]
+        self._adj_mtx = None
+        self._force_diag = None
+        self._dirty = set()
+
+    @classmethod
+    def from_corpus(cls, corpus, chunk_size=CHUNK_SIZE, workers=None,
+                    verbose=True):
+        """
+        param corpus: a CubeCorpus with ids, see utils.load_corpus. Cubes
+            without an id are keyed by their position in the corpus.
+        """
+        ids = [
+            str(i) if cube_id is None else cube_id
+            for i, cube_id in enumerate(corpus.ids or [None] * len(corpus))
+        ]
+        if len(set(ids)) != len(ids):
+            raise ValueError("The corpus holds the same cube id twice")
+        counts = cooccurrence_counts(corpus.to_csr(), chunk_size, workers,
+                                     verbose=verbose)
+        return cls(counts, dict(zip(ids, corpus.index_lists())))
+
+    @classmethod
+    def load(cls, path):
+        arrays = {
+            name: np.load(os.path.join(path, name + ".npy"))
+            for name in cls.ARRAYS
+        }
+        with open(os.path.join(path, cls.IDS)) as f:
+            ids = json.load(f)
+        version = _read_json(os.path.join(path, cls.VERSION), dict())
+        corpus = CubeCorpus(arrays["indptr"], arrays["indices"],
+                            arrays["counts"].shape[0], ids)
+        return cls(arrays["counts"], dict(zip(ids, corpus.index_lists())),
+                   version.get("version", 0))
+
+    def save(self, path):
+        """
+        Writes the state to directory `path`, every file is written aside
+        and renamed into place.
+        """
+        os.makedirs(path, exist_ok=True)
+        self.version += 1
+        ids = list(self.cubes)
+        corpus = CubeCorpus.from_index_lists(
+            [self.cubes[cube_id] for cube_id in ids], self.num_cards)
+        arrays = {
+            "counts": self.counts,
+            "indptr": corpus.indptr,
+            "indices": corpus.indices,
+        }
+        for name in self.ARRAYS:
+            dest = os.path.join(path, name + ".npy")
+            with open(dest + ".tmp", "wb") as f:
+                np.save(f, arrays[name])
+            os.replace(dest + ".tmp", dest)
+        _write_json(os.path.join(path, self.IDS), ids)
+        _write_json(os.path.join(path, self.VERSION),
+                    {"version": self.version})
+
+    def save_adjacency(self, path, dest, force_diag=None):
+        """
+        Writes the normalized matrix to `dest` as a .npy file, then records
+        in the state directory `path` that it belongs to the state's
+        current version. Call after save.
+        """
+        adj_mtx = self.adjacency(force_diag)
+        with open(dest + ".tmp", "wb") as f:
+            np.save(f, adj_mtx)
+        os.replace(dest + ".tmp", dest)
+        stat = os.stat(dest)
+        _write_json(os.path.join(path, self.MATRIX), {
+            "version": self.version,
+            "force_diag": force_diag,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+        })
+
+    def load_adjacency(self, path, dest):
+        """
+        Seeds the matrix adjacency() updates with the one save_adjacency
+        wrote to `dest`, if it is still the matrix of this version of the
+        state. Call before the first call to adjacency().
+
+        return: whether the matrix was loaded
+        """
+        record = _read_json(os.path.join(path, self.MATRIX), None)
+        if record is None or record["version"] != self.version or \
+                not os.path.isfile(dest):
+            return False
+        stat = os.stat(dest)
+        if (stat.st_size, stat.st_mtime_ns) != \
+                (record["size"], record["mtime_ns"]):
+            # written by something else since, e.g. create_mtx.py
+            return False
+        adj_mtx = np.load(dest)
+        if adj_mtx.shape != self.counts.shape or \
+                adj_mtx.dtype != np.float64:
+            return False
+        self._adj_mtx = adj_mtx
+        self._force_diag = record["force_diag"]
+        return True
+
+    @property
+    def totals(self):
+        """
+        return: the number of cubes holding each card
+        """
+        return self.counts.diagonal()
+
+    def _update(self, old, new):
+        cards = np.union1d(old, new).astype(np.int64)
+        if len(cards) == 0:
+            return
+        in_new = np.isin(cards, new).astype(self.counts.dtype)
+        in_old = np.isin(cards, old).astype(self.counts.dtype)
+        self.counts[np.ix_(cards, cards)] += \
+            np.outer(in_new, in_new) - np.outer(in_old, in_old)
+        self._dirty.update(cards.tolist())
+
+    def add(self, cube_id, cards):
+        """
+        Adds a cube, replacing the cube with the same id if there is one.
+        """
+        cards = np.unique(np.asarray(cards, dtype=np.int64))
+        self._update(self.cubes.get(cube_id, cards[:0]), cards)
+        self.cubes[cube_id] = cards
+
+    def remove(self, cube_id):
+        old = self.cubes.pop(cube_id, None)
+        if old is not None:
+            self._update(old, old[:0])
+
+    def edit(self, cube_id, added=(), removed=()):
+        """
+        Adds and removes cards from a cube, a cube that isn't known yet is
+        created.
+        """
+        old = self.cubes.get(cube_id, np.zeros(0, dtype=np.int64))
+        new = np.setdiff1d(np.union1d(old, np.asarray(added, np.int64)),
+                           np.asarray(removed, np.int64))
+        self.add(cube_id, new)
+
+    def apply(self, added=None, removed=None, edited=None):
+        """
+        param added: {cube id: card indices} of new or replaced cubes
+        param removed: ids of removed cubes
+        param edited: list of (cube id, added card indices, removed card
+            indices), applied in order, so a cube can be edited more than
+            once
+        """
+        for cube_id in removed or ():
+            self.remove(cube_id)
+        for cube_id, cards in (added or dict()).items():
+            self.add(cube_id, cards)
+        for cube_id, gained, lost in edited or ():
+            self.edit(cube_id, gained, lost)
+
+    def adjacency(self, force_diag=None, chunk_size=CHUNK_SIZE, workers=None,
+                  verbose=False):
+        """
+        return: the normalized matrix create_adjacency_matrix gives for the
+            current cubes. Only the rows changed since the last call are
+            normalized again, the returned matrix is reused between calls.
+        """
+        if self._adj_mtx is None or force_diag != self._force_diag:
+            self._adj_mtx = np.empty(self.counts.shape, dtype=np.float64)
+            self._dirty = set()
+            cards = np.arange(self.num_cards)
+
+            def fill(chunk):
+                self._adj_mtx[chunk] = normalize_rows(
+                    self.counts[chunk].astype(np.float64), cards[chunk])
+                return chunk
+
+            fill_chunks(self.num_cards, fill, chunk_size, workers, verbose)
+            rows = cards
+        else:
+            rows = np.array(sorted(self._dirty), dtype=np.int64)
+            self._dirty = set()
+            self._adj_mtx[rows] = normalize_rows(
+                self.counts[rows].astype(np.float64), rows)
+        self._force_diag = force_diag
+        if force_diag is not None:
+            self._adj_mtx[rows, rows] = force_diag
+        return self._adj_mtx
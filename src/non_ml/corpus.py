@@ -0,0 +1,171 @@
+import json
+import os
+import os.path
+
+import numpy as np
+from scipy import sparse
+
+"""
+A corpus of cubes stored as card index lists (CSR without the data array).
+
+Cube i holds the cards indices[indptr[i]:indptr[i + 1]], sorted and without
+duplicates. Memory grows with the number of cards in the cubes rather than
+cubes x vocabulary, and consumers densify only the rows they need, e.g. one
+training batch at a time.
+"""
+
+
+def csr_positions(indptr, rows):
+    """
+    return: (positions, lengths) where positions are the offsets into the
+        CSR indices of every entry of `rows`, row after row, and lengths
+        the number of entries of each row
+    """
+    starts = indptr[rows]
+    lengths = indptr[rows + 1] - starts
+    offsets = np.arange(lengths.sum()) - np.repeat(
+        np.cumsum(lengths) - lengths, lengths)
+    return np.repeat(starts, lengths) + offsets, lengths
+
+
+def index_dtype(num_cards):
+    """
+    return: the smallest integer dtype that holds every card index
+    """
+    for dtype in (np.int16, np.int32):
+        if num_cards <= np.iinfo(dtype).max + 1:
+            return dtype
+    return np.int64
+
+
+class CubeCorpus:
+    ARRAYS = ("indptr", "indices")
+    META = "corpus.json"
+
+    def __init__(self, indptr, indices, num_cards, ids=None):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=index_dtype(num_cards))
+        self.num_cards = num_cards
+        # the CubeCobra id of each cube, when known
+        self.ids = ids
+
+    @classmethod
+    def from_index_lists(cls, index_lists, num_cards, ids=None):
+        """
+        param index_lists: iterable with the card indices of each cube
+        param ids: the id of each cube
+        """
+        dtype = index_dtype(num_cards)
+        cubes = [np.unique(np.asarray(cube, dtype=dtype))
+                 for cube in index_lists]
+        lengths = np.array([len(cube) for cube in cubes], dtype=np.int64)
+        indptr = np.zeros(len(cubes) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        if cubes:
+            indices = np.concatenate(cubes)
+        else:
+            indices = np.zeros(0, dtype=dtype)
+        return cls(indptr, indices, num_cards, ids)
+
+    @classmethod
+    def load(cls, path, mmap_mode=None):
+        """
+        param path: directory written by `save`
+        """
+        with open(os.path.join(path, cls.META)) as f:
+            meta = json.load(f)
+        arrays = [
+            np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+            for name in cls.ARRAYS
+        ]
+        return cls(*arrays, meta["num_cards"], meta.get("ids"))
+
+    def save(self, path):
+        """
+        Writes the corpus to directory `path`, one .npy file per array.
+        """
+        os.makedirs(path, exist_ok=True)
+        for name in self.ARRAYS:
+            dest = os.path.join(path, name + ".npy")
+            with open(dest + ".tmp", "wb") as f:
+                np.save(f, getattr(self, name))
+            os.replace(dest + ".tmp", dest)
+        dest = os.path.join(path, self.META)
+        with open(dest + ".tmp", "w") as f:
+            json.dump({"num_cards": self.num_cards, "ids": self.ids}, f)
+        os.replace(dest + ".tmp", dest)
+
+    @classmethod
+    def from_dense(cls, cubes):
+        """
+        param cubes: (num_cubes, num_cards) binary matrix
+        """
+        cubes = np.asarray(cubes)
+        return cls.from_index_lists(
+            (np.flatnonzero(cube == 1) for cube in cubes),
+            cubes.shape[1],
+        )
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    @property
+    def shape(self):
+        return (len(self), self.num_cards)
+
+    @property
+    def sizes(self):
+        return np.diff(self.indptr)
+
+    def cube(self, i):
+        """
+        return: the card indices of cube i
+        """
+        return self.indices[self.indptr[i]:self.indptr[i + 1]]
+
+    def index_lists(self, rows=None):
+        """
+        return: the card indices of each cube in `rows` (all by default)
+        """
+        if rows is None:
+            rows = range(len(self))
+        return [self.cube(i) for i in rows]
+
+    def take(self, rows):
+        """
+        return: a CubeCorpus of only the cubes in `rows`, in that order
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        positions, lengths = csr_positions(self.indptr, rows)
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        ids = None if self.ids is None else [self.ids[i] for i in rows]
+        return CubeCorpus(indptr, self.indices[positions], self.num_cards, ids)
+
+    def densify(self, rows=None, dtype=np.float32):
+        """
+        param rows: indices of the cubes to densify, all of them by default
+        return: (len(rows), num_cards) binary matrix
+        """
+        if rows is None:
+            rows = np.arange(len(self))
+        rows = np.asarray(rows, dtype=np.int64)
+        positions, lengths = csr_positions(self.indptr, rows)
+        cards = self.indices[positions]
+        dense = np.zeros((len(rows), self.num_cards), dtype=dtype)
+        dense[np.repeat(np.arange(len(rows)), lengths), cards] = 1
+        return dense
+
+    def to_csr(self, dtype=np.float32):
+        """
+        return: the corpus as a binary scipy CSR matrix
+        """
+        return sparse.csr_matrix(
+            (np.ones(len(self.indices), dtype=dtype), self.indices,
+             self.indptr),
+            shape=self.shape,
+        )
+
+    @property
+    def nbytes(self):
+        return self.indptr.nbytes + self.indices.nbytes
@@ -0,0 +1,273 @@
+import json
+import logging
+import os
+import os.path
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from non_ml import cubelist
+from non_ml.corpus import CubeCorpus
+
+"""
+Crawls the card lists of many cubes from CubeCobra into a sparse corpus.
+
+Everything the crawler learns is appended to two logs in its output
+directory as it goes: `cards.jsonl` gets every new card name (its line
+number is the card's index) and `cubes.jsonl` gets one record per fetched
+cube. After a crash the logs are read back and the crawl resumes where it
+stopped. New card names are on disk before any cube record that refers to
+them, and records referring to cards the cards log never got are dropped on
+load and fetched again. Each full pass over the cubes is a generation; a
+finished crawl starts a new one, and in incremental mode that pass only
+downloads the cubes whose list changed upstream (ETag/Last-Modified) and
+keeps the rest. Cubes that fail to download stay pending, so running the
+crawl again retries them before a new generation starts.
+
+`finish` writes the cubes of the latest generation as a CubeCorpus, see
+corpus.py, along with `int_to_card.json`.
+"""
+
+logger = logging.getLogger(__name__)
+
+CARDS_LOG = "cards.jsonl"
+CUBES_LOG = "cubes.jsonl"
+STATE = "state.json"
+CORPUS = "corpus"
+INT_TO_CARD = "int_to_card.json"
+# runs of a generation that retry the cubes that failed before giving up
+MAX_PASSES = 3
+
+
+def read_log(path):
+    """
+    return: the records of a JSON lines log. A last line cut off by a crash
+        is dropped from the file so appending can continue after it.
+    """
+    if not os.path.isfile(path):
+        return []
+    with open(path, "rb+") as f:
+        content = f.read()
+        end = content.rfind(b"\n") + 1
+        if end != len(content):
+            f.truncate(end)
+    return [json.loads(line) for line in content[:end].splitlines()]
+
+
+def write_json(path, value):
+    with open(path + ".tmp", "w") as f:
+        json.dump(value, f)
+    os.replace(path + ".tmp", path)
+
+
+class CubeCrawler:
+    """
+    param out_dir: directory for the logs, the checkpoint and the corpus
+    param root: CubeCobra site to crawl
+    param workers: cube lists fetched concurrently, over as many pooled
+        keep-alive connections
+    param retries: attempts per cube for failed connections and 429/5xx
+        responses, with exponential backoff
+    param incremental: revalidate cubes fetched by an earlier generation
+        instead of downloading them again
+    param checkpoint_every: records between flushes of the logs to disk
+    """
+    def __init__(self, out_dir, root=cubelist.ROOT, workers=16, retries=3,
+                 incremental=False, checkpoint_every=256, timeout=10,
+                 client=None):
+        self.out_dir = out_dir
+        self.workers = workers
+        self.incremental = incremental
+        self.checkpoint_every = checkpoint_every
+        if client is None:
+            client = cubelist.CubeListClient(root, timeout=timeout,
+                                             pool_size=workers,
+                                             retries=retries)
+        self.client = client
+        os.makedirs(out_dir, exist_ok=True)
+
+        self.card_to_int = {
+            name: i
+            for i, name in enumerate(read_log(self._path(CARDS_LOG)))
+        }
+        # latest record of every cube
+        self.records = dict()
+        num_cards = len(self.card_to_int)
+        for record in read_log(self._path(CUBES_LOG)):
+            if any(card >= num_cards for card in record.get("cards", ())):
+                # written before the cards it refers to were, fetch again
+                logger.warning("dropping cube %s with unknown cards",
+                               record["_id"])
+                self.records.pop(record["_id"], None)
+            else:
+                self.records[record["_id"]] = record
+        state_file = self._path(STATE)
+        if os.path.isfile(state_file):
+            with open(state_file) as f:
+                self.state = json.load(f)
+        else:
+            self.state = {"generation": 0, "finished": True}
+
+    def _path(self, name):
+        return os.path.join(self.out_dir, name)
+
+    def pending(self, cube_ids):
+        """
+        return: the cubes the current generation still has to fetch
+        """
+        generation = self.state["generation"]
+        return [
+            cube_id for cube_id in cube_ids
+            if self.records.get(cube_id, {}).get("generation") != generation
+        ]
+
+    def crawl(self, cube_ids):
+        """
+        Fetches every cube in `cube_ids` not fetched by the current
+        generation, starting a new generation when the last one finished.
+
+        return: {"fetched", "unchanged", "failed"} counts for this run
+        """
+        cube_ids = list(dict.fromkeys(cube_ids))
+        if self.state["finished"]:
+            self.state = {"generation": self.state["generation"] + 1,
+                          "finished": False, "passes": 0}
+            write_json(self._path(STATE), self.state)
+        todo = self.pending(cube_ids)
+        logger.info("generation %d: %d of %d cubes to fetch",
+                    self.state["generation"], len(todo), len(cube_ids))
+
+        stats = {"fetched": 0, "unchanged": 0, "failed": 0}
+        with open(self._path(CARDS_LOG), "a") as cards_log, \
+                open(self._path(CUBES_LOG), "a") as cubes_log, \
+                ThreadPoolExecutor(max_workers=self.workers) as executor:
+            logs = (cards_log, cubes_log)
+            unflushed = 0
+            in_flight = set()
+            todo = iter(todo)
+            while True:
+                # keep a bounded number of fetches queued, not one per cube
+                for cube_id in todo:
+                    in_flight.add(executor.submit(self._fetch, cube_id))
+                    if len(in_flight) >= 4 * self.workers:
+                        break
+                if not in_flight:
+                    break
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    record, outcome = future.result()
+                    self._record(record, cards_log, cubes_log)
+                    stats[outcome] += 1
+                    unflushed += 1
+                if unflushed >= self.checkpoint_every:
+                    self._flush(logs)
+                    unflushed = 0
+            self._flush(logs)
+
+        # with failures left the generation goes on and the next run retries
+        # them, until cubes that keep failing are given up on
+        self.state["passes"] = self.state.get("passes", 0) + 1
+        self.state["finished"] = stats["failed"] == 0 or \
+            self.state["passes"] >= MAX_PASSES
+        write_json(self._path(STATE), self.state)
+        return stats
+
+    def _fetch(self, cube_id):
+        previous = self.records.get(cube_id)
+        cached = None
+        if self.incremental and previous is not None and "cards" in previous:
+            cached = cubelist.CubeListEntry(previous["cards"],
+                                            previous.get("etag"),
+                                            previous.get("last_modified"))
+        try:
+            entry, modified = self.client.fetch(cube_id, cached)
+        except Exception as e:
+            logger.error("failed to fetch cube %s: %s", cube_id, e)
+            # keep what was known, so the next pass can still revalidate it
+            # and an incremental corpus can keep the cube's last cards
+            return dict(previous or {}, _id=cube_id, error=str(e)), "failed"
+        cards = entry.cards if modified else previous["cards"]
+        return {
+            "_id": cube_id,
+            "etag": entry.etag,
+            "last_modified": entry.last_modified,
+            "cards": cards,
+        }, "fetched" if modified else "unchanged"
+
+    def _record(self, record, cards_log, cubes_log):
+        if "error" not in record:
+            # failed cubes keep the generation they were last fetched by,
+            # so they stay pending
+            record["generation"] = self.state["generation"]
+        if "cards" in record:
+            # cards are stored by index, only new names go to the cards log
+            num_cards = len(self.card_to_int)
+            record["cards"] = [self._card_index(card, cards_log)
+                               for card in record["cards"]
+                               if not isinstance(card, str) or card]
+            if len(self.card_to_int) > num_cards:
+                # the names must be on disk before a record refers to them
+                self._flush((cards_log,))
+        cubes_log.write(json.dumps(record) + "\n")
+        self.records[record["_id"]] = record
+
+    def _card_index(self, card, cards_log):
+        if not isinstance(card, str):
+            # kept from an earlier generation
+            return card
+        index = self.card_to_int.get(card)
+        if index is None:
+            index = len(self.card_to_int)
+            self.card_to_int[card] = index
+            cards_log.write(json.dumps(card) + "\n")
+        return index
+
+    @staticmethod
+    def _flush(logs):
+        for log in logs:
+            log.flush()
+            os.fsync(log.fileno())
+
+    def compact(self):
+        """
+        Rewrites the cubes log with only the latest record of every cube,
+        every generation appends a full pass to it otherwise.
+        """
+        path = self._path(CUBES_LOG)
+        with open(path + ".tmp", "w") as f:
+            for record in self.records.values():
+                f.write(json.dumps(record) + "\n")
+        os.replace(path + ".tmp", path)
+
+    def finish(self, cube_ids=None):
+        """
+        Writes the cubes fetched by the current generation (limited to
+        `cube_ids` when given) as a CubeCorpus in `out_dir/corpus`. In
+        incremental mode, cubes that failed to download keep the cards of
+        the generation that last fetched them.
+
+        return: the corpus
+        """
+        generation = self.state["generation"]
+        if cube_ids is None:
+            cube_ids = list(self.records)
+        def current(record):
+            if "cards" not in record:
+                return False
+            if "error" in record:
+                return self.incremental
+            return record.get("generation") == generation
+
+        records = [
+            self.records[cube_id] for cube_id in dict.fromkeys(cube_ids)
+            if cube_id in self.records and current(self.records[cube_id])
+        ]
+        corpus = CubeCorpus.from_index_lists(
+            [record["cards"] for record in records],
+            len(self.card_to_int),
+            [record["_id"] for record in records],
+        )
+        corpus.save(self._path(CORPUS))
+        self.compact()
+        write_json(self._path(INT_TO_CARD), {
+            i: name for name, i in self.card_to_int.items()
+        })
+        return corpus
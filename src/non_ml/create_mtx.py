@@ -1,29 +1,33 @@
+# enable sibling imports
+if __name__ == "__main__":
+    from sys import path
+    from os.path import dirname as dir
+    path.append(dir(path[0]))
+
 import os
 import os.path
 
-import utils
-import numpy as np
+from non_ml import cooccurrence
+from non_ml.dataset import load_dataset
 import json
 
 map_file = '././data/maps/nameToId.json'
 folder = "././data/cube/"
 print('getting data')
-num_cards, name_lookup, card_to_int, int_to_card = \
-    utils.get_card_maps(map_file)
-
-num_cubes = utils.get_num_cubes(folder)
+dataset = load_dataset(map_file, folder)
+corpus = dataset.corpus
+int_to_card = dataset.vocabulary.int_to_card
 
-cubes = utils.build_cubes(folder, num_cubes, num_cards, name_lookup,
-                          card_to_int)
 print('creating matrix')
-adj_mtx = utils.create_adjacency_matrix(cubes)
+# the counts are kept so update_mtx.py can apply cube changes to them
+state = cooccurrence.CooccurrenceState.from_corpus(corpus)
 
 dest = '././output'
 if not os.path.isdir(dest):
     os.makedirs('././output')
 
-with open('././output/full_adj_mtx.npy', 'wb') as out_mtx:
-    np.save(out_mtx, adj_mtx)
+state.save('././output/cooccurrence')
+state.save_adjacency('././output/cooccurrence', '././output/full_adj_mtx.npy')
 
 with open('././output/int_to_card.json', 'w') as out_lookup:
     json.dump(int_to_card, out_lookup)
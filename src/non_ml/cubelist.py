@@ -0,0 +1,169 @@
+import threading
+import time
+import urllib.parse
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+ROOT = "https://cubecobra.com"
+CUBELIST_PATH = "/cube/api/cubelist/"
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class CubeListEntry:
+    def __init__(self, cards, etag, last_modified):
+        self.cards = cards
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = time.monotonic()
+
+    def revalidated(self):
+        return CubeListEntry(self.cards, self.etag, self.last_modified)
+
+
+def cubelist_url(root, cube_id):
+    return root + CUBELIST_PATH + urllib.parse.quote(cube_id, safe="")
+
+
+def conditional_headers(cached):
+    """
+    return: headers asking the server to only resend a changed cube list
+    """
+    headers = dict()
+    if cached is not None:
+        if cached.etag:
+            headers["If-None-Match"] = cached.etag
+        if cached.last_modified:
+            headers["If-Modified-Since"] = cached.last_modified
+    return headers
+
+
+def parse_cards(content):
+    return content.decode("utf8").split("\n")
+
+
+class CubeListClient:
+    """
+    Fetches cube lists from the CubeCobra `cubelist` API.
+
+    - connections are kept alive and pooled per host
+    - results are kept in an LRU cache of `max_size` cubes; after `ttl`
+        seconds an entry is revalidated with a conditional request
+        (ETag/Last-Modified) instead of being downloaded again
+    - concurrent requests for the same cube share a single fetch
+    - with `retries`, failed connections and overloaded server responses
+        are retried with exponential backoff
+    """
+    def __init__(self, root=ROOT, timeout=10, ttl=300, max_size=1024,
+                 pool_size=16, session=None, retries=0):
+        self.root = root
+        self.timeout = timeout
+        self.ttl = ttl
+        self.max_size = max_size
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=pool_size,
+                pool_maxsize=pool_size,
+                max_retries=Retry(total=retries, backoff_factor=0.5,
+                                  status_forcelist=RETRY_STATUSES),
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        self.session = session
+        self._cache = OrderedDict()
+        self._in_flight = dict()
+        self._lock = threading.Lock()
+
+    def get_cards(self, cube_id, root=None):
+        """
+        param cube_id: CubeCobra cube id or short name
+        param root: site to fetch from, defaults to the client's root
+        return: list of card names in the cube
+        """
+        key = (root or self.root, cube_id)
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and self._is_fresh(entry):
+                self._cache.move_to_end(key)
+                return entry.cards
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._in_flight[key] = future
+        if not leader:
+            return future.result()
+
+        try:
+            entry = self._fetch(key, entry)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(entry.cards)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+        return entry.cards
+
+    def invalidate(self, cube_id=None, root=None):
+        """
+        Drops one cube (or everything when cube_id is None) from the cache.
+        """
+        with self._lock:
+            if cube_id is None:
+                self._cache.clear()
+            else:
+                self._cache.pop((root or self.root, cube_id), None)
+
+    def url(self, cube_id, root=None):
+        return cubelist_url(root or self.root, cube_id)
+
+    def _is_fresh(self, entry):
+        return time.monotonic() - entry.fetched_at < self.ttl
+
+    def fetch(self, cube_id, cached=None, root=None):
+        """
+        Fetches a cube list, bypassing the cache.
+
+        param cached: a CubeListEntry from an earlier fetch, only downloaded
+            again when the server says it changed
+        return: (entry, modified), modified being False when `cached` was
+            still current
+        """
+        response = self.session.get(self.url(cube_id, root),
+                                    headers=conditional_headers(cached),
+                                    timeout=self.timeout)
+        if response.status_code == 304 and cached is not None:
+            return cached.revalidated(), False
+        response.raise_for_status()
+        entry = CubeListEntry(
+            parse_cards(response.content),
+            response.headers.get("ETag"),
+            response.headers.get("Last-Modified"),
+        )
+        return entry, True
+
+    def _fetch(self, key, cached):
+        root, cube_id = key
+        entry, _ = self.fetch(cube_id, cached, root)
+        with self._lock:
+            self._cache[key] = entry
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+        return entry
+
+
+default_client = CubeListClient()
+
+
+def get_cards(cube_id, root=ROOT):
+    """
+    Shortcut for fetching through the process wide client.
+    """
+    return default_client.get_cards(cube_id, root=root)
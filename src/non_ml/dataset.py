@@ -0,0 +1,189 @@
+import hashlib
+import json
+import os
+import os.path
+import shutil
+
+import numpy as np
+
+from non_ml import cooccurrence, utils
+from non_ml.corpus import CubeCorpus
+from non_ml.vocabulary import CardVocabulary
+
+"""
+Preprocessed training data, cached on disk under a hash of its inputs.
+
+Parsing `data/maps/nameToId.json` and every file of `data/cube/` dominates
+the start up of train.py and create_mtx.py. The first run writes the
+vocabulary and the sparse cube corpus to `output/cache/<key>/` as binary
+artifacts, where key hashes the contents of the card map, the cube files and
+the exclusion file. Later runs with the same inputs load them directly, and
+any change to an input gives a new key, so stale artifacts are never read.
+
+The regularization target train.py derives from the adjacency matrix is
+cached the same way, keyed by the dataset and the adjacency file, or by the
+cubes it was counted over when a validation split is held out.
+"""
+
+CACHE_DIR = '././output/cache'
+# bump when the layout or the preprocessing changes
+FORMAT_VERSION = 1
+VOCABULARY = 'vocabulary.npz'
+CORPUS = 'corpus'
+REGULARIZATION = 'y_mtx_{}.npy'
+
+
+def hash_file(path, digest):
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+
+
+def input_key(map_file, cube_folder, exclude_file=None):
+    """
+    return: hex digest of the contents of every input of the dataset
+    """
+    digest = hashlib.sha256()
+    digest.update('format {}\n'.format(FORMAT_VERSION).encode())
+    hash_file(map_file, digest)
+    if exclude_file is not None:
+        digest.update(b'exclude\n')
+        hash_file(exclude_file, digest)
+    for f in sorted(os.listdir(cube_folder)):
+        digest.update('\ncube file {}\n'.format(f).encode())
+        hash_file(os.path.join(cube_folder, f), digest)
+    return digest.hexdigest()
+
+
+class Dataset:
+    """
+    param vocabulary: CardVocabulary of the card map
+    param corpus: CubeCorpus of the cube folder over that vocabulary
+    param path: cache directory of the dataset
+    """
+    def __init__(self, vocabulary, corpus, path):
+        self.vocabulary = vocabulary
+        self.corpus = corpus
+        self.path = path
+
+    @property
+    def key(self):
+        return os.path.basename(self.path)
+
+    def regularization_target(self, adj_file, dtype=np.float32):
+        """
+        return: the adjacency matrix in `adj_file` with ones on the
+            diagonal and every row normalized to sum to one, memory mapped
+            from the cache. The adjacency file is identified by its size
+            and modification time, hashing gigabytes of it would cost about
+            as much as recomputing the target.
+        """
+        stat = os.stat(adj_file)
+        signature = hashlib.sha256('{} {} {} {}'.format(
+            os.path.abspath(adj_file), stat.st_size, stat.st_mtime_ns,
+            np.dtype(dtype).name).encode()).hexdigest()[:16]
+
+        def rows(adj_mtx, chunk):
+            return np.array(adj_mtx[chunk], dtype=np.float64)
+
+        return self._target(signature, lambda: np.load(adj_file,
+                                                       mmap_mode='r'),
+                            rows, dtype)
+
+    def cubes_regularization_target(self, cubes, dtype=np.float32):
+        """
+        Like regularization_target, over the adjacency matrix of only the
+        cubes of the corpus at the indices `cubes`, e.g. those left to train
+        on once a validation split is held out.
+        """
+        cubes = np.asarray(cubes, dtype=np.int64)
+        digest = hashlib.sha256('cubes {}\n'.format(
+            np.dtype(dtype).name).encode())
+        digest.update(cubes.tobytes())
+        signature = digest.hexdigest()[:16]
+
+        def matrices():
+            csr = cooccurrence.as_sparse(self.corpus.take(cubes).to_csr())
+            return cooccurrence.contains(csr), csr
+
+        def rows(matrices, chunk):
+            contained, csr = matrices
+            return cooccurrence.normalize_rows(
+                cooccurrence.cooccurrence_rows(contained, csr, chunk),
+                np.arange(chunk.start, chunk.stop))
+
+        return self._target(signature, matrices, rows, dtype)
+
+    def _target(self, signature, load, rows, dtype, chunk_size=1024):
+        """
+        param load: returns the source of the adjacency matrix, only called
+            when the target isn't cached yet
+        param rows: (source, slice of rows) to those rows of the adjacency
+            matrix as a float64 array
+        """
+        path = os.path.join(self.path, REGULARIZATION.format(signature))
+        if not os.path.isfile(path):
+            source = load()
+            num_cards = self.corpus.num_cards
+            tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+            y_mtx = np.lib.format.open_memmap(tmp_path, mode='w+',
+                                              dtype=dtype,
+                                              shape=(num_cards, num_cards))
+            for start in range(0, num_cards, chunk_size):
+                chunk = slice(start, min(start + chunk_size, num_cards))
+                block = rows(source, chunk)
+                block[np.arange(len(block)), np.arange(chunk.start,
+                                                       chunk.stop)] = 1
+                y_mtx[chunk] = block / block.sum(1)[:, None]
+            y_mtx.flush()
+            del y_mtx
+            os.replace(tmp_path, path)
+        return np.load(path, mmap_mode='r')
+
+
+def build_dataset(map_file, cube_folder, exclude_file, path):
+    vocabulary = utils.get_vocabulary(map_file, exclude_file)
+    name_lookup = {
+        card_id: vocabulary.names[idx]
+        for card_id, idx in vocabulary.id_lookup.items()
+    }
+    corpus = utils.load_corpus(cube_folder, len(vocabulary), name_lookup,
+                               vocabulary.card_to_int)
+    # written aside and renamed, so a crashed build is never picked up
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    vocabulary.save(os.path.join(tmp_path, VOCABULARY))
+    corpus.save(os.path.join(tmp_path, CORPUS))
+    with open(os.path.join(tmp_path, 'inputs.json'), 'w') as f:
+        json.dump({
+            'map_file': map_file,
+            'cube_folder': cube_folder,
+            'exclude_file': exclude_file,
+        }, f)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # another run built the same dataset first
+        if not os.path.isdir(path):
+            raise
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    return Dataset(vocabulary, corpus, path)
+
+
+def load_dataset(map_file, cube_folder, exclude_file=None,
+                 cache_dir=CACHE_DIR):
+    """
+    return: the Dataset of the given inputs, from the cache when it has
+        been built before
+    """
+    path = os.path.join(cache_dir, input_key(map_file, cube_folder,
+                                             exclude_file))
+    if not os.path.isdir(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        return build_dataset(map_file, cube_folder, exclude_file, path)
+    return Dataset(
+        CardVocabulary.load(os.path.join(path, VOCABULARY)),
+        CubeCorpus.load(os.path.join(path, CORPUS)),
+        path,
+    )
@@ -0,0 +1,254 @@
+import time
+
+import numpy as np
+from scipy import sparse
+
+from non_ml import ranking
+from non_ml.corpus import CubeCorpus
+from non_ml.holdout import masked
+from non_ml.sparse_adjacency import SparseAdjacency, cut_scores, row_sum
+
+"""
+Offline evaluation of recommenders on held-out cubes (see holdout.HoldOut).
+
+Additions: a recommender is shown the cubes without their held-out cards
+and ranks every other card. Reported are recall@k and NDCG@k of the
+held-out cards.
+
+Cuts: a recommender is shown the whole cubes plus as many intruders as
+each has held-out cards, cards outside the cube drawn in proportion to
+how many cubes play them. Cut precision is the fraction of the lowest
+ranked cards of a cube, as many as it has intruders, that are intruders.
+
+Recommenders are scored a batch of cubes at a time, given as CSR card
+indices over their own vocabulary, and the time they take is reported as
+cubes per second. Held-out cards a recommender doesn't know count as
+misses.
+"""
+
+BATCH_SIZE = 256
+KS = (10, 50, 100)
+
+
+class ModelScorer:
+    """
+    param recommender: anything with `recommend_indices(indptr, indices)`,
+        e.g. the recommenders of ml.runtime. Low scores of cube cards are
+        the cuts, as in the web service.
+    """
+    def __init__(self, recommender):
+        self.recommender = recommender
+
+    def scores(self, indptr, indices):
+        return self.recommender.recommend_indices(indptr, indices)
+
+    def cut_scores(self, indptr, indices):
+        rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+        return self.scores(indptr, indices)[rows, indices]
+
+
+class AdjacencyScorer:
+    """
+    The simple_recs and simple_cuts baselines over a dense or sparse
+    adjacency matrix, for a batch at once: the cubes as a binary CSR matrix
+    times the adjacency matrix sums the rows of every cube's cards, what
+    row_sum gives for one cube.
+
+    param adj_mtx: dense (possibly memory mapped) matrix or SparseAdjacency
+    """
+    def __init__(self, adj_mtx):
+        self.adj_mtx = adj_mtx
+        num_cards = adj_mtx.shape[0] if isinstance(adj_mtx, np.ndarray) \
+            else adj_mtx.num_cards
+        if isinstance(adj_mtx, SparseAdjacency):
+            self.matrix = sparse.csr_matrix(
+                (np.asarray(adj_mtx.data, dtype=np.float32),
+                 adj_mtx.indices, adj_mtx.indptr),
+                shape=(num_cards, num_cards),
+            )
+            self.diagonal = adj_mtx.diagonal(np.arange(num_cards))
+        else:
+            self.matrix = adj_mtx
+            self.diagonal = np.asarray(np.diagonal(adj_mtx),
+                                       dtype=np.float32)
+        self.num_cards = num_cards
+
+    def scores(self, indptr, indices):
+        cubes = sparse.csr_matrix(
+            (np.ones(len(indices), dtype=np.float32), indices, indptr),
+            shape=(len(indptr) - 1, self.num_cards),
+        )
+        scores = cubes @ self.matrix
+        if sparse.issparse(scores):
+            scores = scores.toarray()
+        return np.asarray(scores, dtype=np.float32)
+
+    def cut_scores(self, indptr, indices):
+        rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+        # each card's link to itself is left out, as in cut_scores
+        return self.scores(indptr, indices)[rows, indices] - \
+            self.diagonal[indices]
+
+    def check(self, cubes, rtol=1e-4):
+        """
+        Compares the batched scores to the row_sum and cut_scores that
+        simple_recs and simple_cuts rank by, one cube at a time.
+
+        param cubes: CubeCorpus over the matrix's vocabulary
+        return: whether they agree on every cube
+        """
+        scores = self.scores(cubes.indptr, cubes.indices)
+        cuts = self.cut_scores(cubes.indptr, cubes.indices)
+        for i in range(len(cubes)):
+            cube = cubes.cube(i).astype(np.int64)
+            cube_cuts = cuts[cubes.indptr[i]:cubes.indptr[i + 1]]
+            if not (np.allclose(scores[i], row_sum(self.adj_mtx, cube),
+                                rtol=rtol, atol=1e-6) and
+                    np.allclose(cube_cuts, cut_scores(self.adj_mtx, cube),
+                                rtol=rtol, atol=1e-6)):
+                return False
+        return True
+
+
+def card_mapping(names, vocabulary):
+    """
+    return: int64 array of the index in `vocabulary` of every card name,
+        -1 for cards it doesn't know
+    """
+    mapping = np.full(len(names), -1, dtype=np.int64)
+    for i, name in enumerate(names):
+        idx = vocabulary.lookup(name)
+        if idx is not None:
+            mapping[i] = idx
+    return mapping
+
+
+def remap(corpus, mapping, num_cards):
+    """
+    return: `corpus` over another vocabulary, dropping the unknown cards.
+        Cards stay sorted within each cube only if the mapping preserves
+        their order, which nothing here relies on.
+    """
+    if mapping is None:
+        return corpus
+    known = mapping[corpus.indices] >= 0
+    dropped = masked(corpus, known)
+    return CubeCorpus(dropped.indptr, mapping[corpus.indices[known]],
+                      num_cards, corpus.ids)
+
+
+def draw_intruders(cubes, popularity, counts, rng=np.random,
+                   batch_size=BATCH_SIZE):
+    """
+    param cubes: CubeCorpus of the cubes
+    param popularity: (num_cards,) weights the intruders are drawn by
+    param counts: number of distinct intruders for every cube
+    return: CubeCorpus of the intruders of every cube, cards outside it
+        with a positive weight drawn without replacement (Gumbel top-k)
+    """
+    with np.errstate(divide='ignore'):
+        log_p = np.log(np.asarray(popularity, dtype=np.float64))
+    lists = []
+    for start in range(0, len(cubes), batch_size):
+        rows = np.arange(start, min(start + batch_size, len(cubes)))
+        keys = log_p - np.log(-np.log(rng.random_sample(
+            (len(rows), cubes.num_cards))))
+        keys[cubes.densify(rows, dtype=bool)] = -np.inf
+        top = ranking.top_k_matrix(keys, max(1, counts[rows].max()),
+                                   ordered=True)
+        for i, count in enumerate(counts[rows]):
+            # fewer cards than asked for are left outside small vocabularies
+            cards = top[i, :count]
+            lists.append(cards[np.isfinite(keys[i, cards])])
+    return CubeCorpus.from_index_lists(lists, cubes.num_cards, cubes.ids)
+
+
+def cut_precision(scores, indptr, intruder, rng=np.random):
+    """
+    param scores: cut scores of the cards of a batch of cubes, given as
+        CSR rows by `indptr`, low scores are cut first
+    param intruder: boolean per card, whether it is an intruder
+    param rng: breaks ties at random, a sparse adjacency scores many cards
+        0 and the intruders would always lose the ties to their positions
+    return: (B,) fraction of each cube's lowest scored cards, as many as it
+        has intruders, that are intruders (0 for cubes without any)
+    """
+    sizes = np.diff(indptr)
+    rows = np.repeat(np.arange(len(sizes)), sizes)
+    order = np.lexsort((rng.random_sample(len(rows)), scores, rows))
+    rank = np.empty(len(rows), dtype=np.int64)
+    rank[order] = np.arange(len(rows)) - indptr[rows]
+    counts = np.bincount(rows[intruder], minlength=len(sizes))
+    hits = np.bincount(rows[intruder & (rank < counts[rows])],
+                       minlength=len(sizes))
+    return hits / np.maximum(1, counts)
+
+
+def evaluate(scorer, hold_out, intruders, ks=KS, mapping=None,
+             num_cards=None, batch_size=BATCH_SIZE):
+    """
+    param scorer: ModelScorer or AdjacencyScorer
+    param hold_out: HoldOut over the dataset's vocabulary
+    param intruders: CubeCorpus of the intruders of every held-out cube
+    param mapping: card_mapping from the dataset's vocabulary to the
+        scorer's, None when they are the same
+    param num_cards: size of the scorer's vocabulary
+    return: {metric: value}, the means over the held-out cubes and the
+        cubes scored per second, for additions and cuts
+    """
+    if num_cards is None:
+        num_cards = hold_out.shown.num_cards
+    shown = remap(hold_out.shown, mapping, num_cards)
+    held = remap(hold_out.held, mapping, num_cards)
+    num_held = hold_out.held.sizes
+    intruders = remap(intruders, mapping, num_cards)
+    totals = {'recall@{}'.format(k): 0.0 for k in ks}
+    totals.update({'ndcg@{}'.format(k): 0.0 for k in ks})
+    totals['cut_precision'] = 0.0
+    seconds = cut_seconds = 0.0
+    cut_cubes = 0
+    # the same ties are broken the same way for every recommender
+    ties = np.random.RandomState(0)
+
+    for start in range(0, len(hold_out), batch_size):
+        rows = np.arange(start, min(start + batch_size, len(hold_out)))
+        batch = shown.take(rows)
+        started = time.perf_counter()
+        scores = scorer.scores(batch.indptr, batch.indices)
+        seconds += time.perf_counter() - started
+        exclude = batch.densify(dtype=bool)
+        relevant = held.densify(rows, dtype=bool)
+        for k in ks:
+            totals['recall@{}'.format(k)] += ranking.recall_at_k(
+                scores, relevant, k, exclude, num_held[rows]).sum()
+            totals['ndcg@{}'.format(k)] += ranking.ndcg_at_k(
+                scores, relevant, k, exclude, num_held[rows]).sum()
+
+        # the whole cube plus its intruders, intruders last in every cube
+        lists = [np.concatenate([cards, held.cube(i), intruders.cube(i)])
+                 for cards, i in zip(batch.index_lists(), rows)]
+        is_intruder = np.concatenate([
+            np.arange(len(cards)) >= len(cards) - len(intruders.cube(i))
+            for cards, i in zip(lists, rows)
+        ])
+        cubes = CubeCorpus(
+            np.concatenate([[0], np.cumsum([len(c) for c in lists])]),
+            np.concatenate(lists),
+            num_cards,
+        )
+        started = time.perf_counter()
+        cuts = scorer.cut_scores(cubes.indptr, cubes.indices)
+        cut_seconds += time.perf_counter() - started
+        precision = cut_precision(cuts, cubes.indptr, is_intruder, ties)
+        has_intruders = intruders.sizes[rows] > 0
+        totals['cut_precision'] += precision[has_intruders].sum()
+        cut_cubes += has_intruders.sum()
+
+    results = {
+        name: float(value / len(hold_out)) for name, value in totals.items()
+    }
+    results['cut_precision'] = float(totals['cut_precision'] /
+                                     max(1, cut_cubes))
+    results['cubes_per_second'] = len(hold_out) / seconds
+    results['cut_cubes_per_second'] = len(hold_out) / cut_seconds
+    return results
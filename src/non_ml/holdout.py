@@ -0,0 +1,118 @@
+import os
+import os.path
+
+import numpy as np
+
+from non_ml.corpus import CubeCorpus
+
+"""
+Held-out cubes and cards for scoring recommenders offline.
+
+A fraction of the cubes of the corpus is set aside, and every one of those
+cubes is split into the cards a recommender is shown and the cards it is
+expected to recommend. Both halves are CubeCorpus objects over the same
+cubes, so they are densified a batch at a time like the training data.
+"""
+
+# fraction of the cards of a held-out cube the recommender isn't shown
+HOLD_OUT = 0.2
+
+
+def split_cubes(corpus, fraction, rng=np.random, min_size=2):
+    """
+    param fraction: fraction of the cubes that is held out
+    param min_size: cubes with fewer cards are never held out, they can't
+        be split into shown and held-out cards
+    return: (train, held) sorted cube indices
+    """
+    eligible = np.flatnonzero(corpus.sizes >= min_size)
+    held = np.sort(rng.permutation(eligible)[:int(len(corpus) * fraction)])
+    train = np.setdiff1d(np.arange(len(corpus)), held)
+    return train, held
+
+
+def masked(corpus, mask):
+    """
+    return: a CubeCorpus with only the entries of corpus.indices that
+        `mask` is True for
+    """
+    rows = np.repeat(np.arange(len(corpus)), corpus.sizes)
+    indptr = np.zeros(len(corpus) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows[mask], minlength=len(corpus)), out=indptr[1:])
+    return CubeCorpus(indptr, corpus.indices[mask], corpus.num_cards,
+                      corpus.ids)
+
+
+def hold_out_cards(corpus, fraction=HOLD_OUT, rng=np.random):
+    """
+    Holds out max(1, int(size * fraction)) cards of every cube, drawn
+    uniformly without replacement.
+
+    return: (shown, held) CubeCorpus pair over the cubes of `corpus`
+    """
+    sizes = corpus.sizes
+    rows = np.repeat(np.arange(len(corpus)), sizes)
+    # the position of every card within its cube after shuffling the cubes
+    order = np.lexsort((rng.random_sample(len(rows)), rows))
+    rank = np.empty(len(rows), dtype=np.int64)
+    rank[order] = np.arange(len(rows)) - corpus.indptr[rows]
+    counts = np.maximum(1, (sizes * fraction).astype(np.int64))
+    held = rank < counts[rows]
+    return masked(corpus, ~held), masked(corpus, held)
+
+
+class HoldOut:
+    """
+    param cubes: indices of the held-out cubes in the full corpus
+    param shown: CubeCorpus of the cards of those cubes a recommender sees
+    param held: CubeCorpus of the cards it should recommend
+    """
+    SHOWN = 'shown'
+    HELD = 'held'
+    CUBES = 'cubes.npy'
+
+    def __init__(self, cubes, shown, held):
+        self.cubes = cubes
+        self.shown = shown
+        self.held = held
+
+    @classmethod
+    def from_corpus(cls, corpus, fraction, rng=np.random,
+                    card_fraction=HOLD_OUT):
+        """
+        return: (train, hold_out), the indices of the cubes left to train
+            on and the HoldOut of the others
+        """
+        train, cubes = split_cubes(corpus, fraction, rng)
+        shown, held = hold_out_cards(corpus.take(cubes), card_fraction, rng)
+        return train, cls(cubes, shown, held)
+
+    @classmethod
+    def load(cls, path):
+        return cls(
+            np.load(os.path.join(path, cls.CUBES)),
+            CubeCorpus.load(os.path.join(path, cls.SHOWN)),
+            CubeCorpus.load(os.path.join(path, cls.HELD)),
+        )
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.shown.save(os.path.join(path, self.SHOWN))
+        self.held.save(os.path.join(path, self.HELD))
+        dest = os.path.join(path, self.CUBES)
+        with open(dest + '.tmp', 'wb') as f:
+            np.save(f, self.cubes)
+        os.replace(dest + '.tmp', dest)
+
+    def __len__(self):
+        return len(self.cubes)
+
+    def batches(self, batch_size, dtype=np.float32):
+        """
+        return: iterator of (shown, held) dense batches, the shown cards as
+            `dtype` and the held-out cards as a boolean mask
+        """
+        for start in range(0, len(self), batch_size):
+            rows = np.arange(start, min(start + batch_size, len(self)))
+            yield (self.shown.densify(rows, dtype=dtype),
+                   self.held.densify(rows, dtype=bool))
@@ -0,0 +1,132 @@
+import numpy as np
+
+
+def top_k(scores, k, exclude=None, largest=True):
+    """
+    Selects the k best entries of each row of `scores` without sorting the
+    whole row: an argpartition picks the k candidates and only those are
+    sorted, so a row costs O(N + k log k) rather than O(N log N).
+
+    param scores: (N,) vector or (B, N) batch of scores
+    param k: number of entries to return per row, None for all of them
+    param exclude: boolean mask shaped like scores, True entries are never
+        returned (e.g. the cards already in a cube)
+    param largest: rank highest scores first, or lowest first when False
+    return: for a vector, an array of at most k indices ordered best first.
+        For a batch, a list with such an array for every row.
+    """
+    scores = np.asarray(scores)
+    squeeze = scores.ndim == 1
+    keyed = np.atleast_2d(-scores if largest else scores).astype(np.float64)
+    if exclude is not None:
+        exclude = np.atleast_2d(exclude)
+        keyed[exclude] = np.inf
+
+    num_rows, num_items = keyed.shape
+    k = num_items if k is None else max(0, min(k, num_items))
+    if k < num_items:
+        candidates = np.argpartition(keyed, k, axis=1)[:, :k]
+    else:
+        candidates = np.broadcast_to(np.arange(num_items), keyed.shape)
+    order = np.argsort(np.take_along_axis(keyed, candidates, 1), axis=1,
+                       kind="stable")
+    ranked = np.take_along_axis(candidates, order, 1)
+
+    if exclude is None:
+        rows = list(ranked)
+    else:
+        # rows with fewer than k eligible entries were padded with excluded
+        # ones, and those always sort last
+        keep = ~np.take_along_axis(exclude, ranked, 1)
+        rows = [row[:n] for row, n in zip(ranked, keep.sum(1))]
+    return rows[0] if squeeze else rows
+
+
+def index_mask(indices, num_items):
+    """
+    param indices: an array of indices, or a list with one per row
+    return: boolean (num_items,) mask, or (rows, num_items) for a list,
+        that is True at the given indices
+    """
+    if isinstance(indices, np.ndarray):
+        mask = np.zeros(num_items, dtype=bool)
+        mask[indices] = True
+        return mask
+    mask = np.zeros((len(indices), num_items), dtype=bool)
+    rows = np.repeat(np.arange(len(indices)), [len(row) for row in indices])
+    if len(rows):
+        mask[rows, np.concatenate(indices)] = True
+    return mask
+
+
+def scored(indices, scores, names):
+    """
+    return: {name: score} for the given indices, in ranked order
+    """
+    return dict(zip(
+        [names[i] for i in indices.tolist()],
+        np.asarray(scores)[indices].tolist(),
+    ))
+
+
+def top_k_matrix(scores, k, exclude=None, ordered=False):
+    """
+    Like `top_k` for a whole batch, as one (B, k) array of indices. Rows
+    with fewer than k eligible entries are padded with excluded ones.
+
+    param k: at least 1
+    param ordered: rank the k entries best first, else leave them in any
+        order, which is all counting hits needs
+    """
+    if k < 1:
+        raise ValueError("k needs to be at least 1, got {}".format(k))
+    keyed = -np.asarray(scores, dtype=np.float64)
+    if exclude is not None:
+        keyed[exclude] = np.inf
+    k = min(k, keyed.shape[1])
+    if k < keyed.shape[1]:
+        top = np.argpartition(keyed, k - 1, axis=1)[:, :k]
+    else:
+        top = np.broadcast_to(np.arange(k), keyed.shape)
+    if ordered:
+        order = np.argsort(np.take_along_axis(keyed, top, 1), axis=1,
+                           kind="stable")
+        top = np.take_along_axis(top, order, 1)
+    return top
+
+
+def recall_at_k(scores, relevant, k, exclude=None, num_relevant=None):
+    """
+    Vectorized over a batch, without ranking more than the top k.
+
+    param scores: (B, N) batch of scores
+    param relevant: boolean (B, N) mask of the entries that should rank
+    param exclude: boolean (B, N) mask of entries that are never ranked
+    param num_relevant: (B,) number of relevant entries per row when some
+        can't be scored at all, by default those in `relevant`
+    return: (B,) fraction of the top k of each row that is relevant, out
+        of min(k, number of relevant entries), 0 for rows without any
+        relevant entry
+    """
+    if num_relevant is None:
+        num_relevant = relevant.sum(1)
+    top = top_k_matrix(scores, k, exclude)
+    hits = np.take_along_axis(relevant, top, 1).sum(1)
+    return hits / np.maximum(1, np.minimum(top.shape[1], num_relevant))
+
+
+def ndcg_at_k(scores, relevant, k, exclude=None, num_relevant=None):
+    """
+    Same arguments as `recall_at_k`.
+
+    return: (B,) normalized discounted cumulative gain of the top k of each
+        row with binary relevance, 0 for rows without any relevant entry
+    """
+    if num_relevant is None:
+        num_relevant = relevant.sum(1)
+    top = top_k_matrix(scores, k, exclude, ordered=True)
+    discounts = 1 / np.log2(np.arange(top.shape[1]) + 2)
+    dcg = (np.take_along_axis(relevant, top, 1) * discounts).sum(1)
+    ideal = np.concatenate([[0], np.cumsum(discounts)])
+    return dcg / np.maximum(ideal[np.minimum(top.shape[1], num_relevant)],
+                            discounts[-1])
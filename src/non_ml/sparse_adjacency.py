@@ -0,0 +1,258 @@
+# enable sibling imports
+if __name__ == "__main__":
+    from sys import path
+    from os.path import dirname as dir
+    path.append(dir(path[0]))
+
+import json
+import os
+import os.path
+import sys
+import time
+import warnings
+
+import numpy as np
+
+from non_ml import ranking
+from non_ml.corpus import csr_positions, index_dtype
+
+"""
+Keeps only the strongest links of every card of the adjacency matrix, as a
+CSR matrix stored one .npy file per array so it loads memory mapped in
+milliseconds:
+
+    python src/non_ml/sparse_adjacency.py output/full_adj_mtx.npy output/adj_topk 256 float16 [cube_folder map_file]
+
+keeps the 256 largest conditional probabilities of each card (pass a float
+below 1 instead to keep every value at or above that threshold), and reports
+how the rankings of simple_recs and simple_cuts change against the dense
+matrix, on the cubes in `cube_folder` when given, else on random cubes.
+The size and mtime of the dense matrix are recorded with the output, and
+load_adjacency falls back to the dense matrix once it has changed.
+"""
+
+ARRAYS = ("indptr", "indices", "data")
+SOURCE = "source.json"
+CHUNK_SIZE = 1024
+
+
+class SparseAdjacency:
+    def __init__(self, indptr, indices, data):
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.num_cards = len(indptr) - 1
+
+    @classmethod
+    def from_dense(cls, adj_mtx, k=None, threshold=None, dtype=np.float32,
+                   chunk_size=CHUNK_SIZE):
+        """
+        param adj_mtx: dense (num_cards, num_cards) matrix, may be memory
+            mapped as it is read a chunk of rows at a time
+        param k: number of largest entries kept per row
+        param threshold: smallest entry kept
+        param dtype: float32 or float16 values
+        return: SparseAdjacency of the positive entries passing both filters
+        """
+        num_cards = adj_mtx.shape[0]
+        counts = np.zeros(num_cards + 1, dtype=np.int64)
+        indices, data = [], []
+        for start in range(0, num_cards, chunk_size):
+            chunk = np.asarray(adj_mtx[start:start + chunk_size],
+                               dtype=np.float32)
+            if k is not None and k < num_cards:
+                cols = np.argpartition(-chunk, k - 1, axis=1)[:, :k]
+                cols.sort(axis=1)
+            else:
+                cols = np.broadcast_to(np.arange(num_cards), chunk.shape)
+            values = np.take_along_axis(chunk, cols, 1)
+            keep = values > 0
+            if threshold is not None:
+                keep &= values >= threshold
+            counts[start + 1:start + 1 + len(chunk)] = keep.sum(1)
+            indices.append(cols[keep])
+            data.append(values[keep])
+        return cls(
+            np.cumsum(counts),
+            np.concatenate(indices).astype(index_dtype(num_cards)),
+            np.concatenate(data).astype(dtype),
+        )
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        return cls(*[
+            np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+            for name in ARRAYS
+        ])
+
+    def save(self, path, source=None):
+        """
+        param source: the dense matrix file this was built from, recorded
+            so is_stale can tell when it changes
+        """
+        os.makedirs(path, exist_ok=True)
+        for name in ARRAYS:
+            dest = os.path.join(path, name + ".npy")
+            with open(dest + ".tmp", "wb") as f:
+                np.save(f, getattr(self, name))
+            os.replace(dest + ".tmp", dest)
+        dest = os.path.join(path, SOURCE)
+        if source is None:
+            if os.path.isfile(dest):
+                os.remove(dest)
+            return
+        stat = os.stat(source)
+        with open(dest + ".tmp", "w") as f:
+            json.dump({"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}, f)
+        os.replace(dest + ".tmp", dest)
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in ARRAYS)
+
+    def row_sum(self, rows):
+        """
+        return: (num_cards,) float32 sum of the given rows, what
+            adj_mtx[rows].sum(0) is for the dense matrix
+        """
+        positions, _ = csr_positions(self.indptr, np.asarray(rows, np.int64))
+        return np.bincount(
+            self.indices[positions],
+            weights=self.data[positions],
+            minlength=self.num_cards,
+        ).astype(np.float32)
+
+    def diagonal(self, rows):
+        """
+        return: the stored link of each of `rows` to itself, 0 when dropped
+        """
+        rows = np.asarray(rows, np.int64)
+        positions, lengths = csr_positions(self.indptr, rows)
+        own = self.indices[positions] == np.repeat(rows, lengths)
+        diag = np.zeros(len(rows), dtype=np.float32)
+        diag[np.repeat(np.arange(len(rows)), lengths)[own]] = \
+            self.data[positions[own]]
+        return diag
+
+
+def row_sum(adj_mtx, rows):
+    """
+    return: the sum of the given rows of a dense or sparse adjacency matrix
+    """
+    if isinstance(adj_mtx, SparseAdjacency):
+        return adj_mtx.row_sum(rows)
+    return adj_mtx[rows].sum(0)
+
+
+def cut_scores(adj_mtx, cube_contains):
+    """
+    return: for each card of the cube, the summed links from the other
+        cards of the cube to it, leaving out each card's link to itself
+    """
+    if isinstance(adj_mtx, SparseAdjacency):
+        return adj_mtx.row_sum(cube_contains)[cube_contains] - \
+            adj_mtx.diagonal(cube_contains)
+    sub_adj_mtx = adj_mtx[cube_contains][:, cube_contains]
+    return sub_adj_mtx.sum(0) - sub_adj_mtx.diagonal()
+
+
+def is_stale(sparse_path, dense_path):
+    """
+    return: whether the dense matrix has been written again since the
+        sparse one at `sparse_path` was built from it. Without a recorded
+        source, whether the dense matrix is the newer file.
+    """
+    if not os.path.isfile(dense_path):
+        return False
+    stat = os.stat(dense_path)
+    source = os.path.join(sparse_path, SOURCE)
+    if os.path.isfile(source):
+        with open(source) as f:
+            recorded = json.load(f)
+        return (stat.st_size, stat.st_mtime_ns) != \
+            (recorded["size"], recorded["mtime_ns"])
+    built = os.stat(os.path.join(sparse_path, ARRAYS[-1] + ".npy"))
+    return stat.st_mtime_ns > built.st_mtime_ns
+
+
+def load_adjacency(sparse_path, dense_path):
+    """
+    return: the sparse adjacency at `sparse_path` when it has been built
+        from the current dense matrix, else the memory mapped dense matrix
+    """
+    if os.path.isdir(sparse_path):
+        if not is_stale(sparse_path, dense_path):
+            return SparseAdjacency.load(sparse_path)
+        warnings.warn("{} is older than {}, using the dense matrix, rerun "
+                      "sparse_adjacency.py".format(sparse_path, dense_path))
+    return np.load(dense_path, mmap_mode='r')
+
+
+def ranking_agreement(dense, sparse, cubes, ks=(10, 50, 100)):
+    """
+    return: {k: (mean top k overlap of the recommendations, of the cuts)}
+        between the dense and the sparse adjacency
+    """
+    agreement = dict()
+    for k in ks:
+        recs, cuts = [], []
+        for cube in cubes:
+            exclude = ranking.index_mask(cube, dense.shape[0])
+            expected = ranking.top_k(row_sum(dense, cube), k, exclude=exclude)
+            actual = ranking.top_k(row_sum(sparse, cube), k, exclude=exclude)
+            recs.append(len(np.intersect1d(expected, actual)) /
+                        max(len(expected), 1))
+            expected = ranking.top_k(cut_scores(dense, cube), k,
+                                     largest=False)
+            actual = ranking.top_k(cut_scores(sparse, cube), k,
+                                   largest=False)
+            cuts.append(len(np.intersect1d(expected, actual)) /
+                        max(len(expected), 1))
+        agreement[k] = (float(np.mean(recs)), float(np.mean(cuts)))
+    return agreement
+
+
+if __name__ == "__main__":
+    from non_ml import utils
+
+    args = sys.argv[1:]
+    src = args[0]
+    dest = args[1]
+    keep = float(args[2]) if len(args) > 2 else 256
+    dtype = np.dtype(args[3]) if len(args) > 3 else np.float32
+
+    print('Loading Adjacency Matrix . . . \n')
+    adj_mtx = np.load(src, mmap_mode='r')
+
+    print('Sparsifying . . . \n')
+    if keep >= 1:
+        sparse = SparseAdjacency.from_dense(adj_mtx, k=int(keep), dtype=dtype)
+    else:
+        sparse = SparseAdjacency.from_dense(adj_mtx, threshold=keep,
+                                            dtype=dtype)
+    sparse.save(dest, source=src)
+    start = time.perf_counter()
+    sparse = SparseAdjacency.load(dest)
+    load_ms = (time.perf_counter() - start) * 1000
+    print('Wrote', dest)
+    print('Size: {:.1f}MB -> {:.1f}MB, loads in {:.1f}ms\n'.format(
+        adj_mtx.nbytes / 2 ** 20, sparse.nbytes / 2 ** 20, load_ms))
+
+    if len(args) > 5:
+        num_cards, name_lookup, card_to_int, _ = utils.get_card_maps(args[5])
+        corpus = utils.load_corpus(args[4], num_cards, name_lookup,
+                                   card_to_int)
+        cubes = [cube for cube in corpus.index_lists(range(min(len(corpus),
+                                                               256)))
+                 if len(cube)]
+    else:
+        rng = np.random.RandomState(0)
+        cube_size = min(360, sparse.num_cards)
+        cubes = [np.sort(rng.choice(sparse.num_cards, cube_size,
+                                    replace=False))
+                 for _ in range(256)]
+
+    print('Comparing Rankings on', len(cubes), 'Cubes . . . \n')
+    for k, (recs, cuts) in ranking_agreement(adj_mtx, sparse, cubes).items():
+        print('top {} agreement: recs {:.4f}, cuts {:.4f}'.format(k, recs,
+                                                                 cuts))
@@ -1,54 +1,60 @@
+# enable sibling imports
+if __name__ == "__main__":
+    from sys import path
+    from os.path import dirname as dir
+    path.append(dir(path[0]))
+
+import argparse
+import json
+import logging
 import os
 import os.path
-import urllib.request
-import unidecode
-import utils
-import numpy as np
-import json
+from non_ml import cubelist, utils
+from non_ml.crawler import CubeCrawler
+
+"""
+Downloads the current card list of every cube in data/cube:
+
+    python src/non_ml/update_data.py [--incremental] [--workers 16]
 
-def get_cards(cube_name, root = "https://cubecobra.com"):
-    url = root + "/cube/api/cubelist/" + cube_name
-    fp = urllib.request.urlopen(url)
-    mybytes = fp.read()
-    mystr = mybytes.decode("utf8")
-    fp.close()
-    return mystr.split("\n")
+The crawl is checkpointed to output/crawl as it goes, run the same command
+again to resume it. Once a crawl has finished, running it again starts a
+new pass, and with --incremental that pass only downloads the cubes that
+changed. The result is written as a sparse CubeCorpus to
+output/crawl/corpus, with the card names in output/int_to_card_new.json.
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--folder', default='././data/cube/')
+parser.add_argument('--out', default='././output/crawl')
+parser.add_argument('--root', default=cubelist.ROOT)
+parser.add_argument('--workers', type=int, default=16)
+parser.add_argument('--retries', type=int, default=3)
+parser.add_argument('--incremental', action='store_true')
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.INFO)
 
-map_file = '././data/maps/nameToId.json'
-folder = "././data/cube/"
 print('getting data')
-num_cards, name_lookup, card_to_int, int_to_card = \
-    utils.get_card_maps(map_file)
-
-num_cubes = utils.get_num_cubes(folder)
-
-card_to_int = dict()
-card_max = 0
-
-cubes = np.zeros((num_cubes,num_cards))
-counter = 0
-for f in os.listdir(folder):
-    full_path = os.path.join(folder,f)
-    contents = json.load(open(full_path,'rb'))
-    for cube in contents:
-        identifier = cube['_id']
-        print(counter,identifier)
-        cards = get_cards(identifier)
-        for card in cards:
-            card_idx = card_to_int.get(card)
-            if card_idx is None:
-                card_idx = card_max
-                card_to_int[card] = card_max
-                card_max += 1
-            cubes[counter,card_idx] = 1
-        counter+=1
-
-int_to_card = {v:k for k,v in card_to_int.items()}
+cube_ids = [cube['_id'] for cube in utils.iter_cubes(args.folder)]
+
+crawler = CubeCrawler(
+    args.out,
+    root=args.root,
+    workers=args.workers,
+    retries=args.retries,
+    incremental=args.incremental,
+)
+print('crawling', len(cube_ids), 'cubes')
+stats = crawler.crawl(cube_ids)
+print(stats)
+
+corpus = crawler.finish(cube_ids)
+print('wrote', len(corpus), 'cubes with', corpus.num_cards, 'cards')
 
 dest = '././output'
 if not os.path.isdir(dest):
     os.makedirs('././output')
-with open('././output/cubes.npy', 'wb') as out_mtx:
-    np.save(out_mtx, cubes)
 with open('././output/int_to_card_new.json', 'w') as out_lookup:
-    json.dump(int_to_card, out_lookup)
\ No newline at end of file
+    json.dump({i: name for name, i in crawler.card_to_int.items()},
+              out_lookup)
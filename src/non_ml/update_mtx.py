@@ -0,0 +1,78 @@
+# enable sibling imports
+if __name__ == "__main__":
+    from sys import path
+    from os.path import dirname as dir
+    path.append(dir(path[0]))
+
+import json
+import sys
+
+from non_ml import cooccurrence, utils
+
+"""
+Applies changes to the cube corpus to the adjacency matrix written by
+create_mtx.py, without recounting the cubes that didn't change:
+
+    python src/non_ml/update_mtx.py changes.json [changes.json ...]
+
+Each file holds
+
+    {
+        "added": [cube, ...],
+        "removed": [cube id, ...],
+        "edited": [{"_id": ..., "added": [card, ...], "removed": [card, ...]}]
+    }
+
+where cubes are shaped like the ones in data/cube (an added cube with a
+known id replaces it) and cards like the entries of their "cards" list.
+Edits are applied in order, so a cube can be edited more than once. The
+matrix the last run wrote is loaded and only the rows of the cards that
+changed are normalized again, unless it no longer matches the saved counts.
+The card map must be the one create_mtx.py ran with. Rerun
+sparse_adjacency.py afterwards if the scripts use output/adj_topk.
+"""
+
+map_file = '././data/maps/nameToId.json'
+state_dir = '././output/cooccurrence'
+adj_mtx_file = '././output/full_adj_mtx.npy'
+
+
+def read_changes(change_file, name_lookup, card_to_int):
+    with open(change_file) as f:
+        changes = json.load(f)
+    added = {
+        cube['_id']: utils.cube_indices(cube, name_lookup, card_to_int)
+        for cube in changes.get('added', [])
+    }
+    edited = [
+        (
+            edit['_id'],
+            utils.cube_indices({'cards': edit.get('added', [])},
+                               name_lookup, card_to_int),
+            utils.cube_indices({'cards': edit.get('removed', [])},
+                               name_lookup, card_to_int),
+        )
+        for edit in changes.get('edited', [])
+    ]
+    return added, changes.get('removed', []), edited
+
+
+if __name__ == "__main__":
+    change_files = sys.argv[1:]
+
+    print('getting data')
+    num_cards, name_lookup, card_to_int, int_to_card = \
+        utils.get_card_maps(map_file)
+    state = cooccurrence.CooccurrenceState.load(state_dir)
+    if not state.load_adjacency(state_dir, adj_mtx_file):
+        print('matrix out of date, normalizing every row')
+
+    for change_file in change_files:
+        print('applying', change_file)
+        added, removed, edited = read_changes(change_file, name_lookup,
+                                              card_to_int)
+        state.apply(added, removed, edited)
+
+    print('updating matrix')
+    state.save(state_dir)
+    state.save_adjacency(state_dir, adj_mtx_file)
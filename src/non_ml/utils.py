@@ -1,11 +1,15 @@
 import json
 import os
+import subprocess
 import sys
 import numpy as np
+from non_ml import cooccurrence
+from non_ml.corpus import CubeCorpus, index_dtype
+from non_ml.vocabulary import load_name_vocabulary
 
 def exclude(card_file=None):
     if card_file is None:
-        return []
+        return set()
     BAD_NAMES = [
         'plains',
         'island',
@@ -21,31 +25,32 @@ def exclude(card_file=None):
     for cd in card_dict.values():
         for bf in BAD_FUNCTIONS:
             if bf(cd):
-                BAD_NAMES.append(cd.get['name_lower'])
-    return BAD_NAMES
+                BAD_NAMES.append(cd.get('name_lower'))
+    return set(BAD_NAMES)
+
+def get_vocabulary(map_file, exclude_file=None):
+    return load_name_vocabulary(map_file, exclude_file, exclude)
 
 def get_card_maps(map_file, exclude_file=None):
-    exclusions = exclude(exclude_file)
-    names = json.load(open(map_file,'rb'))
-    name_lookup = dict()
-    card_to_int = dict()
-    int_to_card = dict()
-    num_cards = 0
-    for name,ids in names.items():
-        if name in exclusions:
-            continue
-        card_to_int[name] = num_cards
-        for idx in ids:
-            name_lookup[idx] = name
-        num_cards += 1
-    int_to_card = {v:k for k,v in card_to_int.items()}
+    vocabulary = get_vocabulary(map_file, exclude_file)
+    name_lookup = {
+        card_id: vocabulary.names[idx]
+        for card_id, idx in vocabulary.id_lookup.items()
+    }
     return (
-        num_cards,
+        len(vocabulary),
         name_lookup,
-        card_to_int,
-        int_to_card
+        vocabulary.card_to_int,
+        vocabulary.int_to_card
     )
 
+def iter_cubes(cube_folder):
+    for f in os.listdir(cube_folder):
+        full_path = os.path.join(cube_folder,f)
+        contents = json.load(open(full_path,'rb'))
+        for cube in contents:
+            yield cube
+
 def get_num_cubes(cube_folder):
     num_cubes = 0
     for f in os.listdir(cube_folder):
@@ -54,39 +59,54 @@ def get_num_cubes(cube_folder):
         num_cubes += len(contents)
     return num_cubes
 
+def cube_indices(cube, name_lookup, card_to_int):
+    card_ids = []
+    for card in cube['cards']:
+        card_name = name_lookup.get(card['cardID'])
+        if card_name is not None:
+            card_id = card_to_int.get(card_name)
+            if card_id is not None:
+                card_ids.append(card_id)
+    return card_ids
+
+def load_corpus(cube_folder, num_cards, name_lookup, card_to_int):
+    """
+    Reads every cube in `cube_folder` in a single pass.
+
+    return: a CubeCorpus holding the card indices and the id of each cube
+    """
+    dtype = index_dtype(num_cards)
+    ids = []
+    index_lists = []
+    for cube in iter_cubes(cube_folder):
+        ids.append(cube.get('_id'))
+        index_lists.append(np.unique(np.array(
+            cube_indices(cube, name_lookup, card_to_int), dtype=dtype)))
+    return CubeCorpus.from_index_lists(index_lists, num_cards, ids)
+
 def build_cubes(cube_folder, num_cubes, num_cards, name_lookup, card_to_int):
-    cubes = np.zeros((num_cubes,num_cards))
-    counter = 0
-    for f in os.listdir(cube_folder):
-        full_path = os.path.join(cube_folder,f)
-        contents = json.load(open(full_path,'rb'))
-        for cube in contents:
-            card_ids = []
-            for card in cube['cards']:
-                card_name = name_lookup.get(card['cardID'])
-                if card_name is not None:
-                    card_id = card_to_int.get(card_name)
-                    if card_id is not None:
-                        card_ids.append(card_id)
-            cubes[counter,card_ids] = 1
-            counter += 1
-    return cubes
+    corpus = load_corpus(cube_folder, num_cards, name_lookup, card_to_int)
+    return corpus.densify(np.arange(num_cubes), dtype=np.float64)
+
+def create_adjacency_matrix(cubes, verbose=True, force_diag=None,
+                            chunk_size=cooccurrence.CHUNK_SIZE, workers=None):
+    return cooccurrence.adjacency_matrix(
+        cubes,
+        force_diag=force_diag,
+        chunk_size=chunk_size,
+        workers=workers,
+        verbose=verbose,
+    )
+
 
-def create_adjacency_matrix(cubes, verbose=True, force_diag=None):
-    num_cards = cubes.shape[1]
-    adj_mtx = np.empty((num_cards,num_cards))
-    for i in range(num_cards):
-        if verbose:
-            if i % 100 == 0:
-                print(i+1,"/",num_cards)
-        idxs = np.where(cubes[:,i] == 1)
-        cubes_w_cards = cubes[idxs]
-        step1 = cubes_w_cards.sum(0)
-        if step1[i] != 0:
-            step2 = step1/step1[i]
-        else:
-            step2 = step1
-        adj_mtx[i] = step2
-    if force_diag is not None:
-        np.fill_diagonal(adj_mtx,force_diag)
-    return adj_mtx
\ No newline at end of file
+def git_commit():
+    """
+    return: the commit checked out in the working directory, None outside
+        of a git checkout
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
@@ -0,0 +1,212 @@
+import hashlib
+import json
+import os
+import os.path
+from functools import lru_cache
+
+import numpy as np
+import unidecode
+
+# suffix of the compiled artifact written next to a JSON card map
+COMPILED_SUFFIX = ".vocab.npz"
+
+
+@lru_cache(maxsize=1 << 16)
+def normalize(name):
+    """
+    Normalizes a card name the way CubeCobra card lists are matched against
+    the vocabulary. Memoized since the same names show up in most cubes.
+    """
+    return unidecode.unidecode(name.lower())
+
+
+class CardVocabulary:
+    """
+    The mapping between card names and the indices used by the models and
+    adjacency matrices.
+
+    - `names[i]` is the name of card i
+    - `aliases` maps names and their normalized forms to indices
+    - `id_lookup` maps CubeCobra card ids to indices (only when built from
+        `nameToId.json`)
+    - `exclusions` holds the names that were left out of the vocabulary
+    """
+    def __init__(self, names, aliases=None, id_lookup=None, exclusions=()):
+        self.names = list(names)
+        if aliases is None:
+            aliases = dict()
+            for idx, name in enumerate(self.names):
+                aliases.setdefault(name, idx)
+                aliases.setdefault(normalize(name), idx)
+        self.aliases = aliases
+        self.id_lookup = dict() if id_lookup is None else id_lookup
+        self.exclusions = frozenset(exclusions)
+        # the plain lookups the scripts have always worked with
+        self.int_to_card = dict(enumerate(self.names))
+        self.card_to_int = {name: idx for idx, name in enumerate(self.names)}
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def from_id_map(cls, map_file):
+        """
+        param map_file: JSON object of {index: name}, e.g.
+            `ml_files/recommender_id_map.json` or `output/int_to_card.json`
+        """
+        with open(map_file, "r") as fp:
+            int_to_card = json.load(fp)
+        names = [None] * len(int_to_card)
+        for k, v in int_to_card.items():
+            names[int(k)] = v
+        return cls(names)
+
+    @classmethod
+    def from_name_map(cls, map_file, exclusions=()):
+        """
+        param map_file: JSON object of {name: [card ids]}, e.g.
+            `data/maps/nameToId.json`
+        param exclusions: names to leave out of the vocabulary
+        """
+        exclusions = set(exclusions)
+        with open(map_file, "rb") as fp:
+            name_map = json.load(fp)
+        names = []
+        id_lookup = dict()
+        for name, ids in name_map.items():
+            if name in exclusions:
+                continue
+            for card_id in ids:
+                id_lookup[card_id] = len(names)
+            names.append(name)
+        return cls(names, id_lookup=id_lookup, exclusions=exclusions)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a vocabulary written by `save`.
+        """
+        with np.load(path, allow_pickle=False) as data:
+            return cls(
+                data["names"].tolist(),
+                aliases=dict(zip(data["alias_names"].tolist(),
+                                 data["alias_indices"].tolist())),
+                id_lookup=dict(zip(data["card_ids"].tolist(),
+                                   data["card_id_indices"].tolist())),
+                exclusions=data["exclusions"].tolist(),
+            )
+
+    def save(self, path):
+        """
+        Writes the vocabulary as a compact, pickle free `.npz` artifact.
+        """
+        def strings(values):
+            return np.array(list(values), dtype=np.str_)
+
+        with open(path, "wb") as out:
+            np.savez(
+                out,
+                names=strings(self.names),
+                alias_names=strings(self.aliases.keys()),
+                alias_indices=np.fromiter(self.aliases.values(), np.int32,
+                                          len(self.aliases)),
+                card_ids=strings(self.id_lookup.keys()),
+                card_id_indices=np.fromiter(self.id_lookup.values(),
+                                            np.int32, len(self.id_lookup)),
+                exclusions=strings(sorted(self.exclusions)),
+            )
+
+    def lookup(self, name):
+        """
+        return: the index of a card name, None for unknown cards
+        """
+        idx = self.aliases.get(name)
+        if idx is None:
+            idx = self.aliases.get(normalize(name))
+        return idx
+
+    def resolve(self, card_names):
+        """
+        Resolves a whole card list, skipping unknown cards (e.g. custom cards).
+
+        return: int32 array of the indices of the known cards
+        """
+        aliases = self.aliases
+        indices = [aliases.get(normalize(name)) for name in card_names]
+        return np.fromiter((idx for idx in indices if idx is not None),
+                           dtype=np.int32)
+
+    def resolve_ids(self, card_ids):
+        """
+        Like `resolve`, for CubeCobra card ids instead of names.
+        """
+        id_lookup = self.id_lookup
+        indices = [id_lookup.get(card_id) for card_id in card_ids]
+        return np.fromiter((idx for idx in indices if idx is not None),
+                           dtype=np.int32)
+
+    def to_vector(self, card_names, dtype=np.float32):
+        """
+        return: the binary vector over the vocabulary of a card list
+        """
+        vector = np.zeros(len(self.names), dtype=dtype)
+        vector[self.resolve(card_names)] = 1
+        return vector
+
+
+def load_compiled(compiled, sources, build):
+    """
+    Loads the vocabulary artifact `compiled`, first building it with
+    `build()` when it is missing or any of the `sources` it is built from
+    is newer than it.
+    """
+    if os.path.isfile(compiled) and all(
+            os.path.getmtime(compiled) >= os.path.getmtime(source)
+            for source in sources):
+        return CardVocabulary.load(compiled)
+    vocabulary = build()
+    # write then rename so concurrent readers never see a partial file
+    tmp = "{}.{}.tmp".format(compiled, os.getpid())
+    try:
+        vocabulary.save(tmp)
+        os.replace(tmp, compiled)
+    except OSError:
+        # e.g. a read only image, loading from JSON still works
+        pass
+    return vocabulary
+
+
+def load_vocabulary(map_file):
+    """
+    Loads the vocabulary of an {index: name} JSON map, compiling it to a
+    binary artifact next to the JSON on first use. The artifact is rebuilt
+    whenever the JSON is newer than it.
+    """
+    return load_compiled(
+        os.path.splitext(map_file)[0] + COMPILED_SUFFIX,
+        [map_file],
+        lambda: CardVocabulary.from_id_map(map_file),
+    )
+
+
+def load_name_vocabulary(map_file, exclude_file=None, exclude=None):
+    """
+    Like load_vocabulary for a {name: [card ids]} map, e.g.
+    `data/maps/nameToId.json`. The artifact is kept per exclusions file and
+    rebuilt when either file is newer than it.
+
+    param exclude: function from `exclude_file` to the names to leave out,
+        only called when the artifact is rebuilt
+    """
+    stem = os.path.splitext(map_file)[0] + ".names"
+    sources = [map_file]
+    if exclude_file is not None:
+        digest = hashlib.sha1(os.path.abspath(exclude_file).encode())
+        stem += "-" + digest.hexdigest()[:8]
+        sources.append(exclude_file)
+    return load_compiled(
+        stem + COMPILED_SUFFIX,
+        sources,
+        lambda: CardVocabulary.from_name_map(
+            map_file, exclude(exclude_file) if exclude_file else ()),
+    )
@@ -1,17 +1,21 @@
-import urllib.request
+# enable sibling imports
+if __name__ == "__main__":
+    from sys import path
+    from os.path import dirname as dir
+    path.append(dir(path[0]))
+
 import sys
-import json
 import numpy as np
-import unidecode
+from non_ml import cubelist, ranking, vocabulary
+from non_ml.sparse_adjacency import cut_scores, load_adjacency
 
-def simple_cuts(cube, adj_mtx, int_to_card=None):
-    np.fill_diagonal(adj_mtx,0)
+def simple_cuts(cube, adj_mtx, int_to_card=None, amount=None):
     cube_contains = np.where(cube == 1)[0]
-    sub_adj_mtx = adj_mtx[cube_contains][:,cube_contains]
-    rec_ids = [
-        cube_contains[i] for i  in
-        sub_adj_mtx.sum(0).argsort()
-    ]
+    # leaves out each card's link to itself without touching adj_mtx
+    scores = cut_scores(adj_mtx, cube_contains)
+    rec_ids = cube_contains[
+        ranking.top_k(scores, amount, largest=False)
+    ].tolist()
     if int_to_card is None:
         return rec_ids
     else:
@@ -26,42 +30,26 @@ else:
 
 print('Getting Cube List . . . \n')
 
-url = "https://cubecobra.com/cube/api/cubelist/" + cube_name
-
-fp = urllib.request.urlopen(url)
-mybytes = fp.read()
-
-mystr = mybytes.decode("utf8")
-fp.close()
-
-card_names = mystr.split("\n")
+card_names = cubelist.get_cards(cube_name)
 
 print ('Loading Adjacency Matrix . . . \n')
 
-adj_mtx = np.load('././output/full_adj_mtx.npy')
+# the top-k links of each card when sparse_adjacency.py has written them,
+# else the full matrix. Both are memory mapped, so only the rows of the cards
+# in the cube are read from disk
+adj_mtx = load_adjacency('././output/adj_topk', '././output/full_adj_mtx.npy')
 
 print ('Loading Card Name Lookup . . . \n')
 
-int_to_card = json.load(open('././output/int_to_card.json','r'))
-int_to_card = {int(k):v for k,v in int_to_card.items()}
-card_to_int = {v:k for k,v in int_to_card.items()}
+card_vocab = vocabulary.load_vocabulary('././output/int_to_card.json')
 
 print ('Creating Cube Vector . . . \n')
 
-cube_indices = []
-for name in card_names:
-    idx = card_to_int.get(unidecode.unidecode(name.lower()))
-    #skip unknown cards (e.g. custom cards)
-    if idx is not None:
-        cube_indices.append(idx)
-
-cube = np.zeros(adj_mtx.shape[1])
-cube[cube_indices] = 1
+cube = card_vocab.to_vector(card_names, dtype=float)
 
 print ('Generating Recommendations . . . \n')
 
-recs = simple_cuts(cube, adj_mtx, int_to_card)
+recs = simple_cuts(cube, adj_mtx, card_vocab.names, amount)
 
-for i in range(amount):
-    rec = recs[i]
+for i, rec in enumerate(recs):
     print(str(i + 1) + ":", rec)
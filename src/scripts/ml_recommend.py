@@ -1,14 +1,18 @@
-import json
+# enable sibling imports
+if __name__ == "__main__":
+    from sys import path
+    from os.path import dirname as dir
+    path.append(dir(path[0]))
+
 import numpy as np
-import unidecode
-from tensorflow.keras.models import load_model
 import sys
-import urllib.request
+from ml.runtime import load_recommender, to_csr
+from non_ml import cubelist, ranking, vocabulary
 
 args = sys.argv[1:]
 cube_name = args[0]
 non_json = True
-root = "https://cubecobra.com"
+root = cubelist.ROOT
 if len(args) > 1:
     amount = int(args[1])
     if len(args) > 2:
@@ -19,39 +23,23 @@ else:
 
 print('Getting Cube List . . . \n')
 
-url = root + "/cube/api/cubelist/" + cube_name
-
-fp = urllib.request.urlopen(url)
-mybytes = fp.read()
-
-mystr = mybytes.decode("utf8")
-fp.close()
-
-card_names = mystr.split("\n")
+card_names = cubelist.get_cards(cube_name, root)
 
 print ('Loading Card Name Lookup . . . \n')
 
-int_to_card = json.load(open('ml_files/recommender_id_map.json','r'))
-int_to_card = {int(k):v for k,v in int_to_card.items()}
-card_to_int = {v:k for k,v in int_to_card.items()}
+card_vocab = vocabulary.load_vocabulary('ml_files/recommender_id_map.json')
+int_to_card = card_vocab.names
 
-num_cards = len(int_to_card)
+num_cards = len(card_vocab)
 
-print ('Creating Cube Vector . . . \n')
+print ('Resolving Cube List . . . \n')
 
-cube_indices = []
-for name in card_names:
-    idx = card_to_int.get(unidecode.unidecode(name.lower()))
-    #skip unknown cards (e.g. custom cards)
-    if idx is not None:
-        cube_indices.append(idx)
-
-cube = np.zeros(num_cards)
-cube[cube_indices] = 1
+cube_indices = np.unique(card_vocab.resolve(card_names))
 
 print('Loading Model . . . \n')
 
-model = load_model('ml_files/neg')
+# only needs tensorflow if the weights haven't been exported (ml/export.py)
+model = load_recommender('ml_files/neg')
 
 # def encode(model,data):
 #     return model.encoder.bottleneck(
@@ -75,42 +63,30 @@ model = load_model('ml_files/neg')
 #         )
 #     )
 
-def recommend(model,data):
-    encoded = model.encoder(data,training=False)
-    return model.decoder(encoded,training=False)
-
 print ('Generating Recommendations . . . \n')
 
-cube = np.array(cube,dtype=float).reshape(1,num_cards)
-results = recommend(model,cube)[0].numpy()
+results = model.recommend_indices(*to_csr([cube_indices]))[0]
 
-ranked = results.argsort()[::-1]
+additions = ranking.top_k(
+    results,
+    amount,
+    exclude=ranking.index_mask(cube_indices, num_cards),
+)
 
 output = {
     'additions':dict(),
-    'cuts':dict(),
+    'cuts':ranking.scored(cube_indices, results, int_to_card),
 }
 
-recommended = 0
-for rec in ranked:
-    if cube[0][rec] != 1:
-        card = int_to_card[rec]
-        if non_json:
-            print(card)
-        else:
-            output['additions'][card] = results[rec].item()
-        recommended += 1
-        if recommended >= amount:
-            break
-
-for idx in cube_indices:
-    card = int_to_card[idx]
-    output['cuts'][card] = results[idx].item()
+if non_json:
+    for rec in additions.tolist():
+        print(int_to_card[rec])
+else:
+    output['additions'] = ranking.scored(additions, results, int_to_card)
 
 if non_json:
-    cards = list(output['cuts'].keys())
-    vals = list(output['cuts'].values())
-    rank_cuts = np.array(vals).argsort()
-    out = [cards[idx] for idx in rank_cuts[:amount]]
+    rank_cuts = cube_indices[
+        ranking.top_k(results[cube_indices], amount, largest=False)
+    ]
     print('\n')
-    for i,item in enumerate(out): print(item,vals[rank_cuts[i]])
+    for idx in rank_cuts.tolist(): print(int_to_card[idx],results[idx])
@@ -1,35 +1,34 @@
-import json
-from tensorflow.keras.models import load_model
-from tensorflow.keras.losses import CosineSimilarity
+# enable sibling imports
+if __name__ == "__main__":
+    from sys import path
+    from os.path import dirname as dir
+    path.append(dir(path[0]))
+
 import sys
 import numpy as np
+from ml.runtime import load_recommender
+from non_ml import ranking, vocabulary
 
 args = sys.argv[1:]
 name = args[0].replace('_',' ')
 N = int(args[1])
 
-int_to_card = json.load(open('ml_files/recommender_id_map.json','r'))
-int_to_card = {int(k):v for k,v in int_to_card.items()}
-card_to_int = {v:k for k,v in int_to_card.items()}
-
-num_cards = len(int_to_card)
-
-model = load_model('ml_files/high_req')
+card_vocab = vocabulary.load_vocabulary('ml_files/recommender_id_map.json')
+int_to_card = card_vocab.names
 
-cards = np.zeros((num_cards,num_cards))
-np.fill_diagonal(cards,1)
+num_cards = len(card_vocab)
 
-dist_f = CosineSimilarity()
+model = load_recommender('ml_files/high_req')
 
-embs = model.encoder(cards)
-idx = card_to_int[name]
+# the encoding of every card on its own, without building the identity matrix
+embs = model.embed_cards()
+idx = card_vocab.lookup(name)
 
-dists = np.array([
-    dist_f(embs[idx],x).numpy() for x in embs
-])
+# negative cosine similarity, like keras' CosineSimilarity loss
+norms = np.maximum(np.linalg.norm(embs, axis=1), 1e-12)
+dists = -(embs @ embs[idx]) / (norms * norms[idx])
 
-ranked = dists.argsort()
+ranked = ranking.top_k(dists, N, largest=False)
 
-for i in range(N):
-    card_idx = ranked[i]
-    print(str(i + 1) + ":",int_to_card[card_idx],dists[card_idx])
\ No newline at end of file
+for i, card_idx in enumerate(ranked.tolist()):
+    print(str(i + 1) + ":",int_to_card[card_idx],dists[card_idx])
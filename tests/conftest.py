@@ -0,0 +1,6 @@
+import os.path
+import sys
+
+# the scripts import `non_ml` and `ml` from src/, the service is `web`
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "src")]
@@ -0,0 +1,79 @@
+"""
+A local stand-in for the CubeCobra cubelist API, used by the cubelist tests
+and by web/benchmark.py to drive the service end to end.
+"""
+import hashlib
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from non_ml.cubelist import CUBELIST_PATH
+
+
+class CubeListStub:
+    """
+    Serves `cubes` ({cube id: card names}) the way the CubeCobra cubelist
+    API does, from a thread of this process. Responses carry an ETag, and a
+    request sending it back gets a 304 while the cube is unchanged.
+
+    param latency: seconds every response is delayed by, to stand in for
+        the round trip to CubeCobra
+    """
+    def __init__(self, cubes, latency=0.0):
+        self.cubes = cubes
+        self.latency = latency
+        self.requests = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                stub.requests += 1
+                path = urllib.parse.urlparse(self.path).path
+                cards = None
+                if path.startswith(CUBELIST_PATH):
+                    cards = stub.cubes.get(urllib.parse.unquote(
+                        path[len(CUBELIST_PATH):]))
+                if stub.latency:
+                    time.sleep(stub.latency)
+                if cards is None:
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                body = "\n".join(cards).encode("utf8")
+                etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("ETag", etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+
+    @property
+    def root(self):
+        return "http://127.0.0.1:{}".format(self.server.server_address[1])
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
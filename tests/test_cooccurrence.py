@@ -0,0 +1,134 @@
+import numpy as np
+import pytest
+from scipy import sparse
+
+from non_ml import cooccurrence
+from non_ml.corpus import CubeCorpus
+
+NUM_CARDS = 30
+
+
+def loop_adjacency_matrix(cubes, force_diag=None):
+    # create_adjacency_matrix before it was vectorized
+    num_cards = cubes.shape[1]
+    adj_mtx = np.empty((num_cards, num_cards))
+    for i in range(num_cards):
+        idxs = np.where(cubes[:, i] == 1)
+        cubes_w_cards = cubes[idxs]
+        step1 = cubes_w_cards.sum(0)
+        if step1[i] != 0:
+            step2 = step1 / step1[i]
+        else:
+            step2 = step1
+        adj_mtx[i] = step2
+    if force_diag is not None:
+        np.fill_diagonal(adj_mtx, force_diag)
+    return adj_mtx
+
+
+@pytest.fixture
+def cubes():
+    rng = np.random.RandomState(0)
+    cubes = (rng.random_sample((40, 30)) < 0.3).astype(np.float64)
+    # a card in no cube, and entries that aren't 1
+    cubes[:, 7] = 0
+    cubes[3, 4] = 2
+    return cubes
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 1024])
+@pytest.mark.parametrize("force_diag", [None, 0])
+def test_adjacency_matrix_matches_loop(cubes, chunk_size, force_diag):
+    expected = loop_adjacency_matrix(cubes, force_diag)
+    actual = cooccurrence.adjacency_matrix(
+        cubes, force_diag, chunk_size=chunk_size, workers=2, verbose=False)
+    np.testing.assert_allclose(actual, expected)
+
+
+def test_adjacency_matrix_of_sparse_cubes(cubes):
+    np.testing.assert_allclose(
+        cooccurrence.adjacency_matrix(sparse.csr_matrix(cubes),
+                                      verbose=False),
+        loop_adjacency_matrix(cubes),
+    )
+
+
+def test_cooccurrence_counts(cubes):
+    binary = (cubes == 1).astype(np.int64)
+    expected = binary.T @ cubes
+    counts = cooccurrence.cooccurrence_counts(cubes, chunk_size=4,
+                                              verbose=False)
+    np.testing.assert_array_equal(counts, expected)
+
+
+def corpus_of(cubes):
+    ids = sorted(cubes)
+    return CubeCorpus.from_index_lists([cubes[i] for i in ids], NUM_CARDS,
+                                       ids)
+
+
+@pytest.fixture
+def card_lists():
+    rng = np.random.RandomState(2)
+    return {
+        "cube{}".format(i): np.flatnonzero(rng.random_sample(NUM_CARDS) < 0.3)
+        for i in range(20)
+    }
+
+
+def edit_cubes(cubes):
+    # the same changes apply() is given below, on plain card lists
+    cubes = dict(cubes)
+    del cubes["cube3"], cubes["cube8"]
+    cubes["new"] = np.array([0, 5, 7, 29])
+    cubes["cube1"] = np.array([1, 2, 3])
+    cubes["cube4"] = np.setdiff1d(np.union1d(cubes["cube4"], [6, 7]), [0, 1])
+    cubes["cube4"] = np.union1d(cubes["cube4"], [0])
+    cubes["fresh"] = np.array([11, 12])
+    return cubes
+
+
+@pytest.mark.parametrize("force_diag", [None, 0])
+def test_incremental_state_matches_rebuild(card_lists, force_diag):
+    state = cooccurrence.CooccurrenceState.from_corpus(
+        corpus_of(card_lists), chunk_size=8, verbose=False)
+    # the matrix is derived once before the changes, so only dirty rows
+    # are normalized again afterwards
+    state.adjacency(force_diag)
+    state.apply(
+        added={"new": [29, 0, 7, 5], "cube1": [3, 2, 1]},
+        removed=["cube3", "cube8", "missing"],
+        edited=[("cube4", [6, 7], [0, 1]), ("cube4", [0], []),
+                ("fresh", [11, 12], [])],
+    )
+
+    edited = corpus_of(edit_cubes(card_lists))
+    rebuilt = cooccurrence.CooccurrenceState.from_corpus(edited,
+                                                         verbose=False)
+    np.testing.assert_array_equal(state.counts, rebuilt.counts)
+    np.testing.assert_allclose(
+        state.adjacency(force_diag),
+        loop_adjacency_matrix(edited.densify(dtype=np.float64), force_diag),
+    )
+
+
+def test_saved_adjacency_is_reused_only_by_its_version(card_lists, tmp_path):
+    path = str(tmp_path / "state")
+    dest = str(tmp_path / "adj_mtx.npy")
+    state = cooccurrence.CooccurrenceState.from_corpus(
+        corpus_of(card_lists), verbose=False)
+    state.save(path)
+    state.save_adjacency(path, dest)
+
+    loaded = cooccurrence.CooccurrenceState.load(path)
+    assert loaded.load_adjacency(path, dest)
+    loaded.apply(removed=["cube0"])
+    expected = cooccurrence.CooccurrenceState.from_corpus(
+        corpus_of({k: v for k, v in card_lists.items() if k != "cube0"}),
+        verbose=False).adjacency()
+    np.testing.assert_allclose(loaded.adjacency(), expected)
+
+    # a newer version of the state doesn't take the older matrix
+    loaded.save(path)
+    assert not cooccurrence.CooccurrenceState.load(path).load_adjacency(
+        path, dest)
@@ -0,0 +1,132 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from non_ml import crawler, cubelist
+
+CUBES = {
+    "cube{}".format(i): ["Card {}".format((i * 7 + j) % 40)
+                         for j in range(5 + i % 4)]
+    for i in range(30)
+}
+
+
+KILLED = 3
+
+
+class FakeClient:
+    """
+    Serves CUBES, failing for `failing` cubes and killing the process
+    without any cleanup after `exit_after` fetches.
+    """
+    def __init__(self, cubes=CUBES, failing=(), exit_after=None):
+        self.cubes = cubes
+        self.failing = set(failing)
+        self.exit_after = exit_after
+        self.fetched = []
+
+    def fetch(self, cube_id, cached=None):
+        if self.exit_after is not None and \
+                len(self.fetched) >= self.exit_after:
+            os._exit(KILLED)
+        self.fetched.append(cube_id)
+        if cube_id in self.failing:
+            raise IOError("unavailable")
+        etag = str(hash(tuple(self.cubes[cube_id])))
+        if cached is not None and cached.etag == etag:
+            return cached.revalidated(), False
+        return cubelist.CubeListEntry(list(self.cubes[cube_id]), etag,
+                                      None), True
+
+
+def crawl_until_killed(out_dir, exit_after):
+    crawler.CubeCrawler(out_dir, workers=4, checkpoint_every=3,
+                        client=FakeClient(exit_after=exit_after)) \
+        .crawl(list(CUBES))
+
+
+def corpus_cubes(out_dir, corpus):
+    with open(os.path.join(out_dir, crawler.INT_TO_CARD)) as f:
+        int_to_card = json.load(f)
+    return {
+        cube_id: sorted(int_to_card[str(i)] for i in cards)
+        for cube_id, cards in zip(corpus.ids, corpus.index_lists())
+    }
+
+
+def expected_cubes(cubes=CUBES):
+    return {cube_id: sorted(cards) for cube_id, cards in cubes.items()}
+
+
+def test_resume_after_kill(tmp_path):
+    out_dir = str(tmp_path)
+    tests_dir = os.path.dirname(os.path.abspath(__file__))
+    code = "import conftest, test_crawler; " \
+        "test_crawler.crawl_until_killed({!r}, 17)"
+    result = subprocess.run([sys.executable, "-c", code.format(out_dir)],
+                            cwd=tests_dir)
+    assert result.returncode == KILLED
+
+    client = FakeClient()
+    resumed = crawler.CubeCrawler(out_dir, workers=4, client=client)
+    stats = resumed.crawl(list(CUBES))
+    # only what the killed run hadn't made durable is fetched again
+    assert 0 < len(client.fetched) < len(CUBES)
+    assert stats["fetched"] == len(client.fetched)
+    corpus = resumed.finish(list(CUBES))
+    assert corpus_cubes(out_dir, corpus) == expected_cubes()
+
+
+def test_records_without_their_cards_are_fetched_again(tmp_path):
+    out_dir = str(tmp_path)
+    crawler.CubeCrawler(out_dir, client=FakeClient()).crawl(list(CUBES))
+    # killed before the generation finished
+    crawler.write_json(os.path.join(out_dir, crawler.STATE),
+                       {"generation": 1, "finished": False})
+    with open(os.path.join(out_dir, crawler.CUBES_LOG), "a") as f:
+        # a record whose new card names never reached the cards log, and
+        # a line cut off by the kill
+        f.write(json.dumps({"_id": "cube3", "cards": [0, 999],
+                            "generation": 1}) + "\n")
+        f.write('{"_id": "cube4", "ca')
+
+    client = FakeClient()
+    resumed = crawler.CubeCrawler(out_dir, client=client)
+    assert resumed.pending(list(CUBES)) == ["cube3"]
+    resumed.crawl(list(CUBES))
+    assert client.fetched == ["cube3"]
+    corpus = resumed.finish()
+    assert corpus_cubes(out_dir, corpus) == expected_cubes()
+
+
+@pytest.mark.parametrize("incremental", [False, True])
+def test_failed_cubes_are_retried(tmp_path, incremental):
+    out_dir = str(tmp_path)
+    crawler.CubeCrawler(out_dir, incremental=incremental,
+                        client=FakeClient()).crawl(list(CUBES))
+    crawler.CubeCrawler(out_dir, incremental=incremental,
+                        client=FakeClient()).finish()
+
+    # the next generation can't reach two cubes
+    failing = FakeClient(failing={"cube1", "cube2"})
+    second = crawler.CubeCrawler(out_dir, incremental=incremental,
+                                 client=failing)
+    assert second.crawl(list(CUBES))["failed"] == 2
+    assert second.pending(list(CUBES)) == ["cube1", "cube2"]
+    corpus = second.finish(list(CUBES))
+    expected = expected_cubes()
+    if not incremental:
+        del expected["cube1"], expected["cube2"]
+    # an incremental corpus keeps their cards from the last generation
+    assert corpus_cubes(out_dir, corpus) == expected
+
+    client = FakeClient()
+    retry = crawler.CubeCrawler(out_dir, incremental=incremental,
+                                client=client)
+    retry.crawl(list(CUBES))
+    assert sorted(client.fetched) == ["cube1", "cube2"]
+    assert corpus_cubes(out_dir, retry.finish(list(CUBES))) == \
+        expected_cubes()
@@ -0,0 +1,85 @@
+import threading
+
+import pytest
+import requests
+
+from non_ml import cubelist
+from tests.cubelist_stub import CubeListStub
+
+CUBES = {
+    "pauper": ["Lightning Bolt", "Counterspell", "Opt"],
+    "vintage": ["Black Lotus", "Ancestral Recall"],
+    "with space": ["Jötun Grunt"],
+}
+
+
+@pytest.fixture
+def stub():
+    with CubeListStub({k: list(v) for k, v in CUBES.items()}) as stub:
+        yield stub
+
+
+def test_get_cards_is_cached(stub):
+    client = cubelist.CubeListClient(stub.root)
+    assert client.get_cards("pauper") == CUBES["pauper"]
+    assert client.get_cards("with space") == CUBES["with space"]
+    assert client.get_cards("pauper") == CUBES["pauper"]
+    assert stub.requests == 2
+
+    client.invalidate("pauper")
+    client.get_cards("pauper")
+    assert stub.requests == 3
+
+
+def test_stale_entries_are_revalidated(stub):
+    client = cubelist.CubeListClient(stub.root, ttl=0)
+    cached, modified = client.fetch("pauper")
+    assert modified and cached.etag
+    entry, modified = client.fetch("pauper", cached)
+    assert not modified and entry.cards == CUBES["pauper"]
+
+    assert client.get_cards("pauper") == CUBES["pauper"]
+    stub.cubes["pauper"] = ["Opt"]
+    # every call revalidates with ttl=0, and picks up the change
+    assert client.get_cards("pauper") == ["Opt"]
+    assert stub.requests == 4
+
+
+def test_concurrent_requests_share_a_fetch(stub):
+    stub.latency = 0.2
+    client = cubelist.CubeListClient(stub.root)
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(client.get_cards("vintage")))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [CUBES["vintage"]] * 8
+    assert stub.requests == 1
+
+
+def test_least_recently_used_cubes_are_evicted(stub):
+    client = cubelist.CubeListClient(stub.root, max_size=2)
+    for cube_id in ("pauper", "vintage", "pauper", "with space"):
+        client.get_cards(cube_id)
+    client.get_cards("pauper")
+    assert stub.requests == 3
+    client.get_cards("vintage")
+    assert stub.requests == 4
+
+
+def test_failures_raise_and_are_not_cached(stub):
+    client = cubelist.CubeListClient(stub.root)
+    with pytest.raises(requests.HTTPError):
+        client.get_cards("missing")
+    stub.cubes["missing"] = ["Opt"]
+    assert client.get_cards("missing") == ["Opt"]
+
+
+def test_root_per_request(stub):
+    client = cubelist.CubeListClient("http://127.0.0.1:9")
+    assert client.get_cards("vintage", root=stub.root) == CUBES["vintage"]
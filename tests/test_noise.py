@@ -0,0 +1,133 @@
+import numpy as np
+import pytest
+
+from ml import noise
+from non_ml.corpus import CubeCorpus
+
+NUM_CARDS = 120
+BATCHES = 400
+
+
+def loop_corrupt_batch(cubes, weights, noise_level=0.2, noise_std=0.1,
+                       rng=np.random):
+    # DataGenerator.generate_data before it was vectorized
+    p = weights / weights.sum()
+    cut_mask = np.zeros(cubes.shape)
+    add_mask = np.zeros(cubes.shape)
+    y_cut_mask = np.zeros(cubes.shape)
+    for i, cube in enumerate(cubes):
+        includes = np.where(cube == 1)[0]
+        excludes = np.where(cube == 0)[0]
+        size = len(includes)
+        level = np.clip(rng.normal(noise_level, noise_std), a_min=0.05,
+                        a_max=0.8)
+        flip_amount = int(size * level)
+        flip_include = rng.choice(includes, flip_amount)
+        neg_sampler = p[excludes] / p[excludes].sum()
+        flip_exclude = rng.choice(excludes, flip_amount, p=neg_sampler)
+        y_flip_include = rng.choice(flip_include, flip_amount // 4)
+        cut_mask[i, flip_include] = -1
+        y_cut_mask[i, y_flip_include] = -1
+        add_mask[i, flip_exclude] = 1
+    return cubes + cut_mask + add_mask, cubes + y_cut_mask
+
+
+@pytest.fixture
+def corpus():
+    rng = np.random.RandomState(0)
+    return CubeCorpus.from_index_lists([
+        np.sort(rng.choice(NUM_CARDS, size, replace=False))
+        for size in rng.randint(20, 60, 16)
+    ], NUM_CARDS)
+
+
+@pytest.fixture
+def weights():
+    weights = np.random.RandomState(1).zipf(1.5, NUM_CARDS).astype(np.float64)
+    weights[:3] = 0
+    return weights
+
+
+def corruption_stats(corrupt, cubes, batches=BATCHES):
+    """
+    return: per card frequencies of the cards cut from and added to the
+        inputs and cut from the targets, and the mean count of each per cube
+    """
+    cut, added, y_cut = (np.zeros(NUM_CARDS) for _ in range(3))
+    for _ in range(batches):
+        x, y = corrupt()
+        cut += (x < cubes).sum(0)
+        added += (x > cubes).sum(0)
+        y_cut += (y < cubes).sum(0)
+    num = batches * len(cubes)
+    return [(c / c.sum(), c.sum() / num) for c in (cut, added, y_cut)]
+
+
+def total_variation(p, q):
+    return 0.5 * np.abs(p - q).sum()
+
+
+def test_corrupt_batch_matches_the_loop(corpus, weights):
+    cubes = corpus.densify(dtype=np.float64)
+    sampler = noise.NegativeSampler(weights)
+    rng = np.random.RandomState(2)
+
+    def loop():
+        return corruption_stats(
+            lambda: loop_corrupt_batch(cubes, weights, rng=rng), cubes)
+
+    expected, again = loop(), loop()
+    actual = corruption_stats(
+        lambda: noise.corrupt_batch(corpus, np.arange(len(corpus)), sampler,
+                                    rng=rng, dtype=np.float64),
+        cubes)
+    # no further from the loop than two runs of the loop are from each other
+    for (expected_p, expected_mean), (again_p, _), (p, mean) in \
+            zip(expected, again, actual):
+        assert total_variation(p, expected_p) < \
+            1.5 * total_variation(again_p, expected_p)
+        assert mean == pytest.approx(expected_mean, rel=0.05)
+
+
+def test_corrupt_batch_only_flips_the_right_cards(corpus, weights):
+    cubes = corpus.densify()
+    x, y = noise.corrupt_batch(corpus, np.arange(len(corpus)),
+                               noise.NegativeSampler(weights),
+                               rng=np.random.RandomState(3))
+    assert set(np.unique(x)) <= {0, 1} and set(np.unique(y)) <= {0, 1}
+    # targets only lose cards the inputs lost as well
+    assert (y <= cubes).all()
+    assert (x[y < cubes] == 0).all()
+    # added cards are outside the cube and have a positive weight
+    added = x > cubes
+    assert not added[:, weights == 0].any()
+
+
+def test_negative_sampler_matches_choice(weights):
+    sampler = noise.NegativeSampler(weights)
+    rng = np.random.RandomState(4)
+    p = weights / weights.sum()
+    drawn = np.bincount(sampler.sample(200000, rng), minlength=NUM_CARDS)
+    expected = np.bincount(rng.choice(NUM_CARDS, 200000, p=p),
+                           minlength=NUM_CARDS)
+    assert drawn[weights == 0].sum() == 0
+    assert total_variation(drawn, expected) / 200000 < 0.01
+
+
+def test_sample_excluding(weights):
+    sampler = noise.NegativeSampler(weights)
+    excluded = np.zeros((3, NUM_CARDS), dtype=bool)
+    excluded[0, np.argsort(-weights)[:10]] = True
+    # nothing with a positive weight is left in the last row
+    excluded[2, 3:] = True
+    rows = np.repeat(np.arange(3), 20000)
+    cards, valid = sampler.sample_excluding(rows, excluded,
+                                            np.random.RandomState(5))
+    np.testing.assert_array_equal(valid, rows != 2)
+    assert not excluded[rows[valid], cards[valid]].any()
+
+    # the weights renormalized over the allowed cards
+    allowed = np.where(excluded[0], 0, weights)
+    counts = np.bincount(cards[rows == 0], minlength=NUM_CARDS)
+    assert total_variation(counts / counts.sum(),
+                           allowed / allowed.sum()) < 0.05
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+from non_ml import ranking
+
+
+@pytest.fixture
+def scores():
+    # distinct scores, so there is exactly one right ranking
+    return np.random.RandomState(0).permutation(8 * 50).reshape(8, 50) / 7.0
+
+
+@pytest.fixture
+def exclude(scores):
+    exclude = np.random.RandomState(1).random_sample(scores.shape) < 0.3
+    # a row with fewer eligible entries than asked for
+    exclude[2] = True
+    exclude[2, [4, 9]] = False
+    return exclude
+
+
+def ranked(scores, exclude, k, largest=True):
+    order = np.argsort(-scores if largest else scores, kind="stable")
+    return [row[~ex[row]][:k] for row, ex in zip(order, exclude)]
+
+
+@pytest.mark.parametrize("k", [0, 1, 10, 49, 50, 80, None])
+@pytest.mark.parametrize("largest", [True, False])
+def test_top_k_matches_argsort(scores, exclude, k, largest):
+    expected = ranked(scores, exclude, scores.shape[1] if k is None else k,
+                      largest)
+    actual = ranking.top_k(scores, k, exclude=exclude, largest=largest)
+    assert len(actual) == len(expected)
+    for row, expected_row in zip(actual, expected):
+        np.testing.assert_array_equal(row, expected_row)
+
+
+def test_top_k_of_a_vector(scores):
+    cube = np.array([3, 17])
+    actual = ranking.top_k(scores[0], 5,
+                           exclude=ranking.index_mask(cube, 50))
+    expected = ranked(scores[:1], ranking.index_mask([cube], 50), 5)[0]
+    np.testing.assert_array_equal(actual, expected)
+
+
+def test_top_k_ties_keep_the_best_scores():
+    scores = np.array([1.0, 3.0, 3.0, 3.0, 0.0, 2.0])
+    top = ranking.top_k(scores, 2)
+    np.testing.assert_array_equal(scores[top], [3.0, 3.0])
+
+
+@pytest.mark.parametrize("k", [1, 10, 50, 80])
+def test_top_k_matrix_matches_argsort(scores, exclude, k):
+    top = ranking.top_k_matrix(scores, k, exclude=exclude, ordered=True)
+    assert top.shape == (len(scores), min(k, scores.shape[1]))
+    for row, ex, expected in zip(top, exclude, ranked(scores, exclude, k)):
+        # eligible entries first, then the excluded padding
+        np.testing.assert_array_equal(row[:len(expected)], expected)
+        assert ex[row[len(expected):]].all()
+
+    unordered = ranking.top_k_matrix(scores, k, exclude=exclude)
+    np.testing.assert_array_equal(np.sort(unordered, 1), np.sort(top, 1))
+
+
+def test_recall_and_ndcg():
+    scores = np.array([[0.9, 0.8, 0.1, 0.7, 0.0]])
+    relevant = np.array([[False, True, True, False, False]])
+    exclude = np.array([[True, False, False, False, False]])
+    np.testing.assert_allclose(
+        ranking.recall_at_k(scores, relevant, 2, exclude), [0.5])
+    np.testing.assert_allclose(
+        ranking.ndcg_at_k(scores, relevant, 2, exclude),
+        [1 / (1 + 1 / np.log2(3))])
+
+
+@pytest.mark.parametrize("metric", [ranking.recall_at_k, ranking.ndcg_at_k])
+def test_metrics_reject_k_below_one(scores, metric):
+    with pytest.raises(ValueError):
+        metric(scores, scores > 3, 0)
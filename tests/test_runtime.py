@@ -0,0 +1,156 @@
+import os
+
+import numpy as np
+import pytest
+
+from ml import runtime
+from ml.quantize import quantize_weights
+
+NUM_CARDS = 300
+ENCODER_DIMS = [NUM_CARDS, 64, 32, 16, 8]
+
+
+@pytest.fixture
+def weights():
+    rng = np.random.RandomState(0)
+    weights = dict()
+    for part, layers, dims in (
+        ("encoder", runtime.ENCODER_LAYERS, ENCODER_DIMS),
+        ("decoder", runtime.DECODER_LAYERS, ENCODER_DIMS[::-1]),
+    ):
+        for (name, _), rows, cols in zip(layers, dims[:-1], dims[1:]):
+            weights[runtime.weight_key(part, name, "kernel")] = \
+                (rng.randn(rows, cols) / np.sqrt(rows)).astype(np.float32)
+            weights[runtime.weight_key(part, name, "bias")] = \
+                (rng.randn(cols) * 0.1).astype(np.float32)
+    return weights
+
+
+@pytest.fixture
+def cubes():
+    rng = np.random.RandomState(1)
+    cubes = [np.sort(rng.choice(NUM_CARDS, size, replace=False))
+             for size in (1, 40, 0, 120, 7)]
+    dense = np.zeros((len(cubes), NUM_CARDS), dtype=np.float32)
+    for row, cube in zip(dense, cubes):
+        row[cube] = 1
+    return cubes, dense
+
+
+def reference(weights, x):
+    # the forward pass of model.py in float64, over dequantized kernels
+    x = np.asarray(x, dtype=np.float64)
+    for part, layers in (("encoder", runtime.ENCODER_LAYERS),
+                         ("decoder", runtime.DECODER_LAYERS)):
+        for name, activation in layers:
+            kernel = weights[runtime.weight_key(part, name, "kernel")]
+            kernel = kernel.astype(np.float64)
+            scale = weights.get(runtime.weight_key(part, name, "scale"))
+            if scale is not None:
+                kernel = kernel * scale
+            x = x @ kernel + weights[runtime.weight_key(part, name, "bias")]
+            x = np.maximum(x, 0) if activation == "relu" \
+                else 1 / (1 + np.exp(-x))
+    return x
+
+
+@pytest.mark.parametrize("precision", ["float32", "float16", "int8"])
+def test_recommend_matches_reference(weights, cubes, precision,
+                                     monkeypatch):
+    # blocks smaller than the layers, tall and wide kernels alike
+    monkeypatch.setattr(runtime, "QUANTIZED_BLOCK_SIZE", 48)
+    if precision != "float32":
+        weights = quantize_weights(weights, precision)
+    recommender = runtime.NumpyRecommender(weights)
+    _, dense = cubes
+    scores = recommender.recommend(dense)
+    assert scores.dtype == np.float32
+    np.testing.assert_allclose(scores, reference(weights, dense),
+                               rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize("precision", ["float32", "float16", "int8"])
+@pytest.mark.parametrize("gather_block_size", [1, 50, 8192])
+def test_recommend_indices_matches_dense(weights, cubes, precision,
+                                         gather_block_size, monkeypatch):
+    monkeypatch.setattr(runtime, "GATHER_BLOCK_SIZE", gather_block_size)
+    if precision != "float32":
+        weights = quantize_weights(weights, precision)
+    recommender = runtime.NumpyRecommender(weights)
+    index_lists, dense = cubes
+    np.testing.assert_allclose(
+        recommender.recommend_indices(*runtime.to_csr(index_lists)),
+        recommender.recommend(dense),
+        rtol=1e-4, atol=1e-5,
+    )
+
+
+def test_embed_cards(weights):
+    recommender = runtime.NumpyRecommender(weights)
+    cards = np.array([0, 5, NUM_CARDS - 1])
+    np.testing.assert_allclose(
+        recommender.embed_cards(cards),
+        recommender.encode(np.eye(NUM_CARDS, dtype=np.float32)[cards]),
+        rtol=1e-5, atol=1e-6,
+    )
+
+
+@pytest.mark.parametrize("gather_block_size", [1, 4, 100])
+def test_sparse_rows_sum(gather_block_size, monkeypatch):
+    monkeypatch.setattr(runtime, "GATHER_BLOCK_SIZE", gather_block_size)
+    rng = np.random.RandomState(2)
+    matrix = rng.randint(-5, 5, (30, 4)).astype(np.int8)
+    index_lists = [rng.choice(30, size) for size in (3, 0, 0, 12, 1)]
+    expected = np.stack([matrix[cube].sum(0, dtype=np.float32)
+                         for cube in index_lists])
+    actual = runtime.sparse_rows_sum(matrix, *runtime.to_csr(index_lists),
+                                     dtype=np.float32)
+    np.testing.assert_array_equal(actual, expected)
+
+
+def test_save_and_load_weights(weights, cubes, tmp_path):
+    model_dir = str(tmp_path)
+    path = os.path.join(model_dir, runtime.WEIGHTS_FILE)
+    runtime.save_weights(quantize_weights(weights, "int8"), path)
+    # saving again publishes a new version and deletes the previous one
+    runtime.save_weights(weights, path)
+    version = runtime.WEIGHTS_FILE + ".v2"
+    assert sorted(os.listdir(model_dir)) == [runtime.WEIGHTS_FILE, version]
+    assert os.readlink(path) == version
+    assert runtime.model_file(model_dir) == path
+
+    recommender = runtime.load_recommender(model_dir)
+    _, dense = cubes
+    np.testing.assert_allclose(
+        recommender.recommend(dense),
+        runtime.NumpyRecommender(weights).recommend(dense),
+    )
+
+
+def test_save_weights_replaces_a_plain_directory(weights, tmp_path):
+    path = os.path.join(str(tmp_path), runtime.WEIGHTS_FILE)
+    os.makedirs(path)
+    np.save(os.path.join(path, "stale.npy"), np.zeros(1))
+    runtime.save_weights(weights, path)
+    assert os.path.islink(path)
+    assert sorted(runtime.load_weights(path)) == sorted(weights)
+
+
+def test_load_weights_rereads_a_deleted_version(weights, tmp_path,
+                                                monkeypatch):
+    path = os.path.join(str(tmp_path), runtime.WEIGHTS_FILE)
+    runtime.save_weights(weights, path)
+    newer = {key: value + 1 for key, value in weights.items()}
+    listdir = os.listdir
+
+    def save_while_listing(version):
+        # a save lands between resolving the link and opening the files
+        monkeypatch.setattr(os, "listdir", listdir)
+        files = listdir(version)
+        runtime.save_weights(newer, path)
+        return files
+
+    monkeypatch.setattr(os, "listdir", save_while_listing)
+    loaded = runtime.load_weights(path, mmap_mode=None)
+    for key, value in newer.items():
+        np.testing.assert_array_equal(loaded[key], value)
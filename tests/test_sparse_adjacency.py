@@ -0,0 +1,55 @@
+import os
+import warnings
+
+import numpy as np
+import pytest
+
+from non_ml import sparse_adjacency
+from non_ml.sparse_adjacency import SparseAdjacency
+
+
+@pytest.fixture
+def dense(tmp_path):
+    adj_mtx = np.random.RandomState(0).random_sample((20, 20))
+    path = str(tmp_path / "adj_mtx.npy")
+    np.save(path, adj_mtx)
+    return path
+
+
+def rewrite(path, seconds=10):
+    # a later write, whatever the resolution of the file system's clock
+    np.save(path, np.load(path) * 2)
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + seconds * 10 ** 9))
+
+
+def test_load_adjacency_of_the_current_matrix(dense, tmp_path):
+    sparse_path = str(tmp_path / "adj_topk")
+    SparseAdjacency.from_dense(np.load(dense), k=5).save(sparse_path,
+                                                         source=dense)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        loaded = sparse_adjacency.load_adjacency(sparse_path, dense)
+    assert isinstance(loaded, SparseAdjacency)
+    assert np.all(np.diff(loaded.indptr) == 5)
+
+
+def test_load_adjacency_falls_back_once_the_matrix_changes(dense, tmp_path):
+    sparse_path = str(tmp_path / "adj_topk")
+    SparseAdjacency.from_dense(np.load(dense), k=5).save(sparse_path,
+                                                         source=dense)
+    rewrite(dense)
+    assert sparse_adjacency.is_stale(sparse_path, dense)
+    with pytest.warns(UserWarning, match="rerun"):
+        loaded = sparse_adjacency.load_adjacency(sparse_path, dense)
+    np.testing.assert_array_equal(loaded, np.load(dense))
+
+
+def test_is_stale_without_a_recorded_source(dense, tmp_path):
+    sparse_path = str(tmp_path / "adj_topk")
+    SparseAdjacency.from_dense(np.load(dense), k=5).save(sparse_path)
+    # saved after the dense matrix
+    os.utime(dense, ns=(0, 0))
+    assert not sparse_adjacency.is_stale(sparse_path, dense)
+    rewrite(dense, seconds=10 ** 6)
+    assert sparse_adjacency.is_stale(sparse_path, dense)
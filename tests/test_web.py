@@ -0,0 +1,137 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+import web
+from ml import runtime
+from non_ml import cubelist
+from web import ml_recommend_web
+from web.model_registry import DEFAULT_MODEL, ID_MAP, ModelRegistry
+
+NUM_CARDS = 80
+CARDS = ["card{}".format(i) for i in range(NUM_CARDS)]
+CUBES = {"known": CARDS[:10]}
+
+
+def write_model(path, seed=0):
+    rng = np.random.RandomState(seed)
+    dims = [NUM_CARDS, 32, 16, 8, 4]
+    weights = dict()
+    for part, layers, part_dims in (
+        ("encoder", runtime.ENCODER_LAYERS, dims),
+        ("decoder", runtime.DECODER_LAYERS, dims[::-1]),
+    ):
+        for (name, _), rows, cols in zip(layers, part_dims[:-1],
+                                         part_dims[1:]):
+            weights[runtime.weight_key(part, name, "kernel")] = \
+                rng.randn(rows, cols).astype(np.float32)
+            weights[runtime.weight_key(part, name, "bias")] = \
+                rng.randn(cols).astype(np.float32)
+    os.makedirs(path, exist_ok=True)
+    runtime.save_weights(weights, os.path.join(path, runtime.WEIGHTS_FILE))
+    with open(os.path.join(path, ID_MAP), "w") as f:
+        json.dump({str(i): name for i, name in enumerate(CARDS)}, f)
+
+
+@pytest.fixture
+def registry(tmp_path, monkeypatch):
+    write_model(str(tmp_path / DEFAULT_MODEL))
+    registry = ModelRegistry(str(tmp_path), check_interval=None)
+    monkeypatch.setattr(web, "registry", registry)
+    monkeypatch.setattr(ml_recommend_web, "registry", registry)
+    return registry
+
+
+@pytest.fixture
+def client(registry, monkeypatch):
+    def get_cards(cube_name, root=cubelist.ROOT):
+        if cube_name not in CUBES:
+            raise LookupError("no cube " + cube_name)
+        return CUBES[cube_name]
+
+    monkeypatch.setattr(cubelist, "get_cards", get_cards)
+    return web.app.test_client()
+
+
+def test_bulk(client):
+    response = client.post("/bulk", json={
+        "cubes": [
+            {"cards": CUBES["known"]},
+            {"cube_name": "known"},
+            {"cube_name": "missing"},
+        ],
+        "num_recs": 5,
+    })
+    assert response.status_code == 200
+    by_cards, by_name, missing = response.get_json()["results"]
+    assert by_cards == by_name
+    assert len(by_cards["additions"]) == 5
+    assert not set(by_cards["additions"]) & set(CUBES["known"])
+    assert set(by_cards["cuts"]) == set(CUBES["known"])
+    assert "missing" in missing["error"]
+
+
+def test_bulk_num_recs_defaults_to_a_few(client):
+    response = client.post("/bulk", json={"cubes": [{"cards": []}]})
+    additions = response.get_json()["results"][0]["additions"]
+    assert len(additions) == ml_recommend_web.DEFAULT_BULK_RECS
+
+
+@pytest.mark.parametrize("body", [
+    None,
+    [],
+    {"cubes": {"cube_name": "known"}},
+    {"cubes": [{}]},
+    {"cubes": [{"cube_name": "known", "cards": []}]},
+    {"cubes": [{"cube_name": 7}]},
+    {"cubes": [{"cards": "card1"}]},
+    {"cubes": [{"cards": [1, 2]}]},
+    {"cubes": [{"cards": []}], "model": 3},
+    {"cubes": [{"cards": []}], "num_recs": 2.7},
+    {"cubes": [{"cards": []}], "num_recs": "5"},
+    {"cubes": [{"cards": []}], "num_recs": True},
+    {"cubes": [{"cards": []}], "num_recs": 0},
+    {"cubes": [{"cards": []}],
+     "num_recs": ml_recommend_web.MAX_BULK_RECS + 1},
+])
+def test_bulk_rejects_malformed_requests(client, body):
+    if body is None:
+        response = client.post("/bulk", data="{",
+                               content_type="application/json")
+    else:
+        response = client.post("/bulk", json=body)
+    assert response.status_code == 400
+
+
+def test_bulk_rejects_too_many_cubes(client, monkeypatch):
+    monkeypatch.setattr(ml_recommend_web, "MAX_BULK_CUBES", 2)
+    response = client.post("/bulk", json={"cubes": [{"cards": []}] * 3})
+    assert response.status_code == 400
+    assert b"At most 2 cubes" in response.data
+
+
+def test_get_batcher_follows_the_loaded_version(registry, tmp_path):
+    loaded = registry.get(DEFAULT_MODEL)
+    batcher = ml_recommend_web.get_batcher(loaded)
+    assert ml_recommend_web.get_batcher(loaded) is batcher
+    cube = np.arange(10)
+    np.testing.assert_allclose(batcher(cube),
+                               loaded.recommend_indices([cube])[0],
+                               rtol=1e-6)
+
+    write_model(str(tmp_path / DEFAULT_MODEL), seed=1)
+    reloaded = registry.load(DEFAULT_MODEL)
+    assert reloaded.version != loaded.version
+    new_batcher = ml_recommend_web.get_batcher(reloaded)
+    assert new_batcher is not batcher
+    np.testing.assert_allclose(new_batcher(cube),
+                               reloaded.recommend_indices([cube])[0],
+                               rtol=1e-6)
+    # the replaced batcher was closed, late callers are served directly
+    future = batcher.submit(cube)
+    assert future.done()
+    np.testing.assert_allclose(future.result(),
+                               loaded.recommend_indices([cube])[0],
+                               rtol=1e-6)
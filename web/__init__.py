@@ -1,12 +1,32 @@
 import logging
+import os
+import sys
 
-from flask import Flask, request, jsonify
+# enable imports of the shared modules in src/
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "src"))
 
-from .ml_recommend_web import get_ml_recommend
+from flask import Flask, Response, request, jsonify
+
+from .formats import FORMATS, JSON, MSGPACK, MSGPACK_MIMETYPE, pack
+from .ml_recommend_web import (
+    DEFAULT_BULK_RECS,
+    InvalidCursor,
+    get_bulk_ml_recommend,
+    get_ml_recommend,
+    registry,
+    validate_bulk_request,
+)
+from .model_registry import DEFAULT_MODEL
 
 
 app = Flask(__name__)
 
+# set by gunicorn.conf.py, so the models are loaded and memory mapped once in
+# the master process and shared by every forked worker
+if os.environ.get("RECOMMENDER_PRELOAD"):
+    registry.preload()
+
 if __name__ != "__main__":
     gunicorn_error_logger = logging.getLogger("gunicorn.error")
     app.logger.handlers.extend(gunicorn_error_logger.handlers)
@@ -18,6 +38,9 @@ def api():
     cube_name = request.args.get("cube_name")
     num_recs = request.args.get("num_recs", 30000)
     root = request.args.get("root", "https://www.cubecobra.com")
+    model_name = request.args.get("model", DEFAULT_MODEL)
+    fmt = request.args.get("format", JSON)
+    cursor = request.args.get("cursor")
     if not (cube_name and num_recs):
         error = "Need cube_name and num_recs as parameters!"
         app.logger.error(error)
@@ -28,14 +51,91 @@ def api():
         error = "num_recs needs to be an integer!"
         app.logger.error(error)
         return error
+    if num_recs < 1:
+        error = "num_recs needs to be at least 1!"
+        app.logger.error(error)
+        return error, 400
+    if fmt not in FORMATS:
+        error = "format needs to be one of " + ", ".join(FORMATS) + "!"
+        app.logger.error(error)
+        return error
+    if model_name not in registry.available():
+        error = "Unknown model: " + model_name
+        app.logger.error(error)
+        return error
 
     try:
-        results = get_ml_recommend(cube_name, num_recs, root)
+        results = get_ml_recommend(cube_name, num_recs, root,
+                                   model_name=model_name, fmt=fmt,
+                                   cursor=cursor)
+    except InvalidCursor as e:
+        error = str(e)
+        app.logger.error(error)
+        return error
     except Exception as e:
         app.logger.error(e)
         raise e
+    if fmt == MSGPACK:
+        return Response(pack(results), mimetype=MSGPACK_MIMETYPE)
     return jsonify(results)
 
 
+@app.route("/bulk", methods=["POST"])
+def bulk_api():
+    body = request.get_json(silent=True)
+    error = validate_bulk_request(body)
+    if error is not None:
+        app.logger.error(error)
+        return error, 400
+    model_name = body.get("model", DEFAULT_MODEL)
+    if model_name not in registry.available():
+        error = "Unknown model: " + model_name
+        app.logger.error(error)
+        return error
+
+    try:
+        results = get_bulk_ml_recommend(
+            body["cubes"],
+            body.get("num_recs", DEFAULT_BULK_RECS),
+            body.get("root", "https://www.cubecobra.com"),
+            model_name=model_name,
+        )
+    except Exception as e:
+        app.logger.error(e)
+        raise e
+    return jsonify({"results": results})
+
+
+@app.route("/models")
+def models():
+    return jsonify(registry.available())
+
+
+@app.route("/models/<model_name>/cards")
+def model_cards(model_name):
+    """
+    Card names by index, for decoding compact and msgpack responses.
+    """
+    if model_name not in registry.available():
+        error = "Unknown model: " + model_name
+        app.logger.error(error)
+        return error
+    loaded = registry.get(model_name)
+    return jsonify({
+        "version": loaded.version,
+        "cards": loaded.vocabulary.names,
+    })
+
+
+@app.route("/models/<model_name>/reload", methods=["POST"])
+def reload_model(model_name):
+    if model_name not in registry.available():
+        error = "Unknown model: " + model_name
+        app.logger.error(error)
+        return error
+    loaded = registry.load(model_name)
+    return jsonify({"model": loaded.name, "version": loaded.version})
+
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8000, threaded=True)
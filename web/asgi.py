@@ -0,0 +1,269 @@
+"""
+Async serving mode for the recommender API, next to the Flask app in
+`web/__init__.py`. Run it with
+
+    uvicorn web.asgi:app
+
+Upstream cube lists are fetched without blocking, so a single process can
+hold many requests waiting on CubeCobra. Model loading and ranking run in a
+bounded thread pool and inference goes through the same micro-batcher as the
+WSGI app.
+"""
+import asyncio
+import json
+import logging
+import os
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from non_ml.async_cubelist import AsyncCubeListClient
+
+from .formats import FORMATS, JSON, MSGPACK, MSGPACK_MIMETYPE, pack
+from .ml_recommend_web import (
+    DEFAULT_BULK_RECS,
+    InvalidCursor,
+    build_cube,
+    get_batcher,
+    merge_bulk_results,
+    rank_recommendations,
+    recommend_batch,
+    registry,
+    validate_bulk_request,
+)
+from .model_registry import DEFAULT_MODEL
+
+ROOT = "https://www.cubecobra.com"
+MAX_WORKERS = int(os.environ.get("RECOMMENDER_ASYNC_WORKERS", 4))
+
+logger = logging.getLogger(__name__)
+
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+cubelist_client = AsyncCubeListClient(root=ROOT)
+
+
+async def get_ml_recommend(cube_name, amount, root=ROOT,
+                           model_name=DEFAULT_MODEL, fmt=JSON, cursor=None):
+    loop = asyncio.get_running_loop()
+    card_names = await cubelist_client.get_cards(cube_name, root)
+    loaded = await loop.run_in_executor(executor, registry.get, model_name)
+    cube_indices = build_cube(loaded, card_names)
+    results = await asyncio.wrap_future(
+        get_batcher(loaded).submit(cube_indices))
+    return await loop.run_in_executor(
+        executor,
+        rank_recommendations,
+        loaded,
+        cube_indices,
+        results,
+        amount,
+        False,
+        fmt,
+        cursor,
+    )
+
+
+async def get_bulk_ml_recommend(cubes, amount, root=ROOT,
+                                model_name=DEFAULT_MODEL):
+    loop = asyncio.get_running_loop()
+
+    async def fetch(entry):
+        if "cards" in entry:
+            return entry["cards"]
+        try:
+            return await cubelist_client.get_cards(entry["cube_name"], root)
+        except Exception as e:
+            return e
+
+    card_lists = await asyncio.gather(*(fetch(entry) for entry in cubes))
+    loaded = await loop.run_in_executor(executor, registry.get, model_name)
+    return await loop.run_in_executor(
+        executor,
+        merge_bulk_results,
+        card_lists,
+        lambda found: recommend_batch(loaded, found, amount),
+    )
+
+
+async def api(query, body):
+    cube_name = query.get("cube_name")
+    num_recs = query.get("num_recs", 30000)
+    root = query.get("root", ROOT)
+    model_name = query.get("model", DEFAULT_MODEL)
+    fmt = query.get("format", JSON)
+    cursor = query.get("cursor")
+    if not (cube_name and num_recs):
+        error = "Need cube_name and num_recs as parameters!"
+        logger.error(error)
+        return error
+    try:
+        num_recs = int(num_recs)
+    except ValueError:
+        error = "num_recs needs to be an integer!"
+        logger.error(error)
+        return error
+    if num_recs < 1:
+        error = "num_recs needs to be at least 1!"
+        logger.error(error)
+        return error, 400
+    if fmt not in FORMATS:
+        error = "format needs to be one of " + ", ".join(FORMATS) + "!"
+        logger.error(error)
+        return error
+    if model_name not in registry.available():
+        error = "Unknown model: " + model_name
+        logger.error(error)
+        return error
+    try:
+        results = await get_ml_recommend(cube_name, num_recs, root,
+                                         model_name, fmt, cursor)
+    except InvalidCursor as e:
+        error = str(e)
+        logger.error(error)
+        return error
+    # msgpack responses are returned already encoded
+    return pack(results) if fmt == MSGPACK else results
+
+
+async def bulk_api(query, body):
+    try:
+        body = json.loads(body)
+    except ValueError:
+        body = None
+    error = validate_bulk_request(body)
+    if error is not None:
+        logger.error(error)
+        return error, 400
+    model_name = body.get("model", DEFAULT_MODEL)
+    if model_name not in registry.available():
+        error = "Unknown model: " + model_name
+        logger.error(error)
+        return error
+    results = await get_bulk_ml_recommend(
+        body["cubes"],
+        body.get("num_recs", DEFAULT_BULK_RECS),
+        body.get("root", ROOT),
+        model_name,
+    )
+    return {"results": results}
+
+
+async def models(query, body):
+    return registry.available()
+
+
+async def model_cards(query, body, model_name):
+    """
+    Card names by index, for decoding compact and msgpack responses.
+    """
+    if model_name not in registry.available():
+        error = "Unknown model: " + model_name
+        logger.error(error)
+        return error
+    loop = asyncio.get_running_loop()
+    loaded = await loop.run_in_executor(executor, registry.get, model_name)
+    return {
+        "version": loaded.version,
+        "cards": loaded.vocabulary.names,
+    }
+
+
+async def reload_model(query, body, model_name):
+    if model_name not in registry.available():
+        error = "Unknown model: " + model_name
+        logger.error(error)
+        return error
+    loop = asyncio.get_running_loop()
+    loaded = await loop.run_in_executor(executor, registry.load, model_name)
+    return {"model": loaded.name, "version": loaded.version}
+
+
+ROUTES = {
+    ("GET", "/"): api,
+    ("POST", "/bulk"): bulk_api,
+    ("GET", "/models"): models,
+}
+# /models/<model name>/<action>, as in the Flask app
+MODEL_ROUTES = {
+    ("GET", "cards"): model_cards,
+    ("POST", "reload"): reload_model,
+}
+
+
+def route(method, path):
+    """
+    return: the handler of the request and the arguments it takes after
+        the query and the body, (None, ()) when nothing serves it
+    """
+    handler = ROUTES.get((method, path))
+    if handler is not None:
+        return handler, ()
+    parts = path.split("/")
+    if len(parts) == 4 and parts[:2] == ["", "models"] and parts[2]:
+        handler = MODEL_ROUTES.get((method, parts[3]))
+        if handler is not None:
+            return handler, (parts[2],)
+    return None, ()
+
+
+async def read_body(receive):
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+    return body
+
+
+async def send_response(send, status, body, content_type):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type)],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await cubelist_client.close()
+            executor.shutdown(wait=False)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+
+    handler, args = route(scope["method"], scope["path"])
+    if handler is None:
+        return await send_response(send, 404, b"Not Found", b"text/plain")
+
+    query = urllib.parse.parse_qs(scope["query_string"].decode("latin-1"))
+    query = {k: v[0] for k, v in query.items()}
+    body = await read_body(receive)
+    try:
+        result = await handler(query, body, *args)
+    except Exception as e:
+        logger.error(e)
+        return await send_response(send, 500, b"Internal Server Error",
+                                   b"text/plain")
+    status = 200
+    if isinstance(result, tuple):
+        result, status = result
+    if isinstance(result, str):
+        # errors are plain strings, same as the Flask app
+        return await send_response(send, status, result.encode("utf8"),
+                                   b"text/html; charset=utf-8")
+    if isinstance(result, bytes):
+        return await send_response(send, 200, result,
+                                   MSGPACK_MIMETYPE.encode("ascii"))
+    await send_response(send, 200, json.dumps(result).encode("utf8"),
+                        b"application/json")
@@ -0,0 +1,105 @@
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+_CLOSE = object()
+
+
+class MicroBatcher:
+    """
+    Collects rows submitted by concurrent requests and runs them through
+    `predict` as a single batch.
+
+    A batch is dispatched as soon as it holds `max_batch_size` rows or the
+    oldest row in it has waited `max_wait_ms` milliseconds, whichever comes
+    first. Each caller gets back its own row of the batched output.
+
+    `collate` turns the list of submitted rows into the batch `predict`
+    takes, stacking them into a matrix by default.
+    """
+    def __init__(self, predict, max_batch_size=64, max_wait_ms=5,
+                 collate=np.stack):
+        self.predict = predict
+        self.collate = collate
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._thread = None
+        self._pid = None
+
+    def submit(self, row):
+        """
+        param row: one input row
+        return: a Future resolving to the matching 1d output row
+        """
+        future = Future()
+        with self._lock:
+            if self._closed:
+                # a newer batcher replaced this one, don't strand the caller
+                future.set_result(self.predict(self.collate([row]))[0])
+                return future
+            self._ensure_worker()
+            self._queue.put((row, future))
+        return future
+
+    def __call__(self, row):
+        return self.submit(row).result()
+
+    def close(self):
+        """
+        Stops the worker once everything already submitted has been served.
+        """
+        with self._lock:
+            if not self._closed:
+                self._closed = True
+                self._queue.put(_CLOSE)
+
+    def _ensure_worker(self):
+        # threads don't survive a fork, so start one per process on demand
+        if self._thread is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is _CLOSE:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self):
+        closing = False
+        while not closing:
+            item = self._queue.get()
+            if item is _CLOSE:
+                return
+            batch, closing = self._collect(item)
+            rows = self.collate([row for row, _ in batch])
+            try:
+                results = self.predict(rows)
+            except Exception as e:
+                logger.error("batched prediction failed: %s", e)
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for i, (_, future) in enumerate(batch):
+                future.set_result(results[i])
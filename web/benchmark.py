@@ -0,0 +1,413 @@
+"""
+Latency and throughput benchmarks of the serving path:
+
+    python -m web.benchmark [--model recommender] [--server gunicorn|flask]
+
+- stages: the steps of `get_ml_recommend` timed in process, on the model
+    loaded by the registry: vocabulary resolution, the cube build, the
+    encoder and decoder at batch sizes 1 to 1024, ranking, and the JSON
+    serialization of the response
+- end to end: the Flask app started in its own process(es) and driven over
+    HTTP, with the cube lists served by a local stub of the CubeCobra
+    cubelist API (tests/cubelist_stub.py, the `root` parameter points the
+    app at it), at every level of `--concurrency`
+
+Reported are the cold start (process start until the first recommendation),
+p50/p95/p99 latencies, requests per second and the RSS of every server
+process, split into anonymous memory and mapped files since memory mapped
+weights are shared between workers. Cubes are random draws from the model's
+vocabulary, the same ones for a given seed.
+
+Results are written as JSON to output/benchmarks/, and `--baseline` compares
+them to an earlier file and fails when a latency or throughput got worse by
+more than `--tolerance`.
+"""
+import argparse
+import datetime
+import json
+import os
+import os.path
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+from ml.runtime import to_csr
+from non_ml.utils import git_commit
+from tests.cubelist_stub import CubeListStub
+
+from .ml_recommend_web import build_cube, rank_recommendations, registry
+from .model_registry import DEFAULT_MODEL
+
+RESULTS = "./output/benchmarks"
+BATCH_SIZES = (1, 4, 16, 64, 256, 1024)
+PERCENTILES = (50, 95, 99)
+GUNICORN_CONF = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "gunicorn.conf.py")
+
+
+def summarize(seconds, items=1):
+    """
+    param seconds: duration of every call
+    param items: number of items (e.g. cubes) every call handles
+    return: {"p50_ms", "p95_ms", "p99_ms", "mean_ms", "per_second"}
+    """
+    ms = np.asarray(seconds) * 1000
+    summary = {
+        "p{}_ms".format(p): float(v)
+        for p, v in zip(PERCENTILES, np.percentile(ms, PERCENTILES))
+    }
+    summary["mean_ms"] = float(ms.mean())
+    summary["per_second"] = float(items * len(ms) / ms.sum() * 1000)
+    return summary
+
+
+def time_calls(fn, args, repeat, warmup=3):
+    """
+    return: the duration of `repeat` calls of fn, cycling through `args`,
+        after `warmup` untimed ones
+    """
+    for i in range(warmup):
+        fn(args[i % len(args)])
+    seconds = []
+    for i in range(repeat):
+        started = time.perf_counter()
+        fn(args[i % len(args)])
+        seconds.append(time.perf_counter() - started)
+    return seconds
+
+
+def memory(pid):
+    """
+    return: {"rss_mb", "rss_anon_mb", "rss_file_mb"} of a process from
+        /proc, None where that isn't available
+    """
+    fields = {"VmRSS:": "rss_mb", "RssAnon:": "rss_anon_mb",
+              "RssFile:": "rss_file_mb"}
+    try:
+        with open("/proc/{}/status".format(pid)) as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+    usage = dict()
+    for line in lines:
+        parts = line.split()
+        if parts and parts[0] in fields:
+            usage[fields[parts[0]]] = int(parts[1]) / 1024
+    return usage
+
+
+def process_tree(pid):
+    """
+    return: pid and the pids of all its descendants
+    """
+    pids = [pid]
+    for parent in pids:
+        try:
+            tasks = os.listdir("/proc/{}/task".format(parent))
+        except OSError:
+            continue
+        for task in tasks:
+            try:
+                with open("/proc/{}/task/{}/children".format(parent,
+                                                             task)) as f:
+                    pids.extend(int(child) for child in f.read().split())
+            except OSError:
+                pass
+    return pids
+
+
+def random_cubes(names, num_cubes, cube_size, seed=0):
+    """
+    return: {cube id: card names} of cubes drawn from `names`
+    """
+    rng = np.random.RandomState(seed)
+    cube_size = min(cube_size, len(names))
+    return {
+        "bench-{}".format(i): [
+            names[j] for j in rng.choice(len(names), cube_size, replace=False)
+        ]
+        for i in range(num_cubes)
+    }
+
+
+def bench_stages(loaded, cubes, repeat, batch_sizes=BATCH_SIZES,
+                 amount=100):
+    """
+    param loaded: the registry's LoadedModel
+    return: {stage: summary} of the steps of get_ml_recommend, run in this
+        process
+    """
+    results = dict()
+    card_lists = list(cubes.values())
+    model = loaded.model
+
+    results["resolve"] = summarize(time_calls(
+        loaded.vocabulary.resolve, card_lists, repeat))
+    results["build_cube"] = summarize(time_calls(
+        lambda names: build_cube(loaded, names), card_lists, repeat))
+    index_lists = [build_cube(loaded, names) for names in card_lists]
+
+    for batch_size in batch_sizes:
+        batches = [
+            to_csr([index_lists[(start + i) % len(index_lists)]
+                    for i in range(batch_size)])
+            for start in range(0, max(len(index_lists), batch_size),
+                               batch_size)
+        ]
+        # fewer repetitions of the big batches, about as many cubes
+        batch_repeat = max(3, repeat // batch_size)
+        encoded = [model.encode_indices(*batch) for batch in batches]
+        results["encoder_{}".format(batch_size)] = summarize(time_calls(
+            lambda batch: model.encode_indices(*batch), batches,
+            batch_repeat), batch_size)
+        results["decoder_{}".format(batch_size)] = summarize(time_calls(
+            model.decode, encoded, batch_repeat), batch_size)
+
+    scores = [loaded.recommend_indices([cube])[0] for cube in index_lists]
+    pairs = list(zip(index_lists, scores))
+    results["rank"] = summarize(time_calls(
+        lambda pair: rank_recommendations(loaded, pair[0], pair[1], amount),
+        pairs, repeat))
+    outputs = [rank_recommendations(loaded, cube, cube_scores, amount)
+               for cube, cube_scores in pairs]
+    results["serialize"] = summarize(time_calls(json.dumps, outputs, repeat))
+    return results
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(kind, port, workers, threads):
+    """
+    Starts the Flask app from the repository root, with gunicorn as in
+    production or with Flask's threaded development server.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, WEB_CONCURRENCY=str(workers),
+               RECOMMENDER_THREADS=str(threads))
+    if kind == "gunicorn":
+        command = [sys.executable, "-m", "gunicorn", "-c", GUNICORN_CONF,
+                   "-b", "127.0.0.1:{}".format(port), "web:app"]
+    else:
+        command = [sys.executable, "-c",
+                   "from web import app; app.run(host='127.0.0.1', "
+                   "port={}, threaded=True)".format(port)]
+    return subprocess.Popen(command, cwd=root, env=env,
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+
+
+def wait_until(fn, process, timeout):
+    """
+    Calls fn until it returns without raising.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        if process.poll() is not None:
+            raise RuntimeError("the server exited with code {}".format(
+                process.returncode))
+        try:
+            return fn()
+        except (requests.RequestException, ValueError):
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def load_test(url, params, num_requests, concurrency):
+    """
+    Sends num_requests GET requests to `url`, cycling through `params`,
+    from `concurrency` threads with a keep-alive session each.
+
+    return: summary of the latencies, with "errors" and "requests_per_second"
+        over the wall clock time of the whole run
+    """
+    local = threading.local()
+
+    def send(i):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        started = time.perf_counter()
+        try:
+            response = session.get(url, params=params[i % len(params)])
+            # errors are reported as plain text by the app
+            ok = response.status_code == 200 and response.headers.get(
+                "Content-Type", "").startswith("application/json")
+        except requests.RequestException:
+            ok = False
+        return time.perf_counter() - started, ok
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        timings = list(executor.map(send, range(num_requests)))
+    wall = time.perf_counter() - started
+    seconds = [s for s, ok in timings if ok]
+    summary = summarize(seconds) if seconds else dict()
+    # the inverse latency of a single client, not the server's throughput
+    summary.pop("per_second", None)
+    summary["errors"] = sum(not ok for _, ok in timings)
+    summary["requests_per_second"] = len(seconds) / wall
+    return summary
+
+
+def bench_end_to_end(args, cubes):
+    """
+    return: cold start, load test summaries per concurrency and the memory
+        of every server process
+    """
+    port = free_port()
+    url = "http://127.0.0.1:{}/".format(port)
+    with CubeListStub(cubes, args.stub_latency_ms / 1000) as stub:
+        params = [
+            {"cube_name": cube_id, "num_recs": args.num_recs,
+             "root": stub.root, "model": args.model}
+            for cube_id in cubes
+        ]
+        started = time.perf_counter()
+        process = start_server(args.server, port, args.workers, args.threads)
+        try:
+            wait_until(lambda: requests.get(url + "models").raise_for_status(),
+                       process, args.timeout)
+            ready = time.perf_counter() - started
+
+            def first():
+                response = requests.get(url, params=params[0])
+                response.raise_for_status()
+                return response.json()
+
+            wait_until(first, process, args.timeout)
+            results = {
+                "ready_seconds": ready,
+                "cold_start_seconds": time.perf_counter() - started,
+            }
+            # every worker loads its model and fetches each cube once
+            load_test(url, params, len(params), args.concurrency[-1])
+            for concurrency in args.concurrency:
+                results["concurrency_{}".format(concurrency)] = load_test(
+                    url, params, args.requests, concurrency)
+            results["memory"] = {
+                str(pid): memory(pid) for pid in process_tree(process.pid)
+            }
+            results["stub_requests"] = stub.requests
+        finally:
+            process.terminate()
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+    return results
+
+
+def compare(current, baseline, tolerance, path=""):
+    """
+    return: a line for every latency (_ms, _seconds) that grew or
+        throughput (per_second) that shrank by more than `tolerance` from
+        `baseline`
+    """
+    regressions = []
+    for key, value in current.items():
+        old = baseline.get(key) if isinstance(baseline, dict) else None
+        name = path + "/" + key if path else key
+        if isinstance(value, dict):
+            regressions += compare(value, old or dict(), tolerance, name)
+        elif not isinstance(value, float) or not old:
+            continue
+        elif key.endswith(("_ms", "_seconds")) and \
+                value > old * (1 + tolerance):
+            regressions.append("{}: {:.3f} -> {:.3f}".format(name, old, value))
+        elif key.endswith("per_second") and value < old * (1 - tolerance):
+            regressions.append("{}: {:.1f} -> {:.1f}".format(name, old, value))
+    return regressions
+
+
+def report(results, indent=""):
+    for key, value in results.items():
+        if isinstance(value, dict):
+            print("{}{}:".format(indent, key))
+            report(value, indent + "  ")
+        elif isinstance(value, float):
+            print("{}{}: {:.3f}".format(indent, key, value))
+        else:
+            print("{}{}: {}".format(indent, key, value))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--server", choices=("gunicorn", "flask"),
+                        default="gunicorn")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--concurrency", type=int, nargs="+",
+                        default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=500,
+                        help="requests per concurrency level")
+    parser.add_argument("--repeat", type=int, default=200,
+                        help="timed calls per in process stage")
+    parser.add_argument("--num-cubes", type=int, default=256)
+    parser.add_argument("--cube-size", type=int, default=360)
+    parser.add_argument("--num-recs", type=int, default=100)
+    parser.add_argument("--stub-latency-ms", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=120,
+                        help="seconds the server gets to answer at all")
+    parser.add_argument("--skip-stages", action="store_true")
+    parser.add_argument("--skip-end-to-end", action="store_true")
+    parser.add_argument("--out", help="results file, a new one in "
+                                      "output/benchmarks/ by default")
+    parser.add_argument("--baseline",
+                        help="earlier results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    print("Loading Model . . . \n")
+    started = time.perf_counter()
+    loaded = registry.load(args.model)
+    load_seconds = time.perf_counter() - started
+    cubes = random_cubes(loaded.vocabulary.names, args.num_cubes,
+                         args.cube_size, args.seed)
+
+    results = {
+        "created": datetime.datetime.utcnow().isoformat() + "Z",
+        "commit": git_commit(),
+        "config": {
+            key: value for key, value in vars(args).items()
+            if key not in ("out", "baseline")
+        },
+        "load_seconds": load_seconds,
+    }
+    if not args.skip_stages:
+        print("Timing Stages . . . \n")
+        results["stages"] = bench_stages(loaded, cubes, args.repeat,
+                                         amount=args.num_recs)
+    if not args.skip_end_to_end:
+        print("Driving The App . . . \n")
+        results["end_to_end"] = bench_end_to_end(args, cubes)
+    report(results)
+
+    out = args.out or os.path.join(RESULTS, "{}.json".format(
+        datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")))
+    if os.path.dirname(out):
+        os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out + ".tmp", "w") as f:
+        json.dump(results, f, indent=2)
+    os.replace(out + ".tmp", out)
+    print("\nWrote", out)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print("regression:", line)
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,49 @@
+import msgpack
+import numpy as np
+
+JSON = "json"
+COMPACT = "compact"
+MSGPACK = "msgpack"
+FORMATS = (JSON, COMPACT, MSGPACK)
+
+MSGPACK_MIMETYPE = "application/msgpack"
+
+
+def scored_arrays(indices, scores, fmt):
+    """
+    return: the compact encoding of ranked cards, parallel arrays of card
+        indices and float32 scores. For msgpack the arrays are sent as raw
+        little endian int32/float32 buffers.
+    """
+    indices = np.asarray(indices, dtype="<i4")
+    scores = np.asarray(scores)[indices].astype("<f4")
+    if fmt == MSGPACK:
+        return {"indices": indices.tobytes(), "scores": scores.tobytes()}
+    return {"indices": indices.tolist(), "scores": scores.tolist()}
+
+
+def pack(output):
+    return msgpack.packb(output, use_bin_type=True)
+
+
+def encode_cursor(version, offset):
+    return "{}:{}".format(offset, version)
+
+
+def decode_cursor(cursor, version):
+    """
+    param cursor: cursor from a previous page, "" for the first page
+    param version: version of the model serving this page
+    return: offset into the ranked list, None if the cursor is invalid or
+        was handed out by a different model version
+    """
+    if not cursor:
+        return 0
+    offset, _, cursor_version = cursor.partition(":")
+    if cursor_version != str(version):
+        return None
+    try:
+        offset = int(offset)
+    except ValueError:
+        return None
+    return offset if offset >= 0 else None
@@ -0,0 +1,14 @@
+import multiprocessing
+import os
+
+# gunicorn -c web/gunicorn.conf.py web:app
+
+bind = "0.0.0.0:8000"
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+threads = int(os.environ.get("RECOMMENDER_THREADS", 16))
+
+# import the app, and with it load the models, once in the master process.
+# The weights are memory mapped read only, so the forked workers share them
+# through the page cache instead of each reading its own copy.
+preload_app = True
+os.environ.setdefault("RECOMMENDER_PRELOAD", "1")
@@ -1,67 +1,227 @@
-import json
-import numpy as np
-import unidecode
-from tensorflow import keras
-import urllib.request
-
-ROOT = "https://cubecobra.com"
-
-
-def get_ml_recommend(cube_name, amount, root=ROOT, non_json=False):
-    url = root + "/cube/api/cubelist/" + cube_name
-
-    fp = urllib.request.urlopen(url)
-    mybytes = fp.read()
-
-    mystr = mybytes.decode("utf8")
-    fp.close()
-
-    card_names = mystr.split("\n")
-
-    int_to_card = json.load(open("./ml_files/recommender_id_map.json", "r"))
-    int_to_card = {int(k): v for k, v in int_to_card.items()}
-    card_to_int = {v: k for k, v in int_to_card.items()}
-
-    num_cards = len(int_to_card)
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-    cube_indices = []
-    for name in card_names:
-        idx = card_to_int.get(unidecode.unidecode(name.lower()))
-        # skip unknown cards (e.g. custom cards)
-        if idx is not None:
-            cube_indices.append(idx)
-
-    cube = np.zeros(num_cards)
-    cube[cube_indices] = 1
-
-    model = keras.models.load_model("./ml_files/recommender")
-
-    def recommend(model, data):
-        encoded = model.encoder(data)
-        return model.decoder(encoded)
-
-    cube = np.array(cube, dtype=float).reshape(1, num_cards)
-    results = recommend(model, cube)[0].numpy()
-
-    ranked = results.argsort()[::-1]
+import numpy as np
+from non_ml import cubelist, ranking
+
+from .batching import MicroBatcher
+from .formats import JSON, decode_cursor, encode_cursor, scored_arrays
+from .model_registry import DEFAULT_MODEL, ModelRegistry
+
+ROOT = cubelist.ROOT
+# set RECOMMENDER_MAX_BATCH_SIZE=1 to run every request on its own
+MAX_BATCH_SIZE = int(os.environ.get("RECOMMENDER_MAX_BATCH_SIZE", 64))
+MAX_BATCH_WAIT_MS = float(os.environ.get("RECOMMENDER_MAX_BATCH_WAIT_MS", 5))
+# cubes scored and ranked at a time for bulk requests, only the formatted
+# results of a chunk outlive it, so this bounds the size of the score matrix
+BULK_CHUNK_SIZE = int(os.environ.get("RECOMMENDER_BULK_CHUNK_SIZE", 256))
+# cubes per bulk request
+MAX_BULK_CUBES = int(os.environ.get("RECOMMENDER_MAX_BULK_CUBES", 1024))
+# additions per cube of a bulk request, the response holds num_recs of them
+# for every cube, so unlike a single request it's capped
+DEFAULT_BULK_RECS = 50
+MAX_BULK_RECS = int(os.environ.get("RECOMMENDER_MAX_BULK_RECS", 1000))
+BULK_FETCH_WORKERS = int(os.environ.get("RECOMMENDER_BULK_FETCH_WORKERS", 16))
+
+registry = ModelRegistry()
+
+# {model name: (LoadedModel, MicroBatcher serving it)}
+_batchers = dict()
+_batchers_lock = threading.Lock()
+_fetch_executor = ThreadPoolExecutor(max_workers=BULK_FETCH_WORKERS)
+
+
+def get_batcher(loaded):
+    """
+    return: the MicroBatcher serving this version of the model. When the
+        registry has swapped in a new version the old batcher is drained
+        and replaced.
+    """
+    current, batcher = _batchers.get(loaded.name, (None, None))
+    if current is loaded:
+        return batcher
+    with _batchers_lock:
+        current, batcher = _batchers.get(loaded.name, (None, None))
+        if current is not loaded:
+            old = batcher
+            batcher = MicroBatcher(
+                loaded.recommend_indices,
+                max_batch_size=MAX_BATCH_SIZE,
+                max_wait_ms=MAX_BATCH_WAIT_MS,
+                collate=list,
+            )
+            _batchers[loaded.name] = (loaded, batcher)
+            if old is not None:
+                old.close()
+    return batcher
+
+
+def build_cube(loaded, card_names):
+    """
+    return: sorted indices of the model's cards that are in the cube,
+        unknown cards (e.g. custom cards) are skipped
+    """
+    return np.unique(loaded.vocabulary.resolve(card_names))
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def format_recommendations(loaded, cube_indices, results, additions,
+                           non_json=False, fmt=JSON):
+    """
+    param additions: ranked indices of the cards to recommend adding
+    param fmt: one of formats.FORMATS
+    return: {"additions", "cuts"} with the score of every card, as
+        {name: score} dicts for json, else as parallel index/score arrays
+    """
+    int_to_card = loaded.int_to_card
+
+    if fmt != JSON:
+        return {
+            "additions": scored_arrays(additions, results, fmt),
+            "cuts": scored_arrays(cube_indices, results, fmt),
+        }
 
     output = {"additions": dict(), "cuts": dict()}
 
-    recommended = 0
-    for rec in ranked:
-        if cube[0][rec] != 1:
-            card = int_to_card[rec]
-            if non_json:
-                print(card)
-            else:
-                output["additions"][card] = results[rec].item()
-            recommended += 1
-            if recommended >= amount:
-                break
-
-    for idx in cube_indices:
-        card = int_to_card[idx]
-        output["cuts"][card] = results[idx].item()
+    if non_json:
+        for rec in additions.tolist():
+            print(int_to_card[rec])
+    else:
+        output["additions"] = ranking.scored(additions, results, int_to_card)
+
+    output["cuts"] = ranking.scored(cube_indices, results, int_to_card)
+
+    return output
+
+
+def rank_recommendations(loaded, cube_indices, results, amount,
+                         non_json=False, fmt=JSON, cursor=None):
+    """
+    param amount: number of additions per page, at least one
+    param cursor: None to return the top `amount` additions, otherwise ""
+        or the "next_cursor" of the previous page to page through the
+        ranking `amount` cards at a time
+    """
+    if amount < 1:
+        raise ValueError("amount needs to be at least 1, got {}".format(
+            amount))
+    offset = 0
+    if cursor is not None:
+        offset = decode_cursor(cursor, loaded.version)
+        if offset is None or offset < 0:
+            raise InvalidCursor("Invalid or expired cursor!")
+    exclude = ranking.index_mask(cube_indices, len(results))
+    additions = ranking.top_k(results, offset + amount, exclude=exclude)
+    output = format_recommendations(loaded, cube_indices, results,
+                                    additions[offset:], non_json, fmt)
+    if cursor is not None:
+        num_eligible = len(exclude) - np.count_nonzero(exclude)
+        end = offset + amount
+        output["next_cursor"] = encode_cursor(loaded.version, end) \
+            if end < num_eligible else None
+    return output
+
+
+def get_ml_recommend(cube_name, amount, root=ROOT, non_json=False,
+                     model_name=DEFAULT_MODEL, fmt=JSON, cursor=None):
+    card_names = cubelist.get_cards(cube_name, root)
+
+    loaded = registry.get(model_name)
+    cube_indices = build_cube(loaded, card_names)
+    results = get_batcher(loaded)(cube_indices)
+    output = rank_recommendations(loaded, cube_indices, results, amount,
+                                  non_json, fmt, cursor)
 
     if not non_json:
         return output
+
+
+def recommend_batch(loaded, card_lists, amount):
+    """
+    Scores, ranks and formats many cubes BULK_CHUNK_SIZE cubes at a time,
+    with one forward pass per chunk.
+
+    param card_lists: list of lists of card names
+    return: list of {"additions", "cuts"} dicts in the same order
+    """
+    output = []
+    for start in range(0, len(card_lists), BULK_CHUNK_SIZE):
+        cubes = [build_cube(loaded, names)
+                 for names in card_lists[start:start + BULK_CHUNK_SIZE]]
+        results = loaded.recommend_indices(cubes)
+        exclude = ranking.index_mask(cubes, loaded.num_cards)
+        additions = ranking.top_k(results, amount, exclude=exclude)
+        output.extend(
+            format_recommendations(loaded, cube_indices, results[i],
+                                   additions[i])
+            for i, cube_indices in enumerate(cubes)
+        )
+    return output
+
+
+def get_bulk_ml_recommend(cubes, amount, root=ROOT, model_name=DEFAULT_MODEL):
+    """
+    param cubes: list of {"cube_name": id} or {"cards": [card names]}
+    return: list with an {"additions", "cuts"} dict per cube, or an
+        {"error"} dict for cubes whose list couldn't be fetched
+    """
+    def fetch(entry):
+        if "cards" in entry:
+            return entry["cards"]
+        try:
+            return cubelist.get_cards(entry["cube_name"], root)
+        except Exception as e:
+            return e
+
+    card_lists = list(_fetch_executor.map(fetch, cubes))
+    return merge_bulk_results(
+        card_lists,
+        lambda found: recommend_batch(registry.get(model_name), found, amount),
+    )
+
+
+def merge_bulk_results(card_lists, score):
+    """
+    Scores the card lists that were fetched and puts an error in place of
+    the ones that raised.
+    """
+    found = [cards for cards in card_lists if not isinstance(cards, Exception)]
+    scored = iter(score(found))
+    return [
+        {"error": str(cards)} if isinstance(cards, Exception) else next(scored)
+        for cards in card_lists
+    ]
+
+
+def validate_bulk_request(body):
+    """
+    return: an error message for a malformed bulk request body, else None
+    """
+    if not isinstance(body, dict) or not isinstance(body.get("cubes"), list):
+        return "Need a json body with a list of cubes!"
+    if len(body["cubes"]) > MAX_BULK_CUBES:
+        return "At most {} cubes per request!".format(MAX_BULK_CUBES)
+    for entry in body["cubes"]:
+        if not isinstance(entry, dict) or \
+                ("cube_name" in entry) == ("cards" in entry):
+            return "Every cube needs exactly one of cube_name or cards!"
+        if "cube_name" in entry and not isinstance(entry["cube_name"], str):
+            return "cube_name needs to be a string!"
+        if "cards" in entry and not (
+                isinstance(entry["cards"], list) and
+                all(isinstance(card, str) for card in entry["cards"])):
+            return "cards needs to be a list of card names!"
+    for key in ("model", "root"):
+        if key in body and not isinstance(body[key], str):
+            return "{} needs to be a string!".format(key)
+    num_recs = body.get("num_recs", DEFAULT_BULK_RECS)
+    # bool is an int, but not a number of cards
+    if not isinstance(num_recs, int) or isinstance(num_recs, bool):
+        return "num_recs needs to be an integer!"
+    if not 1 <= num_recs <= MAX_BULK_RECS:
+        return "num_recs needs to be between 1 and {}!".format(MAX_BULK_RECS)
+    return None
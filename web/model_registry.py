@@ -0,0 +1,187 @@
+import logging
+import os
+import threading
+import time
+
+from ml.runtime import is_exported, load_recommender, model_file, to_csr
+from non_ml.vocabulary import load_vocabulary
+
+ML_FILES = "./ml_files"
+DEFAULT_MODEL = "recommender"
+# fallback for model directories that don't ship their own id map
+DEFAULT_ID_MAP = "recommender_id_map.json"
+ID_MAP = "id_map.json"
+# float32, float16 or int8, see src/ml/quantize.py
+PRECISION = os.environ.get("RECOMMENDER_PRECISION", "float32")
+
+logger = logging.getLogger(__name__)
+
+
+class LoadedModel:
+    """
+    A model together with the card lookups it was trained against.
+
+    Instances are never mutated after construction, so a request holding
+    one keeps a consistent view even if the registry swaps in a newer version
+    while the request is in flight.
+    """
+    def __init__(self, name, model, vocabulary, version):
+        self.name = name
+        self.model = model
+        self.vocabulary = vocabulary
+        self.int_to_card = vocabulary.names
+        self.card_to_int = vocabulary.card_to_int
+        self.num_cards = len(vocabulary)
+        self.version = version
+
+    def recommend(self, data):
+        """
+        return: scores for a batch of cube vectors as a NumPy array
+        """
+        return self.model.recommend(data)
+
+    def recommend_indices(self, index_lists):
+        """
+        param index_lists: one array of card indices per cube
+        return: scores for the batch of cubes as a NumPy array
+        """
+        return self.model.recommend_indices(*to_csr(index_lists))
+
+
+class ModelRegistry:
+    """
+    Process wide cache of the models under `ml_files/`.
+
+    Every model directory is loaded at most once per worker. Once loaded, the
+    directory is checked for a newer version at most every `check_interval`
+    seconds; if one is found it is loaded in a background thread and swapped
+    in atomically, while requests keep being served by the old version. The
+    listing of the model directories is refreshed as often.
+    """
+    def __init__(self, root=ML_FILES, check_interval=30, precision=PRECISION):
+        self.root = root
+        self.check_interval = check_interval
+        self.precision = precision
+        self._models = dict()
+        self._checked = dict()
+        self._reloading = set()
+        self._listing = None
+        self._listed = 0
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+
+    def available(self):
+        """
+        return: names of the model directories that can be loaded, and of
+            the models already loaded, which keep being served while
+            train.py swaps their directory
+        """
+        now = time.time()
+        if self._listing is None or (self.check_interval is not None and
+                                     now - self._listed >= self.check_interval):
+            self._listing = self._list()
+            self._listed = now
+        return sorted(set(self._listing).union(self._models))
+
+    def _list(self):
+        if not os.path.isdir(self.root):
+            return []
+        # train.py stages new models in `<name>.tmp`/`<name>.old` directories
+        return [
+            name for name in os.listdir(self.root)
+            if "." not in name
+            and model_file(os.path.join(self.root, name)) is not None
+        ]
+
+    def get(self, name=DEFAULT_MODEL):
+        """
+        param name: name of a model directory under the registry root
+        return: the current LoadedModel for that name
+        """
+        loaded = self._models.get(name)
+        if loaded is None:
+            return self.load(name)
+        if self._should_check(name) and self._version(name) != loaded.version:
+            self._reload_in_background(name)
+        return loaded
+
+    def load(self, name):
+        """
+        Loads (or reloads) a model synchronously and swaps it in.
+        A version that is already loaded is not loaded again.
+        """
+        path = self._path(name)
+        with self._lock:
+            version = self._version(name)
+            current = self._models.get(name)
+            if current is not None and current.version == version:
+                return current
+            model = load_recommender(path, self.precision)
+            vocabulary = self._load_vocabulary(path)
+            loaded = LoadedModel(name, model, vocabulary, version)
+            # a single dict assignment, so readers see either version whole
+            self._models[name] = loaded
+            self._checked[name] = time.time()
+        logger.info("loaded model %s (version %s)", name, version)
+        return loaded
+
+    def preload(self, names=None):
+        """
+        Eagerly loads `names`, e.g. before a server starts accepting requests
+        or forks its workers. By default that is every model that loads
+        without tensorflow, which isn't safe to fork once initialized.
+        """
+        if names is None:
+            names = [
+                name for name in self.available()
+                if is_exported(os.path.join(self.root, name), self.precision)
+            ]
+        for name in names:
+            self.load(name)
+
+    def _path(self, name):
+        # only accept known directory names so `name` can't escape the root
+        if name not in self.available():
+            raise KeyError("Unknown model: " + str(name))
+        return os.path.join(self.root, name)
+
+    def _version(self, name):
+        try:
+            stat = os.stat(model_file(os.path.join(self.root, name),
+                                      self.precision))
+        except (FileNotFoundError, TypeError):
+            # mid swap by train.py, keep serving what we have
+            current = self._models.get(name)
+            return None if current is None else current.version
+        return stat.st_mtime_ns
+
+    def _load_vocabulary(self, path):
+        id_map = os.path.join(path, ID_MAP)
+        if not os.path.isfile(id_map):
+            id_map = os.path.join(self.root, DEFAULT_ID_MAP)
+        return load_vocabulary(id_map)
+
+    def _should_check(self, name):
+        if self.check_interval is None:
+            return False
+        now = time.time()
+        if now - self._checked.get(name, 0) < self.check_interval:
+            return False
+        self._checked[name] = now
+        return True
+
+    def _reload_in_background(self, name):
+        with self._reload_lock:
+            if name in self._reloading:
+                return
+            self._reloading.add(name)
+
+        def reload():
+            try:
+                self.load(name)
+            except Exception as e:
+                logger.error("failed to reload model %s: %s", name, e)
+            finally:
+                self._reloading.discard(name)
+
+        threading.Thread(target=reload, daemon=True).start()